@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+
+"""Cold start benchmark of inetd mode (pysieved -i).
+
+Every run starts a new interpreter on an accepted TCP connection, like
+xinetd does, and measures:
+
+* the time to import pysieved.main
+* the time until the client has the whole greeting
+
+The configuration uses htpasswd, virtual and Dovecot storage, plus TLS
+if --key and --cert are given (the key is then parsed at STARTTLS, or
+read from --key-cache, which only the tlslite backend has and selects).
+
+Usage: python benchmarks/bench_inetd.py [--runs N] [--key KEY --cert CERT]
+
+"""
+
+import optparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """
+[main]
+auth = htpasswd
+userdb = virtual
+storage = Dovecot
+logfile = %(tmp)s/pysieved.log
+
+[TLS]
+backend = %(backend)s
+key = %(key)s
+cert = %(cert)s
+key_cache = %(key_cache)s
+
+[htpasswd]
+passwdfile = %(tmp)s/passwd
+
+[Virtual]
+path = %(tmp)s/%%u
+uid = -1
+gid = -1
+"""
+
+IMPORT = "import time; t = time.perf_counter(); import pysieved.main; print(time.perf_counter() - t)"
+
+
+def import_time(env):
+    out = subprocess.check_output([sys.executable, "-c", IMPORT], env=env)
+    return float(out)
+
+
+def greeting_time(env, config):
+    listener = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(listener.getsockname())
+    conn, _ = listener.accept()
+    listener.close()
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "pysieved.main", "-i", "-c", config],
+        stdin=conn,
+        stdout=subprocess.DEVNULL,
+        env=env,
+    )
+    conn.close()
+
+    greeting = b""
+    while not greeting.endswith(b"OK\r\n"):
+        data = client.recv(4096)
+        if not data:
+            raise RuntimeError("No greeting: %r" % greeting)
+        greeting += data
+    elapsed = time.perf_counter() - start
+
+    client.sendall(b"LOGOUT\r\n")
+    client.close()
+    proc.wait()
+
+    return elapsed
+
+
+def report(name, times):
+    print(
+        "%-16s min %8.1f ms  median %8.1f ms"
+        % (name, min(times) * 1000, statistics.median(times) * 1000)
+    )
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--runs", type="int", default=20, help="Connections")
+    parser.add_option("--key", default="", help="TLS private key")
+    parser.add_option("--cert", default="", help="TLS certificate")
+    parser.add_option("--key-cache", default="", help="Parsed key cache directory")
+    options, _ = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        open(os.path.join(tmp, "passwd"), "w").close()
+        config = os.path.join(tmp, "pysieved.ini")
+        with open(config, "w") as f:
+            f.write(
+                CONFIG
+                % {
+                    "tmp": tmp,
+                    "backend": "tlslite" if options.key_cache else "ssl",
+                    "key": options.key,
+                    "cert": options.cert,
+                    "key_cache": options.key_cache,
+                }
+            )
+
+        report("import", [import_time(env) for _ in range(options.runs)])
+        report("greeting", [greeting_time(env, config) for _ in range(options.runs)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+
+"""Per-command cost of logging in RequestHandler.
+
+Pipelined commands are parsed from memory and answered with OK, like
+bench_parser.py, while every protocol line goes through main.log:
+
+* eager: the message is formatted before the verbosity check, as
+  before log() took arguments
+* lazy: the arguments are only formatted when the level is enabled
+
+Both do the same work once the level is enabled (verbosity 3), and
+only differ by noise there.
+
+Records go either to a WatchedFileHandler in the process (a stat() of
+the log file per record), or to a LogWriter process.  The CPU column is
+the session process alone: on a single CPU the wall time includes the
+writer's work too.
+
+Usage: python benchmarks/bench_logging.py [--commands N] [--repeat N]
+
+"""
+
+import logging
+import optparse
+import os
+import tempfile
+import time
+from logging.handlers import WatchedFileHandler
+
+from pysieved import logwriter, main
+from pysieved.managesieve import Hangup, RequestHandler
+
+
+class MemorySocket:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def recv_into(self, buffer):
+        n = min(len(buffer), 1448, len(self.data) - self.pos)
+        buffer[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+class Session(RequestHandler):
+    def __init__(self, data):
+        self.request = MemorySocket(data)
+        self.setup()
+        self.reset_input()
+        self.out = []
+        self.recv_into = self.request.recv_into
+        self.sendall = lambda data: None
+
+    def log(self, level, message, *args):
+        main.log(level, message, *args)
+
+    def get_tls_params(self):
+        return {"required": False, "credentials": None}
+
+
+class EagerSession(Session):
+    def log(self, level, message, *args):
+        if args:
+            message = message % args
+        main.log(level, message)
+
+
+def run(session_class, data):
+    session = session_class(data)
+    commands = 0
+    start = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        while True:
+            session.get_command()
+            session.ok()
+            commands += 1
+    except Hangup:
+        pass
+
+    return (
+        (time.perf_counter() - start) / commands,
+        (time.process_time() - cpu) / commands,
+    )
+
+
+def file_sink(path):
+    handler = WatchedFileHandler(path)
+    main.LOGGER.addHandler(handler)
+
+    def stop():
+        main.LOGGER.removeHandler(handler)
+        handler.close()
+
+    return stop
+
+
+def writer_sink(path):
+    handler = WatchedFileHandler(path)
+    main.LOGGER.addHandler(handler)
+    pid = logwriter.spawn(handler, main.LOGGER)
+
+    def stop():
+        for sender in list(main.LOGGER.handlers):
+            main.LOGGER.removeHandler(sender)
+            sender.close()
+        os.waitpid(pid, 0)
+
+    return stop
+
+
+def main_():
+    parser = optparse.OptionParser()
+    parser.add_option("--commands", type="int", default=20000, help="Commands")
+    parser.add_option("--repeat", type="int", default=5, help="Best of N runs")
+    options, _ = parser.parse_args()
+
+    data = b'HAVESPACE "script" "1000"\r\n' * options.commands
+    main.LOGGER.setLevel(logging.DEBUG)
+    main.LOGGER.propagate = False
+    main.lean_records()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for verbosity in (1, 3):
+            main.VERBOSITY = verbosity
+            cases = [
+                (sink, session_class)
+                for sink in (file_sink, writer_sink)
+                for session_class in (EagerSession, Session)
+            ]
+
+            # Take turns, so that every case sees the same noise
+            best = {}
+            for _ in range(options.repeat):
+                for case in cases:
+                    sink, session_class = case
+                    stop = sink(os.path.join(tmp, "pysieved.log"))
+                    try:
+                        elapsed = run(session_class, data)
+                    finally:
+                        stop()
+                    if case not in best or elapsed < best[case]:
+                        best[case] = elapsed
+
+            for sink, session_class in cases:
+                elapsed = best[sink, session_class]
+                name = "lazy" if session_class is Session else "eager"
+                sink_name = sink.__name__[: -len("_sink")]
+                print(
+                    "verbosity %d  %-6s  %-5s  %7.2f us/command  %7.2f us CPU"
+                    % (verbosity, sink_name, name, elapsed[0] * 1e6, elapsed[1] * 1e6)
+                )
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+
+"""Micro-benchmark for the command parser of RequestHandler.
+
+Commands are fed to get_command() from memory, so this only measures
+parsing and input buffering:
+
+* PUTSCRIPT with one large literal
+* many short commands pipelined in one stream
+
+The same input is also run through the old parser (bytes concatenation
+and 1024 byte reads) for comparison.
+
+Reads hand over at most --chunk bytes, like a socket receiving
+MSS-sized segments.
+
+Usage: python benchmarks/bench_parser.py [--size BYTES] [--commands N]
+
+"""
+
+import optparse
+import time
+
+from pysieved.managesieve import Hangup, RequestHandler
+
+
+class MemorySocket:
+    """Hands out `data` like a socket would, at most `chunk` bytes a call."""
+
+    def __init__(self, data, chunk):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.chunk = chunk
+        self.calls = 0
+
+    def recv(self, n):
+        self.calls += 1
+        n = min(n, self.chunk)
+        s = bytes(self.data[self.pos : self.pos + n])
+        self.pos += len(s)
+        return s
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        n = min(len(buffer), self.chunk, len(self.data) - self.pos)
+        buffer[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+class Parser(RequestHandler):
+    def __init__(self, data, chunk):
+        self.request = MemorySocket(data, chunk)
+        self.setup()
+        self.reset_input()
+        self.out = []
+        self.recv_into = self.request.recv_into
+        self.sendall = lambda data: None
+
+    def log(self, level, message, *args):
+        pass
+
+    def get_tls_params(self):
+        return {"required": False, "credentials": None}
+
+
+class LegacyParser(Parser):
+    """readline() and bread() as they were before the input buffer."""
+
+    def __init__(self, data, chunk):
+        super().__init__(data, chunk)
+        self.buf = b""
+
+    def bread(self, n):
+        buffer = self.buf
+        while len(buffer) < n:
+            r = self.request.recv(n - len(buffer))
+            if not r:
+                raise Hangup()
+            buffer += r
+        self.buf = buffer[n:]
+        s = buffer[:n]
+        self.log(3, "C: %r" % s)
+        return s
+
+    def readline(self):
+        out = self.buf
+        while True:
+            pos = out.find(b"\r\n")
+            if pos > -1:
+                self.buf = out[pos + 2 :]
+                s = out[:pos]
+                self.log(3, "C: %r" % (s + b"\r\n"))
+                return s.decode()
+            r = self.request.recv(1024)
+            if not r:
+                raise Hangup()
+            out += r
+
+
+def parse_all(parser_class, data, chunk):
+    parser = parser_class(data, chunk)
+    commands = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            parser.get_command()
+            commands += 1
+    except Hangup:
+        pass
+    elapsed = time.perf_counter() - start
+
+    return elapsed, commands, parser.request.calls
+
+
+def report(name, data, chunk, repeat):
+    for parser_class in (LegacyParser, Parser):
+        best = None
+        for _ in range(repeat):
+            result = parse_all(parser_class, data, chunk)
+            if best is None or result[0] < best[0]:
+                best = result
+
+        elapsed, commands, calls = best
+        print(
+            "%-22s %-12s %9.3f ms  %7d commands  %6d reads"
+            % (name, parser_class.__name__, elapsed * 1000, commands, calls)
+        )
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--size", type="int", default=100000, help="Literal size")
+    parser.add_option("--commands", type="int", default=20000, help="Commands")
+    parser.add_option(
+        "--chunk", type="int", default=1448, help="Bytes the network hands over per read"
+    )
+    parser.add_option("--repeat", type="int", default=5, help="Best of N runs")
+    options, _ = parser.parse_args()
+
+    script = b"# " + b"x" * (options.size - 3) + b"\n"
+    literal = b'PUTSCRIPT "big" {%d+}\r\n%s\r\n' % (len(script), script)
+    report("large literal", literal, options.chunk, options.repeat)
+
+    pipelined = b'HAVESPACE "script" "1000"\r\n' * options.commands
+    report("pipelined commands", pipelined, options.chunk, options.repeat)
+
+
+if __name__ == "__main__":
+    main()
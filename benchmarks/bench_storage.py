@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+
+"""Benchmark of FileStorage metadata operations on a slow filesystem.
+
+A session opens the storage, then runs LISTSCRIPTS and GETSCRIPT on
+every script.  Filesystem calls made through the os module are counted
+and each one is delayed by --latency milliseconds, like round trips to
+an NFS server would be.
+
+The same session is also run against the old FileStorage (listdir,
+exists and samefile on absolute paths) for comparison.
+
+Usage: python benchmarks/bench_storage.py [--scripts N] [--latency MS]
+
+"""
+
+import functools
+import optparse
+import os
+import tempfile
+import time
+
+from pysieved.plugins import FileStorage
+
+SLOW_CALLS = (
+    "stat",
+    "lstat",
+    "open",
+    "readlink",
+    "listdir",
+    "scandir",
+    "mkdir",
+    "unlink",
+    "symlink",
+    "rename",
+)
+
+
+class SlowFilesystem:
+    """Delays and counts the filesystem calls in SLOW_CALLS."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.saved = {}
+
+    def __enter__(self):
+        for name in SLOW_CALLS:
+            self.saved[name] = func = getattr(os, name)
+            setattr(os, name, self.slow(func))
+        return self
+
+    def __exit__(self, *exc):
+        for name, func in self.saved.items():
+            setattr(os, name, func)
+
+    def slow(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.calls += 1
+            time.sleep(self.latency)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+
+class LegacyFileStorage(FileStorage.FileStorage):
+    """The metadata operations as they were before directory descriptors."""
+
+    def __init__(self, sieve_test, mydir, active_file, homedir):
+        self.sieve_test = sieve_test
+        self.mydir = mydir
+        self.active_file = active_file
+        self.homedir = homedir
+        self.basedir = os.path.join(self.homedir, self.mydir)
+        self.active = os.path.join(self.homedir, self.active_file)
+        self.homefd = self.dirfd = None
+
+        if not os.path.exists(self.basedir):
+            os.mkdir(self.basedir)
+
+        if os.path.exists(self.active) and not os.path.islink(self.active):
+            os.rename(self.active, os.path.join(self.basedir, "dovecot"))
+            self.set_active("dovecot")
+
+    def open_script(self, k):
+        fn = os.path.join(self.basedir, FileStorage.quote(k))
+
+        try:
+            fd = os.open(fn, os.O_RDONLY)
+        except OSError:
+            raise KeyError("Unknown script")
+
+        return fd, os.fstat(fd).st_size
+
+    def __iter__(self):
+        for s in os.listdir(self.basedir):
+            if s[0] == ".":
+                continue
+            if s[-1] == "~":
+                continue
+            yield FileStorage.unquote(s)
+
+    def has_key(self, k):
+        return os.path.exists(os.path.join(self.basedir, FileStorage.quote(k)))
+
+    def is_active(self, k):
+        fn = os.path.join(self.basedir, FileStorage.quote(k))
+        if not self.has_key(k):
+            raise KeyError("Unknown script %s" % k)
+        try:
+            return os.path.samefile(fn, self.active)
+        except OSError:
+            return False
+
+    def active_name(self):
+        # LISTSCRIPTS asked every script
+        active = None
+        for k in self:
+            if self.is_active(k):
+                active = k
+        return active
+
+    def set_active(self, k):
+        if k:
+            fn = os.path.join(self.mydir, FileStorage.quote(k))
+        try:
+            os.unlink(self.active)
+        except OSError:
+            pass
+        if k:
+            os.symlink(fn, self.active)
+
+
+def session(storage_class, home, latency):
+    with SlowFilesystem(latency) as fs:
+        start = time.perf_counter()
+
+        storage = storage_class(None, ".pysieved", ".dovecot.sieve", home)
+
+        # LISTSCRIPTS
+        active = storage.active_name()
+        names = [(name, name == active) for name in storage]
+
+        # GETSCRIPT of each
+        for name, _ in names:
+            fd, _ = storage.open_script(name)
+            os.close(fd)
+
+        elapsed = time.perf_counter() - start
+        storage.close()
+
+    return elapsed, fs.calls, len(names)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--scripts", type="int", default=20, help="Scripts per user")
+    parser.add_option(
+        "--latency", type="float", default=1.0, help="Milliseconds per call"
+    )
+    parser.add_option(
+        "--depth", type="int", default=6, help="Directories above the home"
+    )
+    options, _ = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        home = os.path.join(tmp, *["d%d" % i for i in range(options.depth)])
+        os.makedirs(os.path.join(home, ".pysieved"))
+        for i in range(options.scripts):
+            name = FileStorage.quote("script %d" % i)
+            with open(os.path.join(home, ".pysieved", name), "w") as f:
+                f.write("keep;\n")
+        os.symlink(".pysieved/script%200", os.path.join(home, ".dovecot.sieve"))
+
+        for storage_class in (LegacyFileStorage, FileStorage.FileStorage):
+            elapsed, calls, scripts = session(
+                storage_class, home, options.latency / 1000
+            )
+            print(
+                "%-18s %9.3f ms  %5d calls  %4d scripts"
+                % (storage_class.__name__, elapsed * 1000, calls, scripts)
+            )
+
+
+if __name__ == "__main__":
+    main()
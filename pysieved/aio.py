@@ -0,0 +1,326 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import asyncio
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pysieved.managesieve import Hangup, LiteralTooLarge, compact_traceback, discard
+
+
+class AsyncSession:
+    """Run a RequestHandler over asyncio streams.
+
+    Waiting for the next command happens on the event loop, so an idle
+    connection only costs a coroutine.  Commands run in the server's
+    executor since they call plugins that block (saslauthd, PAM, sievec,
+    the filesystem).  A command that needs more input from the client,
+    like a SASL exchange, reads it through the event loop, and the
+    session is dropped if it waits longer than `input_timeout`.
+
+    Replies, scripts sent by GETSCRIPT included, are collected while a
+    command runs and written out when it is done, or before the command
+    waits for the client.
+
+    """
+
+    # Seconds a command's thread may wait on the client
+    input_timeout = 120
+
+    def __init__(self, reader, writer, server):
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.loop = server.loop
+        self.request = writer.get_extra_info("socket")
+        self.client_address = writer.get_extra_info("peername")
+
+        self.out = []
+
+        self.setup()
+
+    def get_tls_params(self):
+        # STARTTLS has to go through the event loop, which only speaks ssl
+        params = super().get_tls_params()
+        credentials = params["credentials"]
+        if (
+            credentials is None
+            or credentials.backend != "ssl"
+            or not hasattr(self.writer, "start_tls")
+        ):
+            return dict(params, credentials=None)
+        return params
+
+    async def handle_async(self):
+        self.log(1, "Connect from %r", self.client_address)
+
+        try:
+            await self.blocking(self.do_capability)
+            while True:
+                try:
+                    cmd = await self.get_command_async()
+                except AssertionError as error:
+                    self.no(reason=error)
+                    await self.flush_async()
+                    continue
+                except LiteralTooLarge:
+                    self.no(code="QUOTA/MAXSIZE", reason="Literal too large")
+                    await self.flush_async()
+                    continue
+
+                await self.blocking(self.run_command, cmd)
+
+        except (Hangup, ConnectionError):
+            pass
+        except Exception:
+            _, t, v, tbinfo = compact_traceback()
+            self.log(-1, "[ERROR] %s:%s %s", t, v, tbinfo)
+            try:
+                self.bye(reason="Server error")
+                await self.flush_async()
+            except Exception:
+                pass
+        finally:
+            self.finish()
+
+    async def blocking(self, func, *args):
+        try:
+            return await self.loop.run_in_executor(self.server.executor, func, *args)
+        finally:
+            await self.flush_async()
+
+    def flush(self):
+        # Replies are sent from the event loop, by flush_async()
+        pass
+
+    async def flush_async(self):
+        out, self.out = self.out, []
+
+        try:
+            while out:
+                # Queued bytes up to the next file go out in one write
+                n = 0
+                while n < len(out) and isinstance(out[n], bytes):
+                    n += 1
+                if n:
+                    data = b"".join(out[:n])
+                    del out[:n]
+                    self.writer.write(data)
+                    self.sent += len(data)
+                    continue
+
+                f, size = out.pop(0)
+                with f:
+                    await self.writer.drain()
+                    sent = await self.loop.sendfile(self.writer.transport, f, 0, size)
+                self.sent += sent
+                if sent != size:
+                    raise OSError("File shrank while sending")
+        finally:
+            for item in out:
+                if not isinstance(item, bytes):
+                    item[0].close()
+
+        await self.writer.drain()
+
+    async def readline_async(self) -> str:
+        await self.flush_async()
+
+        try:
+            s = await self.reader.readuntil(b"\r\n")
+        except asyncio.IncompleteReadError:
+            raise Hangup()
+
+        self.received += len(s)
+        self.log(3, "C: %r", s)
+
+        return s[:-2].decode()
+
+    async def bread_async(self, n) -> bytes:
+        try:
+            s = await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError:
+            raise Hangup()
+
+        self.received += n
+        self.log(3, "C: %r", s)
+
+        return s
+
+    async def bread_into_async(self, n, f):
+        left = n
+        while left:
+            s = await self.reader.read(min(left, self.rbufsize))
+            if not s:
+                raise Hangup()
+            left -= len(s)
+            self.received += len(s)
+            if f is not discard:
+                await self.loop.run_in_executor(self.server.executor, f.write, s)
+
+        self.log(3, "C: <%d bytes>", n)
+
+    async def get_command_async(self):
+        oparts = [""]
+
+        while True:
+            n = self.parse_line(await self.readline_async(), oparts)
+            if n is None:
+                break
+            elif n < 0:
+                continue
+
+            sink = await self.blocking(self.literal_sink, oparts, n)
+            if sink is not None:
+                await self.bread_into_async(n, sink)
+                oparts[-1] = sink
+            elif self.is_script(oparts):
+                oparts[-1] = await self.bread_async(n)
+            else:
+                oparts[-1] = (await self.bread_async(n)).decode()
+
+        if any(p is discard for p in oparts):
+            raise LiteralTooLarge()
+
+        assert oparts != [""], "No command given"
+        return oparts
+
+    # Commands run in executor threads: block them on the event loop
+    def readline(self) -> str:
+        return self.wait_for(self.readline_async())
+
+    def bread(self, n) -> bytes:
+        return self.wait_for(self.bread_async(n))
+
+    def sendfile(self, f, size):
+        # Sent by flush_async() in turn, without holding up the thread
+        self.out.append((open(os.dup(f.fileno()), "rb"), size))
+
+    def start_ssl(self, context):
+        self.wait_for(self.start_ssl_async(context))
+
+    async def start_ssl_async(self, context):
+        # The OK goes out in the clear
+        await self.flush_async()
+        await self.writer.start_tls(context)
+        self.tls = self.writer.get_extra_info("ssl_object")
+        self.log(2, "TLS session %s", "resumed" if self.tls.session_reused else "new")
+
+    def wait_for(self, coro):
+        coro = asyncio.wait_for(coro, self.input_timeout)
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+        except asyncio.TimeoutError:
+            self.log(1, "Timed out waiting for the client")
+            raise Hangup()
+
+
+def make_async_handler(handler):
+    class AsyncRequestHandler(AsyncSession, handler):
+        pass
+
+    return AsyncRequestHandler
+
+
+class AsyncServer:
+    """Serve every connection as a coroutine on one event loop.
+
+    Looks like a socketserver server to main() and the tests:
+    serve_forever(), shutdown() and server_close().
+
+    """
+
+    address_family = socket.AF_INET6
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, server_address, RequestHandlerClass, threads=16):
+        self.RequestHandlerClass = make_async_handler(RequestHandlerClass)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="pysieved")
+        self.loop = None
+        self.tasks = set()
+
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.server_address = self.socket.getsockname()
+        self.socket.listen(self.request_queue_size)
+
+        self._stop = None
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def serve_forever(self):
+        self._is_shut_down.clear()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self._shutdown_request = False
+            self.loop = None
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stop.set)
+
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+
+    async def serve(self):
+        self._stop = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+
+        server = await asyncio.start_server(
+            self.handle_connection,
+            sock=self.socket.dup(),
+            backlog=self.request_queue_size,
+        )
+
+        try:
+            if not self._shutdown_request:
+                await self._stop.wait()
+        finally:
+            server.close()
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+
+        try:
+            handler = self.RequestHandlerClass(reader, writer, self)
+            await handler.handle_async()
+        finally:
+            self.tasks.discard(task)
+            writer.close()
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+
+from pysieved.cache import FileCache
+
+
+class AuthCache:
+    """Remember successful logins for a short while.
+
+    Only exchanges done in one step (PLAIN with an initial response)
+    can be replayed from the cache.  Entries are keyed by an HMAC of the
+    mechanism and the client's response, with a secret kept next to the
+    cache, so neither passwords nor their plain hashes are ever stored.
+    A failed login drops every cached login of that user.
+
+    """
+
+    def __init__(self, cache, secret, ttl):
+        self.cache = cache
+        self.secret = secret
+        self.ttl = ttl
+
+    def digest(self, *parts):
+        message = "\0".join(parts).encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def cacheable(self, mechanism, args):
+        return mechanism.upper() == "PLAIN" and len(args) == 1
+
+    def username(self, response):
+        "The authentication identity of a PLAIN response"
+
+        try:
+            decoded = base64.b64decode(response)
+            _, username, _ = decoded.decode().split("\0", 2)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            return None
+
+        return username
+
+    def lookup(self, mechanism, args):
+        """Return the username of a cached login, or None."""
+
+        if not self.cacheable(mechanism, args):
+            return None
+
+        username = self.username(args[0])
+        if username is None:
+            return None
+
+        value = self.cache.get(
+            self.digest("login", mechanism.upper(), args[0]),
+            self.digest("user", username),
+        )
+        if value is None:
+            return None
+
+        return value.decode()
+
+    def succeeded(self, mechanism, args, username):
+        if not self.cacheable(mechanism, args):
+            return
+
+        # Invalidated through the name the client logged in with
+        login = self.username(args[0])
+        if login is None:
+            return
+
+        self.cache.set(
+            self.digest("login", mechanism.upper(), args[0]),
+            username.encode(),
+            self.ttl,
+            self.digest("user", login),
+        )
+
+    def failed(self, mechanism, args):
+        if not self.cacheable(mechanism, args):
+            return
+
+        login = self.username(args[0])
+        if login is not None:
+            self.cache.invalidate(self.digest("user", login))
+
+
+def read_secret(path):
+    fn = os.path.join(path, ".secret")
+    try:
+        fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+
+    with open(fn, "rb") as f:
+        return f.read()
+
+
+def get_auth_cache(config, log=None):
+    """Return the AuthCache configured in [main], or None."""
+
+    path = config.get("main", "auth_cache", "")
+    if not path:
+        return None
+
+    # Entries are only for pysieved's eyes
+    cache = FileCache(
+        path,
+        config.getint("main", "auth_cache_size", 10000),
+        log,
+        mode=0o600,
+    )
+
+    try:
+        secret = read_secret(path)
+    except OSError as error:
+        if log:
+            log(1, "Authentication cache disabled: %s" % error)
+        return None
+
+    return AuthCache(cache, secret, config.getint("main", "auth_cache_ttl", 60))
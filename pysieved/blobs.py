@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+
+import hashlib
+import os
+import stat
+
+from pysieved.cache import due
+
+
+def file_digest(path):
+    """Return the SHA-256 of a file, in hex"""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """Script bodies stored once, under their SHA-256.
+
+    A stored script is a hard link to its blob, so a blob with a single
+    link is used by nobody, and collect() removes it.  Only scripts
+    that validated become blobs: storing a known body is a link instead
+    of a write and a validation.
+
+    Blobs are only linked to by sessions running as the blob's owner,
+    so users with their own uid don't share files (and the kernel's
+    protected_hardlinks wouldn't let them anyway).  The directory must
+    be on the same filesystem as the scripts.
+
+    """
+
+    collect_interval = 3600
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log or (lambda level, message: None)
+
+    def filename(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def find(self, digest):
+        """Return the path of a blob we may link to, or None."""
+
+        fn = self.filename(digest)
+        try:
+            st = os.lstat(fn)
+        except OSError:
+            return None
+
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid():
+            return None
+
+        return fn
+
+    def add(self, path, digest):
+        """Make the validated script at path the blob for digest."""
+
+        fn = self.filename(digest)
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            os.link(path, fn)
+        except FileExistsError:
+            pass
+        except OSError as error:
+            self.log(3, "Blob store %s: %s" % (self.path, error))
+
+    def maybe_collect(self):
+        if due(os.path.join(self.path, ".collected"), self.collect_interval):
+            self.collect()
+
+    def collect(self):
+        removed = 0
+        try:
+            with os.scandir(self.path) as dirs:
+                for d in dirs:
+                    if d.name.startswith(".") or not d.is_dir(follow_symlinks=False):
+                        continue
+                    with os.scandir(d.path) as blobs:
+                        for blob in blobs:
+                            try:
+                                if blob.stat(follow_symlinks=False).st_nlink > 1:
+                                    continue
+                                os.unlink(blob.path)
+                            except OSError:
+                                continue
+                            removed += 1
+        except OSError as error:
+            self.log(3, "Blob store %s: %s" % (self.path, error))
+
+        if removed:
+            self.log(3, "Blob store %s: removed %d blobs" % (self.path, removed))
+        return removed
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import hashlib
+import os
+import tempfile
+import time
+
+
+def due(marker, interval):
+    """Return True at most once every `interval` seconds per marker file.
+
+    Any number of processes may share the marker: whoever touches it
+    first gets True, the rest see a fresh mtime and get False.
+    """
+
+    try:
+        if time.time() - os.stat(marker).st_mtime < interval:
+            return False
+    except OSError:
+        pass
+
+    try:
+        open(marker, "ab").close()
+        os.utime(marker)
+    except OSError:
+        return False
+
+    return True
+
+
+class FileCache:
+    """Key/value cache kept as files in one directory.
+
+    Every process (forked children, prefork workers) sees the same
+    entries.  An entry is a file named after the hash of its key, which
+    holds the expiry time on the first line and the value after it.
+    Reading an entry touches it, and once every `evict_interval` seconds
+    one process removes the least recently used entries beyond
+    `max_entries`.
+
+    Entries may belong to a group, and invalidate(group) drops all of
+    them at once: every group has a generation, which its entries must
+    match.
+
+    The cache is best effort: errors are logged and count as a miss.
+
+    """
+
+    evict_interval = 60
+
+    def __init__(self, path, max_entries=10000, log=None, mode=0o644):
+        self.path = path
+        self.max_entries = max_entries
+        self.log = log or (lambda level, message: None)
+        self.mode = mode
+
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as error:
+            self.log(1, "Cache %s unusable: %s" % (path, error))
+
+    def filename(self, key, prefix=""):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, prefix + digest)
+
+    def generation(self, group):
+        if group is None:
+            return b"-"
+
+        try:
+            with open(self.filename(group, ".g"), "rb") as f:
+                return f.read() or b"-"
+        except OSError:
+            return b"-"
+
+    def get(self, key, group=None):
+        fn = self.filename(key)
+        try:
+            with open(fn, "rb") as f:
+                header, _, value = f.read().partition(b"\n")
+
+            expires, _, generation = header.partition(b" ")
+            expires = int(expires)
+            if expires and expires < time.time():
+                os.unlink(fn)
+                return None
+
+            if generation != self.generation(group):
+                return None
+        except (OSError, ValueError):
+            return None
+
+        try:
+            # Most recently used
+            os.utime(fn)
+        except OSError:
+            # Written by another user, a hit all the same
+            pass
+
+        return value
+
+    def set(self, key, value, ttl=0, group=None):
+        expires = int(time.time() + ttl) if ttl else 0
+        header = b"%d %s\n" % (expires, self.generation(group))
+
+        if self.write(self.filename(key), header + value):
+            self.maybe_evict()
+
+    def delete(self, key):
+        try:
+            os.unlink(self.filename(key))
+        except OSError:
+            pass
+
+    def invalidate(self, group):
+        self.write(self.filename(group, ".g"), b"%d" % time.time_ns())
+
+    def write(self, fn, data):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".")
+            try:
+                os.fchmod(fd, self.mode)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.rename(tmp, fn)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as error:
+            self.log(3, "Cache %s: %s" % (self.path, error))
+            return False
+
+        return True
+
+    def maybe_evict(self):
+        if due(os.path.join(self.path, ".evicted"), self.evict_interval):
+            self.evict()
+
+    def evict(self):
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        # Groups, temporary files and the marker
+                        continue
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass
+        except OSError:
+            return
+
+        if len(entries) <= self.max_entries:
+            return
+
+        # Make some room, so we don't evict again on the next set()
+        entries.sort()
+        keep = self.max_entries * 9 // 10
+        for _, fn in entries[: len(entries) - keep]:
+            try:
+                os.unlink(fn)
+            except OSError:
+                pass
+
+        self.log(3, "Cache %s: evicted %d entries" % (self.path, len(entries) - keep))
@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import asyncio
+import itertools
+import os
+import socket
+
+# Replies ending a request, by channel
+FINAL = {
+    "auth": ("OK", "FAIL"),
+    "master": ("USER", "NOTFOUND", "FAIL", "PASS"),
+}
+
+
+class Upstream:
+    """One persistent connection to a Dovecot socket, shared by sessions.
+
+    Requests are "COMMAND\\tid\\t..." lines.  Every session numbers its
+    requests from 1, so ids are renumbered on the way up and restored on
+    the way down.  The handshake is done once; sessions get a replay of
+    the server's greeting and their own VERSION and CPID are dropped.
+
+    """
+
+    def __init__(self, channel, path, handshake, greeting_end, log):
+        self.channel = channel
+        self.path = path
+        self.handshake = handshake
+        self.greeting_end = greeting_end
+        self.log = log
+
+        self.writer = None
+        self.greeting = None
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.lock:
+            if self.writer is not None:
+                return
+
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            writer.write(self.handshake.encode())
+
+            greeting = []
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b"\n"):
+                    writer.close()
+                    raise ConnectionError("%s closed the connection" % self.path)
+                greeting.append(line)
+                if line.startswith(self.greeting_end):
+                    break
+
+            self.log(7, "Hub connected to %s" % self.path)
+            self.greeting = b"".join(greeting)
+            self.writer = writer
+            asyncio.get_running_loop().create_task(self.read_replies(reader, writer))
+
+    async def read_replies(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b"\n"):
+                    break
+                self.route(line)
+        except ConnectionError:
+            pass
+        finally:
+            self.log(1, "Hub lost its connection to %s" % self.path)
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+
+            # Nobody will answer these any more
+            pending, self.pending = self.pending, {}
+            for session, request_id in pending.values():
+                session.send(b"FAIL\t%s\n" % request_id)
+
+    def route(self, line):
+        parts = line.split(b"\t", 2)
+        if len(parts) < 2:
+            return
+
+        try:
+            key = int(parts[1])
+        except ValueError:
+            return
+
+        if parts[0].decode() in FINAL[self.channel]:
+            entry = self.pending.pop(key, None)
+        else:
+            entry = self.pending.get(key)
+
+        if entry is None:
+            # A session that went away
+            return
+
+        session, request_id = entry
+        parts[1] = request_id
+        session.send(b"\t".join(parts))
+
+    def forward(self, session, line):
+        parts = line.split(b"\t", 2)
+        if len(parts) < 2 or self.writer is None:
+            session.send(b"FAIL\t%s\n" % (parts[1] if len(parts) > 1 else b"0"))
+            return
+
+        request_id = parts[1]
+        key = session.keys.get(request_id)
+        if key is None:
+            key = session.keys[request_id] = next(self.ids)
+        self.pending[key] = (session, request_id)
+
+        parts[1] = b"%d" % key
+        self.writer.write(b"\t".join(parts))
+
+    def forget(self, session):
+        for key in session.keys.values():
+            self.pending.pop(key, None)
+
+
+class Session:
+    def __init__(self, writer):
+        self.writer = writer
+        self.keys = {}
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class Hub:
+    """Helper process relaying sessions' requests to Dovecot.
+
+    Created by the Dovecot plugin in the long-lived parent.  start()
+    forks the hub, which keeps one connection per Dovecot socket.  A
+    session calls connect(channel) to get a socket that behaves like a
+    fresh connection to that Dovecot socket: it creates a socketpair and
+    hands one end to the hub over the control socket inherited from the
+    parent.  The hub exits once every process holding the control socket
+    is gone.
+
+    """
+
+    def __init__(self, mux, master, version, log):
+        self.log = log
+        self.paths = {"auth": mux, "master": master}
+        self.version = version
+
+        self.control = None
+        self.pid = None
+
+    def start(self):
+        self.control, hub_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        self.pid = os.fork()
+        if self.pid:
+            hub_end.close()
+            return self.pid
+
+        status = 1
+        try:
+            self.control.close()
+            asyncio.run(self.serve(hub_end))
+            status = 0
+        finally:
+            os._exit(status)
+
+    def connect(self, channel):
+        session, hub_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            socket.send_fds(self.control, [channel.encode()], [hub_end.fileno()])
+        finally:
+            hub_end.close()
+
+        return session
+
+    async def serve(self, control):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        version = "VERSION\t%d\t%d\n" % tuple(self.version)
+        upstreams = {}
+        if self.paths["auth"]:
+            upstreams["auth"] = Upstream(
+                "auth",
+                self.paths["auth"],
+                version + "CPID\t%d\n" % os.getpid(),
+                b"DONE",
+                self.log,
+            )
+        if self.paths["master"]:
+            upstreams["master"] = Upstream(
+                "master", self.paths["master"], version, b"VERSION", self.log
+            )
+        control.setblocking(False)
+
+        def accept():
+            try:
+                msg, fds, _, _ = socket.recv_fds(control, 64, 1)
+            except BlockingIOError:
+                return
+            except OSError:
+                msg, fds = b"", []
+
+            if not msg and not fds:
+                # All holders of the control socket are gone
+                if not done.done():
+                    done.set_result(None)
+                return
+
+            sock = socket.socket(fileno=fds[0])
+            upstream = upstreams.get(msg.decode())
+            if upstream is None:
+                sock.close()
+                return
+
+            loop.create_task(self.serve_session(upstream, sock))
+
+        loop.add_reader(control.fileno(), accept)
+        try:
+            await done
+        finally:
+            loop.remove_reader(control.fileno())
+            control.close()
+
+    async def serve_session(self, upstream, sock):
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        session = Session(writer)
+        try:
+            try:
+                await upstream.connect()
+            except OSError as error:
+                self.log(1, "Hub can't connect to %s: %s" % (upstream.path, error))
+                return
+
+            writer.write(upstream.greeting)
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b"\n"):
+                    break
+                if line.startswith((b"VERSION\t", b"CPID\t")):
+                    # The hub did the handshake already
+                    continue
+
+                await upstream.connect()
+                upstream.forward(session, line)
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            upstream.forget(session)
+            writer.close()
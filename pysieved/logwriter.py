@@ -0,0 +1,164 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import logging
+import os
+import socket
+
+# Longest record sent to the writer, longer ones are cut
+maxrecord = 32768
+
+
+class SenderHandler(logging.Handler):
+    """Send every formatted record to the log writer, one message each.
+
+    Sending never blocks: while the writer lags behind, records are
+    dropped and counted, and the count is logged with the next record
+    that goes through.
+
+    """
+
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        self.dropped = 0
+
+    def encode(self, record):
+        data = (self.format(record) + "\n").encode("utf-8", "backslashreplace")
+        if len(data) > maxrecord:
+            data = data[: maxrecord - 5] + b" ...\n"
+        return data
+
+    def dropped_record(self, name):
+        return logging.makeLogRecord(
+            {
+                "name": name,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "%d log records dropped",
+                "args": (self.dropped,),
+            }
+        )
+
+    def emit(self, record):
+        try:
+            if self.dropped:
+                note = self.dropped_record(record.name)
+                self.sock.send(self.encode(note), socket.MSG_DONTWAIT)
+                self.dropped = 0
+            self.sock.send(self.encode(record), socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.dropped:
+            # Last chance to tell, worth waiting for
+            try:
+                self.sock.send(self.encode(self.dropped_record("pysieved")))
+            except OSError:
+                pass
+        self.sock.close()
+        super().close()
+
+
+class LogWriter:
+    """Helper process writing the log records of all other processes.
+
+    Sessions send their records over a socket inherited from the
+    parent, which costs them one send(); the writer process alone
+    checks the log file for rotation and writes to it, once for every
+    batch of records waiting.  It exits once every process holding the
+    sending end is gone.
+
+    """
+
+    def __init__(self, handler):
+        # A WatchedFileHandler, its formatter is used by the senders
+        self.handler = handler
+        self.pid = None
+
+    def start(self, server=None):
+        """Fork the writer, return a handler sending records to it."""
+
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        self.pid = os.fork()
+        if self.pid:
+            receiver.close()
+            handler = SenderHandler(sender)
+            handler.setFormatter(self.handler.formatter)
+            return handler
+
+        status = 1
+        try:
+            sender.close()
+            if server is not None:
+                server.socket.close()
+            self.serve(receiver)
+            status = 0
+        finally:
+            os._exit(status)
+
+    def serve(self, sock):
+        while True:
+            batch = [sock.recv(maxrecord)]
+            if not batch[0]:
+                break
+
+            # Whatever else arrived meanwhile
+            while True:
+                try:
+                    data = sock.recv(maxrecord, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                if not data:
+                    break
+                batch.append(data)
+
+            self.write(b"".join(batch))
+
+    def write(self, data):
+        handler = self.handler
+        handler.acquire()
+        try:
+            if hasattr(handler, "reopenIfNeeded"):
+                handler.reopenIfNeeded()
+            # Records arrive encoded, skip the text layer
+            handler.stream.flush()
+            handler.stream.buffer.write(data)
+            handler.stream.buffer.flush()
+        finally:
+            handler.release()
+
+
+def spawn(handler, logger, server=None):
+    """Replace handler on logger with one sending to a new LogWriter."""
+
+    writer = LogWriter(handler)
+    sender = writer.start(server)
+
+    logger.addHandler(sender)
+    logger.removeHandler(handler)
+    handler.close()
+
+    return writer.pid
@@ -21,38 +21,52 @@
 # 05 December 2025 - Modified by A. Manalikadis.
 
 
+import importlib
 import optparse
 import os
+import signal
 import socket
 import socketserver as SocketServer
 import sys
+import threading
+import time
 import logging
-from logging.handlers import WatchedFileHandler
+from logging.handlers import SysLogHandler, WatchedFileHandler
 import getpass
 
 
+# The caches and validation are imported where used: an inetd session
+# starts from scratch and may never need them
+from pysieved import metrics, tls
 from pysieved.config import Config
 from pysieved.managesieve import RequestHandler
 
-try:
-    from tlslite.api import *
-
-    have_tls = True
-except Exception:
-    have_tls = False
-
 
 class Server(SocketServer.ForkingTCPServer):
     allow_reuse_address = True
     address_family = socket.AF_INET6
 
+    def service_actions(self):
+        super().service_actions()
+        metrics.set_gauge("pysieved_children", len(self.active_children or ()))
+
+
+# Auth plugins' SASL results, as metrics outcomes
+sasl_outcomes = {"OK": "ok", "NO": "fail", "BYE": "fail", "CONT": "cont"}
+
+
+# Server modes serving several sessions from one process
+threaded_modes = ("thread", "asyncio")
 
 # Define defaults before they get overwritten
 VERBOSITY = 10
 DEBUG = False
 LOGGER = logging.getLogger("pysieved")
+LOG_WRITER = None
+
+def log(l: int, s: str, *args) -> None:
+    """Log s % args, formatted only if level l is enabled"""
 
-def log(l: int, s: str) -> None:
     if l <= VERBOSITY:
         if l > 0:
             lvl = logging.INFO
@@ -61,23 +75,41 @@ def log(l: int, s: str) -> None:
         else:
             lvl = logging.ERROR
 
+        # Formatted here: a LogRecord with args costs more to build
+        if args:
+            s = s % args
         LOGGER.log(lvl, s)
 
 
+def lean_records() -> None:
+    """Have records carry only what our formats use.
+
+    No caller frame (see "Optimization" in the logging HOWTO), thread
+    or process name: finding them is a good part of a record's cost.
+    """
+
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+
+
 def setup_logging(options: optparse.Values, config: Config) -> None:
-    global VERBOSITY, DEBUG, LOGGER
+    global VERBOSITY, DEBUG, LOGGER, LOG_WRITER
 
     VERBOSITY = options.verbosity
     DEBUG = options.debug
 
     # Default logfile, overrideable by config
     logfile = config.get("main", "logfile", "/var/log/pysieved/pysieved.log")
+    log_to = config.get("main", "log_to", "file").lower()
 
     # Base logger config
     LOGGER.setLevel(logging.DEBUG)
+    lean_records()
 
     # Remove any existing handlers (if intiliazed more than once in tests)
     LOGGER.handlers.clear()
+    LOG_WRITER = None
 
     username = getpass.getuser()
 
@@ -86,18 +118,34 @@ def setup_logging(options: optparse.Values, config: Config) -> None:
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
+    handler = None
     if DEBUG:
         # In debug mode, log to stderr
         handler = logging.StreamHandler(sys.stderr)
-    else:
+    elif log_to == "syslog":
+        # One datagram per record, to syslog or journald
+        try:
+            handler = SysLogHandler(
+                address=config.get("main", "syslog_socket", "/dev/log"),
+                facility=SysLogHandler.LOG_DAEMON,
+            )
+            formatter = logging.Formatter(
+                fmt="pysieved[%(process)d]: %(levelname)s: %(message)s"
+            )
+        except OSError as error:
+            sys.stderr.write("Cannot log to syslog, using %s: %s\n" % (logfile, error))
+
+    if handler is None:
         # In normal mode, log to a logfile that notices rotation by logrotate
         handler = WatchedFileHandler(logfile)
+        if log_to == "writer" and not options.stdin:
+            # Handed to a log writer process once the daemon runs
+            LOG_WRITER = handler
 
     handler.setFormatter(formatter)
     LOGGER.addHandler(handler)
 
 
-
 def cli():
     global VERBOSITY, DEBUG
 
@@ -201,6 +249,56 @@ def cli():
     return options, args
 
 
+class LazyPlugin:
+    """Stands for a plugin, which is imported and set up on first use"""
+
+    def __init__(self, load):
+        self._load = load
+        self._plugin = None
+
+    def __getattr__(self, name):
+        if self._plugin is None:
+            self._plugin = self._load()
+        return getattr(self._plugin, name)
+
+
+def load_plugins(config, lazy=False):
+    """Return the auth, userdb and storage plugins.
+
+    With `lazy`, a userdb that isn't also the auth or storage plugin is
+    only loaded when a user logs in: the greeting doesn't need it.
+    """
+
+    names = [
+        config.get("main", "auth", "SASL").lower(),
+        config.get("main", "userdb", "passwd").lower(),
+        config.get("main", "storage", "Dovecot").lower(),
+    ]
+
+    def load(name):
+        module = importlib.import_module("pysieved.plugins.%s" % name)
+        return module.PysievedPlugin(log, config)
+
+    # If the same plugin is used in two places, recycle it
+    authenticate = load(names[0])
+
+    if names[1] == names[0]:
+        homedir = authenticate
+    elif lazy and names[1] != names[2]:
+        homedir = LazyPlugin(lambda: load(names[1]))
+    else:
+        homedir = load(names[1])
+
+    if names[2] == names[0]:
+        store = authenticate
+    elif names[2] == names[1]:
+        store = homedir
+    else:
+        store = load(names[2])
+
+    return authenticate, homedir, store
+
+
 def get_handler(options, config):
     base = options.base or config.get("main", "base", "")
     tls_required = options.tls_required or config.getboolean("TLS", "required", False)
@@ -208,13 +306,17 @@ def get_handler(options, config):
     tls_cert = options.tls_cert or config.get("TLS", "cert", "")
     tls_passphrase = config.get("TLS", "passphrase", "")
 
-    # Load TLS key and cert
-    tls_privateKey = None
-    tls_certChain = None
+    tls_backend = config.get("TLS", "backend", "ssl").lower()
+
+    # TLS key and cert are parsed on first use, see preload()
+    tls_credentials = None
     if tls_key or tls_cert:
         # Expect to use TLS
-        if not have_tls:
-            log(1, "TLSLite is not available. STARTTLS will not be offered")
+        if tls_backend not in tls.backends:
+            log(1, "Unknown TLS backend %r. STARTTLS will not be offered", tls_backend)
+            tls_required = False
+        elif not tls.available(tls_backend):
+            log(1, "%s is not available. STARTTLS will not be offered", tls_backend)
             tls_required = False
         elif not tls_key:
             log(1, "Cannot enable TLS without a key. STARTTLS will not be offered")
@@ -226,131 +328,240 @@ def get_handler(options, config):
             )
             tls_required = False
         else:
-            try:
-                tls_read_cert = open(tls_cert).read()
-                tls_x509 = X509()
-                tls_x509.parse(tls_read_cert)
-                tls_certChain = X509CertChain([tls_x509])
-                tls_read_key = open(tls_key).read()
-
-                def passphrase():
-                    return tls_passphrase
-
-                tls_privateKey = parsePEMKey(
-                    tls_read_key, private=True, passwordCallback=passphrase
-                )
-            except Exception:
-                log(
-                    1,
-                    "Failed to load TLS key or certificate. STARTTLS will not be offered.",
-                )
-                tls_certChain = None
-                tls_privateKey = None
-                tls_required = False
-
-    ##
-    ## Import plugins
-    ##
-    auth = __import__(
-        "pysieved.plugins.%s" % config.get("main", "auth", "SASL").lower(),
-        None,
-        None,
-        True,
-    )
-    userdb = __import__(
-        "pysieved.plugins.%s" % config.get("main", "userdb", "passwd").lower(),
-        None,
-        None,
-        True,
-    )
-    storage = __import__(
-        "pysieved.plugins.%s" % config.get("main", "storage", "Dovecot").lower(),
-        None,
-        None,
-        True,
-    )
+            key_cache = None
+            if tls_backend == "tlslite":
+                key_cache = config.get("TLS", "key_cache", "")
+            if key_cache:
+                from pysieved.cache import FileCache
+
+                # Holds the decrypted key
+                key_cache = FileCache(key_cache, 16, log, mode=0o600)
+            tls_credentials = tls.get_credentials(
+                tls_backend, tls_key, tls_cert, tls_passphrase, key_cache or None, log
+            )
 
-    # If the same plugin is used in two places, recycle it
-    authenticate = auth.PysievedPlugin(log, config)
+    mode = config.get("main", "mode", "fork").lower()
 
-    if userdb == auth:
-        homedir = authenticate
-    else:
-        homedir = userdb.PysievedPlugin(log, config)
+    # Read the secret before the plugins drop privileges
+    auth_cache = user_cache = None
+    if config.get("main", "auth_cache", ""):
+        from pysieved.authcache import get_auth_cache
 
-    if storage == auth:
-        store = authenticate
-    elif storage == userdb:
-        store = homedir
-    else:
-        store = storage.PysievedPlugin(log, config)
+        auth_cache = get_auth_cache(config, log)
+    if config.get("main", "userdb_cache", ""):
+        from pysieved.usercache import get_user_cache
+
+        user_cache = get_user_cache(config, log)
+
+    # inetd starts over for every connection: only load what it uses
+    shared = load_plugins(config, lazy=getattr(options, "stdin", False))
+
+    if mode in threaded_modes and shared[1].setuid_per_user():
+        raise ValueError(
+            "Server mode %r needs a userdb that does not switch users" % mode
+        )
+
+    if mode == "asyncio" and tls_credentials and tls_credentials.backend != "ssl":
+        log(1, "STARTTLS is only available in asyncio mode with the ssl backend")
+
+    local = threading.local()
+
+    def get_plugins():
+        # Sessions served by threads share one process, so every thread
+        # gets its own plugin instances (they keep sockets and request ids)
+        if mode not in threaded_modes:
+            return shared
+
+        try:
+            return local.plugins
+        except AttributeError:
+            local.plugins = load_plugins(config)
+            return local.plugins
 
     class handler(RequestHandler):
-        capabilities = store.capabilities
+        capabilities = shared[2].capabilities
 
-        def __init__(self, *args):
+        def setup(self):
             self.params = {}
 
-            super().__init__(*args)
+            super().setup()
 
-        def log(self, l, s):
-            log(l, s)
+        def log(self, l, s, *args):
+            log(l, s, *args)
 
         def list_mech(self):
+            authenticate, _, _ = get_plugins()
             mechs = authenticate.mechanisms()
-            self.log(5, "Announcing mechanisms : %r" % mechs)
+            self.log(5, "Announcing mechanisms : %r", mechs)
             return mechs
 
         def do_sasl_first(self, mechanism, *args):
-            self.log(
-                5,
-                "Starting SASL authentication (%s) : %s" % (mechanism, " ".join(args)),
-            )
-            ret = authenticate.do_sasl_first(mechanism, *args)
+            msg = "Starting SASL authentication (%s) :" + " %s" * len(args)
+            self.log(5, msg, mechanism, *args)
+            if auth_cache:
+                username = auth_cache.lookup(mechanism, args)
+                if username is not None:
+                    self.log(5, "Cached SASL authentication : %s", username)
+                    metrics.observe("pysieved_auth_duration_seconds", 0, "cached")
+                    return {"result": "OK", "username": username}
+
+            authenticate, _, _ = get_plugins()
+            ret = self.timed_auth(authenticate.do_sasl_first, mechanism, *args)
             if ret["result"] == "CONT":
-                self.log(5, "Need more SASL authentication : %r" % ret)
+                self.log(5, "Need more SASL authentication : %r", ret)
             else:
-                self.log(5, "Finished SASL authentication : %r" % ret)
+                self.log(5, "Finished SASL authentication : %r", ret)
+
+            if auth_cache and ret["result"] == "OK" and ret.get("username"):
+                auth_cache.succeeded(mechanism, args, ret["username"])
+            elif auth_cache and ret["result"] == "NO":
+                auth_cache.failed(mechanism, args)
+
             return ret
 
         def do_sasl_next(self, b64_string):
-            self.log(5, "Continuing SASL authentication : %s" % b64_string)
-            ret = authenticate.do_sasl_next(b64_string)
+            self.log(5, "Continuing SASL authentication : %s", b64_string)
+            authenticate, _, _ = get_plugins()
+            ret = self.timed_auth(authenticate.do_sasl_next, b64_string)
             if ret["result"] == "CONT":
-                self.log(5, "Need more SASL authentication : %r" % ret)
+                self.log(5, "Need more SASL authentication : %r", ret)
             else:
-                self.log(5, "Finished SASL authentication : %r" % ret)
+                self.log(5, "Finished SASL authentication : %r", ret)
             return ret
 
+        def timed_auth(self, func, *args):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                ret = func(*args)
+                outcome = sasl_outcomes.get(ret["result"], "error")
+                return ret
+            finally:
+                metrics.since("pysieved_auth_duration_seconds", start, outcome)
+
         def authenticate(self, username, passwd):
-            self.log(5, "Authenticating %s" % username)
+            self.log(5, "Authenticating %s", username)
             self.params["username"] = username
             self.params["password"] = passwd
+            authenticate, _, _ = get_plugins()
             return authenticate.auth(self.params)
 
         def get_homedir(self, username):
             self.params["username"] = username
-            ret = homedir.lookup(self.params)
-            self.log(5, "Plugin returned home : %r" % ret)
+            _, homedir, _ = get_plugins()
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                if user_cache:
+                    ret = user_cache.lookup(homedir, self.params)
+                else:
+                    ret = homedir.lookup(self.params)
+                outcome = "found" if ret else "notfound"
+            except LookupError as error:
+                self.log(1, "Cannot look up %s : %s", username, error)
+                return None
+            finally:
+                metrics.since("pysieved_userdb_duration_seconds", start, outcome)
+            self.log(5, "Plugin returned home : %r", ret)
             if ret and not os.path.isabs(ret) and base:
                 ret = os.path.join(base, ret)
-                self.log(5, "Added base to home : %r" % ret)
+                self.log(5, "Added base to home : %r", ret)
             return ret
 
+        @classmethod
+        def setuid_per_user(cls):
+            return shared[1].setuid_per_user()
+
         def new_storage(self, homedir):
             self.params["homedir"] = homedir
+            _, _, store = get_plugins()
             return store.create_storage(self.params)
 
         def get_tls_params(self):
             return {
-                "required": tls_required,
-                "key": tls_privateKey,
-                "cert": tls_certChain,
+                "required": self.tls_required,
+                "credentials": self.tls_credentials,
             }
 
+    def refresh_banners():
+        # Sessions inherit the banners, so a client that only reads the
+        # greeting never reaches the auth backend
+        authenticate, _, _ = shared
+        try:
+            mechs = list(authenticate.mechanisms())
+        except Exception as error:
+            log(1, "Cannot list SASL mechanisms (%s), asking every session", error)
+            handler.banners = None
+            return
+
+        log(5, "Announcing mechanisms : %r", mechs)
+        handler.build_banners(mechs, handler.tls_required)
+
+    def preload():
+        # Daemons parse the TLS key once, before forking sessions
+        if handler.tls_credentials is None:
+            return
+        try:
+            handler.tls_credentials.load()
+        except Exception:
+            log(
+                1,
+                "Failed to load TLS key or certificate. STARTTLS will not be offered.",
+            )
+            handler.tls_credentials = None
+            handler.tls_required = False
+            refresh_banners()
+
+    # Before any fork, so that all processes share the counters.  An
+    # inetd session would have nobody to share them with.
+    if not getattr(options, "stdin", False):
+        from pysieved import validation
+
+        metrics.setup(config, handler, validation.validators)
+
+    handler.tls_required = tls_required
+    handler.tls_credentials = tls_credentials
+    handler.refresh_banners = staticmethod(refresh_banners)
+    handler.preload = staticmethod(preload)
+    refresh_banners()
+
     return handler
 
 
+def get_server(config, server_address, handler):
+    mode = config.get("main", "mode", "fork").lower()
+
+    if mode == "fork":
+        return Server(server_address, handler)
+    elif mode == "prefork":
+        from pysieved.prefork import PreforkServer
+
+        return PreforkServer(
+            server_address,
+            handler,
+            workers=config.getint("main", "workers", 8),
+            max_sessions=config.getint("main", "max_sessions", 1000),
+        )
+    elif mode == "thread":
+        from pysieved.threaded import ThreadPoolServer
+
+        return ThreadPoolServer(
+            server_address,
+            handler,
+            threads=config.getint("main", "threads", 16),
+        )
+    elif mode == "asyncio":
+        from pysieved.aio import AsyncServer
+
+        return AsyncServer(
+            server_address,
+            handler,
+            threads=config.getint("main", "threads", 16),
+        )
+
+    raise ValueError("Unknown server mode %r" % mode)
+
+
 def main(options: optparse.Values, _: list):
     # Read config file
     config = Config(options.config)
@@ -368,13 +579,28 @@ def main(options: optparse.Values, _: list):
         sock = socket.fromfd(0, socket.AF_INET, socket.SOCK_STREAM)
         h = handler(sock, sock.getpeername(), None)
     else:
-        from pysieved import daemon
+        from pysieved import daemon, logwriter, metricsd, validatord
 
-        s = Server((addr, port), handler)
+        handler.preload()
+        s = get_server(config, (addr, port), handler)
 
         if not options.debug:
             daemon.daemon(pidfile=pidfile)
 
+        # After daemon(), so the helpers exit with us
+        if LOG_WRITER is not None:
+            logwriter.spawn(LOG_WRITER, LOGGER, s)
+        validatord.spawn(config, log, s)
+        metricsd.spawn(config, log, s)
+
+        def reload(signum, frame):
+            log(1, "Reloading SASL mechanisms")
+            handler.refresh_banners()
+            if hasattr(s, "recycle_workers"):
+                s.recycle_workers()
+
+        signal.signal(signal.SIGHUP, reload)
+
         log(1, f"Listening on {addr or 'INADDR_ANY'} port {port}")
         s.serve_forever()
 
@@ -22,22 +22,38 @@
 
 
 import errno
+import socket
 import socketserver as SocketServer
 import sys
 import time
-from typing import cast
 
-try:
-    from tlslite.api import *
-
-    have_tls = True
-except Exception:
-    have_tls = False
+from pysieved import metrics, tls
 
 version = "pysieved 1.0"
 maxsize = 100000
 
 
+def response(*args) -> str:
+    """Format args as a response line, with literals where needed."""
+
+    lines = []
+    out = []
+
+    for a in args:
+        if type(a) == type(()):
+            out.append(" ".join(a))
+        elif len(a) > 200 or '"' in a:
+            out.append("{%d}" % len(a))
+            lines.append(" ".join(out) + "\r\n")
+            lines.append(a)
+            out = []
+        else:
+            out.append('"%s"' % a)
+    lines.append(" ".join(out) + "\r\n")
+
+    return "".join(lines)
+
+
 def compact_traceback():
     """Return a compact (1-line) traceback.
 
@@ -74,48 +90,100 @@ class AuthenticateFirst(Exception):
     pass
 
 
+class LiteralTooLarge(Exception):
+    pass
+
+
+class Discard:
+    """File-like sink for literals we refuse to keep."""
+
+    def write(self, data):
+        pass
+
+
+discard = Discard()
+
+
 class RequestHandler(SocketServer.BaseRequestHandler):
-    def __init__(self, request, client_address, server):
+    # Size of the input buffer, and how long a line may grow it
+    rbufsize = 65536
+    maxline = 1 << 20
+
+    # Largest script accepted, unless the storage sets its own limit
+    maxsize = maxsize
+
+    # Which argument of a command is a script, kept as bytes
+    script_args = {"PUTSCRIPT": 2, "CHECKSCRIPT": 1}
+
+    # CAPABILITY responses from build_banners(), None to build them
+    # for every session
+    banners = None
+
+    def setup(self):
         self.user = None
         self.storage = None
         self.tls = None
         self.tls_params = self.get_tls_params()
 
-        super().__init__(request, client_address, server)
+        # For the metrics, published after every command
+        self.failed = False
+        self.received = 0
+        self.sent = 0
+        metrics.add("pysieved_connections")
 
-    def log(self, level: int, message: str):
+    def log(self, level: int, message: str, *args):
+        if args:
+            message = message % args
         print(time.time(), "=" * level, message)
 
+    def write(self, s: str | bytes):
+        """Queue `s` for the client.  It is sent by the next flush()."""
+
+        if isinstance(s, str):
+            s = s.encode()
+
+        self.out.append(s)
+
+    def flush(self):
+        """Send everything queued by write() at once."""
+
+        if self.out:
+            data = b"".join(self.out)
+            del self.out[:]
+            self.sendall(data)
+
+    def send_chunks(self, f, size: int):
+        """Send `size` bytes of file `f` after the queued output.
+
+        Used where os.sendfile can't be (TLS), see handle().
+
+        """
+
+        self.flush()
+        while size > 0:
+            chunk = f.read(min(size, self.rbufsize))
+            if not chunk:
+                raise OSError("File shrank while sending")
+            self.sendall(chunk)
+            size -= len(chunk)
+
     def send(self, *args):
-        out = []
-
-        def flush(out):
-            s = " ".join(out) + "\r\n"
-            self.log(3, "S: %r" % s)
-            self.write(s)
-            del out[:]
-
-        for a in args:
-            if type(a) == type(()):
-                out.append(" ".join(a))
-            elif len(a) > 200 or '"' in a:
-                out.append("{%d}" % len(a))
-                flush(out)
-                self.log(3, "S: %r" % a)
-                self.write(a)
-            else:
-                out.append('"%s"' % a)
-        flush(out)
+        s = response(*args)
+        self.log(3, "S: %r", s)
+        self.write(s)
 
     def _rsp(self, rsp, code, reason):
+        if rsp != "OK":
+            self.failed = True
         out = rsp
         if code:
             out += " (%s)" % code
         if reason:
             out += ' "%s"' % reason
         out += "\r\n"
-        self.log(3, "S: %r" % out)
+        self.log(3, "S: %r", out)
         self.write(out)
+        self.flush()
 
     def ok(self, code=None, reason=None):
         self._rsp("OK", code, reason)
@@ -126,56 +194,118 @@ class RequestHandler(SocketServer.BaseRequestHandler):
     def bye(self, code=None, reason=None):
         self._rsp("BYE", code, reason)
 
-    def bread(self, n) -> bytes:
-        buffer = self.buf
+    def reset_input(self):
+        self.rbuf = bytearray(self.rbufsize)
+        self.rstart = 0  # First byte not consumed yet
+        self.rend = 0  # End of the data received so far
+        self.rscan = 0  # Where to continue searching for CRLF
+
+    def fill(self):
+        """Receive more data from the client into the input buffer."""
+
+        # Whatever the client waits for has to go out first
+        self.flush()
+
+        if self.rstart == self.rend:
+            self.rstart = self.rend = self.rscan = 0
+        elif self.rend == len(self.rbuf):
+            pending = self.rend - self.rstart
+            if self.rstart:
+                # Move the unconsumed data to the front
+                self.rbuf[:pending] = self.rbuf[self.rstart : self.rend]
+            elif pending < self.maxline:
+                self.rbuf.extend(bytes(len(self.rbuf)))
+            else:
+                self.bye(reason="Line too long")
+                raise Hangup()
+            self.rscan -= self.rstart
+            self.rstart = 0
+            self.rend = pending
 
-        buffer = cast(bytes, buffer)
+        n = self.recv_into(memoryview(self.rbuf)[self.rend :])
+        if not n:
+            raise Hangup()
 
-        while len(buffer) < n:
-            r = self.request.recv(n - len(buffer))
+        self.rend += n
 
-            if not r:
-                raise Hangup()
+    def bread(self, n) -> bytes:
+        if n > max(self.maxline, self.script_maxsize()):
+            self.bye(reason="Literal too large")
+            raise Hangup()
+
+        have = self.rend - self.rstart
 
-            buffer += r
+        if have >= n:
+            s = bytes(memoryview(self.rbuf)[self.rstart : self.rstart + n])
+            self.rstart += n
+            self.rscan = max(self.rscan, self.rstart)
+        else:
+            # Grow the literal as it arrives, whatever size was announced
+            out = bytearray(memoryview(self.rbuf)[self.rstart : self.rend])
+            self.rstart = self.rend = self.rscan = 0
+
+            view = memoryview(self.rbuf)
+            while len(out) < n:
+                r = self.recv_into(view[: min(n - len(out), len(view))])
+                if not r:
+                    raise Hangup()
+                out += view[:r]
 
-        self.buf = buffer[n:]
-        s = buffer[:n]
+            view.release()
+            s = bytes(out)
 
-        self.log(3, "C: %r" % s)
+        self.log(3, "C: %r", s)
 
         return s
 
-    def readline(self) -> str:
-        out = self.buf
+    def bread_into(self, n, f):
+        """Copy the next `n` bytes from the client to file `f`."""
+
+        self.flush()
+
+        have = min(self.rend - self.rstart, n)
+        if have:
+            f.write(memoryview(self.rbuf)[self.rstart : self.rstart + have])
+            self.rstart += have
+            self.rscan = max(self.rscan, self.rstart)
+
+        left = n - have
+        if left:
+            # The input buffer is empty, use it for the copy
+            self.rstart = self.rend = self.rscan = 0
+            view = memoryview(self.rbuf)
+            while left:
+                r = self.recv_into(view[: min(left, len(view))])
+                if not r:
+                    raise Hangup()
+                f.write(view[:r])
+                left -= r
+            view.release()
 
-        out = cast(bytes, out)
+        self.log(3, "C: <%d bytes>", n)
+
+    def readline(self) -> str:
+        rbuf = self.rbuf
 
         while True:
-            pos = out.find(b"\r\n")
+            pos = rbuf.find(b"\r\n", self.rscan, self.rend)
             if pos > -1:
-                self.buf = out[pos + 2 :]
-                s = out[:pos]
-                self.log(3, "C: %r" % (s + b"\r\n"))
+                s = bytes(rbuf[self.rstart : pos])
+                self.rstart = self.rscan = pos + 2
+                self.log(3, "C: %r", s + b"\r\n")
 
                 return s.decode()
 
-            r = self.request.recv(1024)
-
-            if not r:
-                raise Hangup()
-
-            out += r
+            # Only search the new data next time, a CR may end this part
+            self.rscan = max(self.rstart, self.rend - 1)
+            self.fill()
+            rbuf = self.rbuf
 
     def handle(self):
-        def _write(content: str | bytes):
+        def _sendall(data: bytes):
             try:
-                message = content
-
-                if isinstance(content, str):
-                    message = content.encode()
-
-                return self.request.send(message)
+                self.request.sendall(data)
+                self.sent += len(data)
 
             except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
                 # Client closed early (common on LOGOUT / timeouts / reconnects)
@@ -185,18 +315,25 @@ class RequestHandler(SocketServer.BaseRequestHandler):
                     raise Hangup()
                 raise
 
-        def _read(n: int) -> str:
-            """Read `n` bytes from socket and convert to string."""
+        def _sendfile(f, size: int):
+            self.flush()
             try:
-                received = self.request.recv(n)
-
-                if not received:
+                sent = self.request.sendfile(f, 0, size)
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                raise Hangup()
+            except OSError as e:
+                if e.errno in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED, errno.ETIMEDOUT):
                     raise Hangup()
+                raise
 
-                if isinstance(received, bytes):
-                    received = received.decode()
+            self.sent += sent
+            if sent != size:
+                raise OSError("File shrank while sending")
 
-                return received
+        def _recv_into(buffer) -> int:
+            """Receive into `buffer`, return the number of bytes read."""
+            try:
+                n = self.request.recv_into(buffer)
             except (ConnectionResetError, ConnectionAbortedError):
                 raise Hangup()
             except OSError as e:
@@ -204,12 +341,23 @@ class RequestHandler(SocketServer.BaseRequestHandler):
                     raise Hangup()
                 raise
 
+            self.received += n
+            return n
 
-        self.buf = b""
-        self.write = _write
-        self.read = _read
+        try:
+            # Responses are written in one go, don't wait for ACKs
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            # Not TCP (inetd may hand us anything)
+            pass
 
-        self.log(1, "Connect from %r" % (self.client_address,))
+        self.reset_input()
+        self.out = []
+        self.sendall = _sendall
+        self.sendfile = _sendfile
+        self.recv_into = _recv_into
+
+        self.log(1, "Connect from %r", self.client_address)
 
         try:
             self.do_capability()
@@ -219,29 +367,17 @@ class RequestHandler(SocketServer.BaseRequestHandler):
                 except AssertionError as error:
                     self.no(reason=error)
                     continue
-
-                try:
-                    func = getattr(self, "do_%s" % (cmd[0].lower()))
-                except AttributeError:
-                    self.no(reason="Unknown command")
+                except LiteralTooLarge:
+                    self.no(code="QUOTA/MAXSIZE", reason="Literal too large")
                     continue
 
-                try:
-                    func(*cmd[1:])
-                except AuthenticateFirst:
-                    self.no(reason="Authenticate first")
-                except TypeError as exc:
-                    if exc.args[0].startswith("do_") and "arguments" in exc.args[0]:
-                        self.no(reason="Wrong number of arguments")
-                        continue
-                    else:
-                        raise
+                self.run_command(cmd)
 
         except Hangup:
             pass
         except Exception:
             _, t, v, tbinfo = compact_traceback()
-            self.log(-1, "[ERROR] %s:%s %s" % (t, v, tbinfo))
+            self.log(-1, "[ERROR] %s:%s %s", t, v, tbinfo)
             try:
                 self.bye(reason="Server error")
             except Exception:
@@ -250,48 +386,147 @@ class RequestHandler(SocketServer.BaseRequestHandler):
 
     def finish(self):
         self.log(1, "Disconnect")
+        self.publish_metrics()
+        metrics.add("pysieved_connections", -1)
+        if self.tls is not None and self.tls is self.request:
+            # The server only closes the socket it handed us
+            self.request.close()
+
+    def run_command(self, cmd):
+        start = time.perf_counter()
+        self.failed = False
+        try:
+            self.dispatch(cmd)
+        except Hangup:
+            raise
+        except BaseException:
+            self.failed = True
+            raise
+        finally:
+            metrics.since("pysieved_command_duration_seconds", start, cmd[0].upper())
+            self.publish_metrics(cmd[0].upper())
+
+    def dispatch(self, cmd):
+        try:
+            func = getattr(self, "do_%s" % (cmd[0].lower()))
+        except AttributeError:
+            self.no(reason="Unknown command")
+            return
+
+        try:
+            func(*cmd[1:])
+        except AuthenticateFirst:
+            self.no(reason="Authenticate first")
+        except TypeError as exc:
+            if exc.args[0].startswith("do_") and "arguments" in exc.args[0]:
+                self.no(reason="Wrong number of arguments")
+            else:
+                raise
+
+    def publish_metrics(self, command=None):
+        if self.failed and command is not None:
+            metrics.add("pysieved_command_errors_total", label=command)
+        if self.received:
+            metrics.add("pysieved_received_bytes_total", self.received)
+            self.received = 0
+        if self.sent:
+            metrics.add("pysieved_sent_bytes_total", self.sent)
+            self.sent = 0
 
     def get_command(self):
         oparts = [""]
 
         while True:
-            s = self.readline()
-            parts = s.split(" ")
-            closed = True
-            if not parts[0]:
+            n = self.parse_line(self.readline(), oparts)
+            if n is None:
                 break
-
-            for p in parts:
-                if p[0] == '"':
-                    closed = False
-                    p = p[1:]
-                if p[-1] == '"' and (len(p) == 1 or p[-2] != "\\"):
-                    closed = True
-                    p = p[:-1]
-                elif not closed:
-                    p += " "
-                p = p.replace('\\"', '"')
-                oparts[-1] += p
-                if closed:
-                    oparts.append("")
-            assert not oparts[-1], ("Misquoted argument", oparts)
-            del oparts[-1]
-
-            # Pull out {31+}-style parameters
-            o = oparts[-1]
-            if len(o) > 3 and o[0] == "{" and o[-2:] == "+}":
-                try:
-                    n = int(o[1:-2])
-                except ValueError:
-                    continue
-
-                oparts[-1] = self.bread(n).decode()
+            elif n < 0:
+                continue
+
+            sink = self.literal_sink(oparts, n)
+            if sink is not None:
+                self.bread_into(n, sink)
+                oparts[-1] = sink
+            elif self.is_script(oparts):
+                oparts[-1] = self.bread(n)
             else:
-                break
+                oparts[-1] = self.bread(n).decode()
+
+        if any(p is discard for p in oparts):
+            raise LiteralTooLarge()
 
         assert oparts != [""], "No command given"
         return oparts
 
+    def is_script(self, oparts):
+        "Is the last argument in oparts a script?"
+
+        return self.script_args.get(oparts[0].upper()) == len(oparts) - 1
+
+    def literal_sink(self, oparts, n):
+        """Where to copy the {n+} literal ending oparts.
+
+        Literals over the size limit are discarded before they are
+        read.  Scripts go straight to a file when the storage supports
+        uploads.  None means the literal is read into memory.
+
+        """
+
+        if n > self.script_maxsize():
+            return discard
+
+        # Checked scripts stay out of the user's storage
+        if self.storage and self.is_script(oparts) and oparts[0].upper() == "PUTSCRIPT":
+            return self.storage.begin_upload()
+
+        return None
+
+    def script_maxsize(self):
+        if self.storage and self.storage.maxsize:
+            return self.storage.maxsize
+
+        return self.maxsize
+
+    def parse_line(self, s, oparts):
+        """Add the arguments found on line `s` to `oparts`.
+
+        Returns None once the command is complete, or the size of the
+        {31+}-style literal that ends the line (-1 if that size can't be
+        parsed).  Either way the caller has to read another line.
+
+        """
+
+        parts = s.split(" ")
+        closed = True
+        if not parts[0]:
+            return None
+
+        for p in parts:
+            if p[0] == '"':
+                closed = False
+                p = p[1:]
+            if p[-1] == '"' and (len(p) == 1 or p[-2] != "\\"):
+                closed = True
+                p = p[:-1]
+            elif not closed:
+                p += " "
+            p = p.replace('\\"', '"')
+            oparts[-1] += p
+            if closed:
+                oparts.append("")
+        assert not oparts[-1], ("Misquoted argument", oparts)
+        del oparts[-1]
+
+        # Pull out {31+}-style parameters
+        o = oparts[-1]
+        if len(o) > 3 and o[0] == "{" and o[-2:] == "+}":
+            try:
+                return int(o[1:-2])
+            except ValueError:
+                return -1
+
+        return None
+
     def check_auth(self):
         "Fail if not authenticated"
         if not self.storage:
@@ -311,10 +546,10 @@ class RequestHandler(SocketServer.BaseRequestHandler):
         while ret["result"] == "CONT":
             # Server requests more data
             line = "{%d}\r\n" % len(ret["msg"])
-            self.log(3, "S: %r" % line)
+            self.log(3, "S: %r", line)
             self.write(line)
             line = "%s\r\n" % ret["msg"]
-            self.log(3, "S: %r" % line)
+            self.log(3, "S: %r", line)
             self.write(line)
 
             # Read client string
@@ -327,6 +562,11 @@ class RequestHandler(SocketServer.BaseRequestHandler):
                     # Can't parse length
                     return self.no(reason="Malformed string literal")
                 else:
+                    if n < 0:
+                        return self.no(reason="Malformed string literal")
+                    if n > self.maxline:
+                        self.bye(reason="Literal too large")
+                        raise Hangup()
                     s = self.bread(n)
                     # Data should be followed by CRLF
                     misc = self.readline()
@@ -361,7 +601,7 @@ class RequestHandler(SocketServer.BaseRequestHandler):
 
         self.storage = self.new_storage(home)
 
-        self.log(1, "Authenticated user %s" % ret["username"])
+        self.log(1, "Authenticated user %s", ret["username"])
 
         return self.ok()
 
@@ -369,27 +609,59 @@ class RequestHandler(SocketServer.BaseRequestHandler):
         "2.2.  STARTTLS Command"
 
         assert not self.storage, "Already authenticated"
-        assert have_tls, "No TLS support"
-        assert self.tls_params["key"], "Undefined TLS private key"
-        assert self.tls_params["cert"], "Undefined TLS certificate"
+        assert self.tls_params["credentials"], "No TLS support"
+
+        # Parsed now, unless a daemon did it before forking
+        credentials = self.tls_params["credentials"]
+        try:
+            material = credentials.load()
+        except Exception as error:
+            self.log(1, "Failed to load TLS key or certificate: %s", error)
+            return self.no(reason="TLS not available")
 
         self.ok(reason="Begin TLS negotiation now")
+        self.reset_input()
 
         try:
-            self.buf = ""
-            self.tls = TLSConnection(self.request)
-            self.tls.handshakeServer(
-                certChain=self.tls_params["cert"],
-                privateKey=self.tls_params["key"],
-                reqCert=False,
-            )
-            self.write = lambda s: self.tls.write(s)
-            self.read = lambda n: self.tls.read(n)
-            return self.do_capability()
-        except Exception:
-            import traceback
+            if credentials.backend == "ssl":
+                self.start_ssl(material)
+            else:
+                self.start_tlslite(*material)
+        except Exception as error:
+            self.log(1, "TLS negotiation failed: %s", error)
+            raise Hangup()
 
-            traceback.print_exc()
+        return self.do_capability()
+
+    def start_ssl(self, context):
+        # handle() sends and receives through self.request, which now
+        # encrypts.  Sessions resume with tickets from the shared context.
+        self.request = context.wrap_socket(self.request, server_side=True)
+        self.tls = self.request
+        self.log(2, "TLS session %s", "resumed" if self.tls.session_reused else "new")
+
+    def start_tlslite(self, cert_chain, private_key):
+        TLSConnection = tls.api().TLSConnection
+
+        def _tls_recv_into(buffer) -> int:
+            s = self.tls.read(len(buffer))
+            buffer[: len(s)] = s
+            self.received += len(s)
+            return len(s)
+
+        def _tls_sendall(data):
+            self.tls.write(data)
+            self.sent += len(data)
+
+        self.tls = TLSConnection(self.request)
+        self.tls.handshakeServer(
+            certChain=cert_chain,
+            privateKey=private_key,
+            reqCert=False,
+        )
+        self.sendall = _tls_sendall
+        self.sendfile = self.send_chunks
+        self.recv_into = _tls_recv_into
 
     def do_logout(self):
         "2.3.  LOGOUT Command"
@@ -400,19 +672,69 @@ class RequestHandler(SocketServer.BaseRequestHandler):
     def do_capability(self):
         "2.4.  CAPABILITY Command"
 
-        self.send("IMPLEMENTATION", version)
+        banner = self.capability_banner()
+        self.log(3, "S: %r", banner)
+        self.write(banner)
+        self.flush()
 
+    def capability_banner(self) -> bytes:
+        """The CAPABILITY response for this session, ending with OK."""
+
+        starttls = bool(self.tls_params["credentials"] and not self.tls)
+
+        if self.banners is not None:
+            banner = self.banners.get((bool(self.tls), starttls))
+            if banner is not None:
+                return banner
+
+        mechs = None
         if self.tls or not self.tls_params["required"]:
-            self.send("SASL", " ".join(self.list_mech()))
+            mechs = self.list_mech()
+
+        return self.build_banner(mechs, starttls)
+
+    @classmethod
+    def build_banner(cls, mechs, starttls) -> bytes:
+        """Build a CAPABILITY response.
+
+        `mechs` are the SASL mechanisms to announce, None when they're
+        only announced after STARTTLS.
+
+        """
+
+        lines = [response("IMPLEMENTATION", version)]
+
+        if mechs is None:
+            lines.append(response("SASL"))
         else:
-            self.send("SASL")
+            lines.append(response("SASL", " ".join(mechs)))
 
-        self.send("SIEVE", self.capabilities)
+        lines.append(response("SIEVE", cls.capabilities))
 
-        if self.tls_params["key"] and self.tls_params["cert"] and not self.tls:
-            self.send("STARTTLS")
+        if starttls:
+            lines.append(response("STARTTLS"))
 
-        self.ok()
+        # RFC 5804 commands: RENAMESCRIPT, CHECKSCRIPT and NOOP
+        lines.append(response("VERSION", "1.0"))
+
+        lines.append("OK\r\n")
+
+        return "".join(lines).encode()
+
+    @classmethod
+    def build_banners(cls, mechs, tls_required):
+        """Precompute the CAPABILITY responses for each session state.
+
+        Keyed by (TLS active, STARTTLS offered), so that sending the
+        greeting doesn't need the auth plugin.
+
+        """
+
+        cls.banners = {
+            (False, False): cls.build_banner(None if tls_required else mechs, False),
+            (False, True): cls.build_banner(None if tls_required else mechs, True),
+            (True, False): cls.build_banner(mechs, False),
+        }
 
     def do_havespace(self, name, size):
         "2.5.  HAVESPACE Command"
@@ -424,18 +746,27 @@ class RequestHandler(SocketServer.BaseRequestHandler):
         except ValueError:
             return self.no(reason="Not a number")
 
-        if required_space < maxsize:
+        if required_space <= self.script_maxsize():
             return self.ok()
 
         return self.no(code="QUOTA", reason="Quota exceeded")
 
-    def do_putscript(self, name: str, content: str):
+    def do_putscript(self, name: str, content):
         "2.6.  PUTSCRIPT Command"
 
         self.check_auth()
 
+        if isinstance(content, str):
+            content = content.encode()
+
         try:
-            self.storage[name] = content.encode()
+            if not isinstance(content, bytes):
+                # Uploaded by get_command
+                self.storage.finish_upload(name, content)
+            elif len(content) > self.script_maxsize():
+                return self.no(code="QUOTA/MAXSIZE", reason="Script too large")
+            else:
+                self.storage[name] = content
         except ValueError as reason:
             return self.no(reason=reason)
 
@@ -445,8 +776,9 @@ class RequestHandler(SocketServer.BaseRequestHandler):
         "2.7.  LISTSCRIPTS Command"
 
         self.check_auth()
+        active = self.storage.active_name()
         for i in self.storage:
-            if self.storage.is_active(i):
+            if i == active:
                 self.send(i, ("ACTIVE",))
             else:
                 self.send(i)
@@ -474,17 +806,31 @@ class RequestHandler(SocketServer.BaseRequestHandler):
         self.check_auth()
 
         try:
-            content: bytes = self.storage[name]
+            script = self.storage.open_script(name)
+            if script is None:
+                content: bytes = self.storage[name]
         except KeyError:
             return self.no(reason="No script by that name")
 
-        line = "{%d}\r\n" % len(content)
-        self.log(3, "C: %r" % line)
-        self.write(line)
+        if script is None:
+            line = "{%d}\r\n" % len(content)
+            self.log(3, "S: %r", line)
+            self.write(line)
+
+            self.log(3, "S: %r", content)
+            self.write(content)
+        else:
+            # Stream the script without reading it in
+            fd, size = script
+            with open(fd, "rb") as f:
+                line = "{%d}\r\n" % size
+                self.log(3, "S: %r", line)
+                self.write(line)
+
+                self.log(3, "S: <%d bytes>", size)
+                self.sendfile(f, size)
 
-        line = content + b"\r\n"
-        self.log(3, "S: %r" % line)
-        self.write(line)
+        self.write(b"\r\n")
 
         return self.ok()
 
@@ -500,6 +846,53 @@ class RequestHandler(SocketServer.BaseRequestHandler):
             return self.no(reason="No script by that name")
         return self.ok()
 
+    def do_renamescript(self, old, new):
+        "2.11.  RENAMESCRIPT Command"
+
+        self.check_auth()
+        try:
+            self.storage.rename(old, new)
+        except KeyError:
+            return self.no(code="NONEXISTENT", reason="No script by that name")
+        except FileExistsError:
+            return self.no(code="ALREADYEXISTS", reason="A script by that name exists")
+        except ValueError as reason:
+            return self.no(reason=reason)
+        return self.ok()
+
+    def do_checkscript(self, content):
+        "2.12.  CHECKSCRIPT Command"
+
+        self.check_auth()
+
+        if isinstance(content, str):
+            content = content.encode()
+
+        if len(content) > self.script_maxsize():
+            return self.no(code="QUOTA/MAXSIZE", reason="Script too large")
+
+        try:
+            self.storage.check(content)
+        except NotImplementedError:
+            return self.no(reason="Checking scripts is not supported")
+        except ValueError as reason:
+            return self.no(reason=reason)
+
+        return self.ok()
+
+    def do_noop(self, tag=None):
+        "2.13.  NOOP Command"
+
+        if tag is None:
+            return self.ok(reason="Done")
+
+        # Echo the tag back, as a literal if it can't be quoted
+        if any(c in tag for c in '"\\\r\n'):
+            code = "TAG {%d}\r\n%s" % (len(tag.encode()), tag)
+        else:
+            code = 'TAG "%s"' % tag
+        return self.ok(code=code, reason="Done")
+
     def list_mech(self):
         raise NotImplementedError()
 
@@ -515,8 +908,19 @@ class RequestHandler(SocketServer.BaseRequestHandler):
     def get_homedir(self, username):
         raise NotImplementedError()
 
+    @classmethod
+    def setuid_per_user(cls):
+        "Does get_homedir() switch to each user's uid/gid?"
+        return True
+
     def new_storage(self, homedir):
         raise NotImplementedError()
 
     def get_tls_params(self):
-        return {"required": False, "key": None, "cert": None}
+        """Return the TLS settings.
+
+        'credentials' is one of the classes in pysieved.tls, or None if
+        STARTTLS isn't offered.
+        """
+
+        return {"required": False, "credentials": None}
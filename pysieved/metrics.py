@@ -0,0 +1,320 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Upper bounds of the latency histograms' buckets, in seconds
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Label value standing for any value not declared
+OTHER = "other"
+
+# The registry every process updates, None while metrics are off
+registry = None
+
+
+class Family:
+    """A metric with one value (or histogram) per value of its label."""
+
+    def __init__(self, kind, name, help, label=None, values=()):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = list(values)
+        if label and OTHER not in self.values:
+            self.values.append(OTHER)
+        if not label:
+            self.values = [None]
+
+        # Slots per label value: the buckets, +Inf and the sum
+        self.width = len(buckets) + 2 if kind == "histogram" else 1
+        self.offset = None
+
+    def slot(self, value):
+        try:
+            i = self.values.index(value)
+        except ValueError:
+            i = self.values.index(OTHER) if self.label else 0
+        return self.offset + i * self.width
+
+    def labels(self, value, **extra):
+        pairs = []
+        if self.label:
+            pairs.append((self.label, value))
+        pairs.extend(extra.items())
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % pair for pair in pairs)
+
+
+class Registry:
+    """Metrics kept in shared memory, so forked processes add them up.
+
+    Every family is declared before start(), which maps a shared file
+    with a row of doubles for each of up to `rows` processes.  A process
+    claims a free row with lockf() on its first update and is the only
+    one writing to it, so there is no lock between processes that a
+    killed one could leave held: the kernel releases its row, counts
+    kept, for the next process to claim.  render() adds the rows up.
+    Past `rows` live processes, the others share the first row and may
+    lose updates.
+
+    """
+
+    rows = 1024
+
+    def __init__(self):
+        self.families = {}
+        self.width = 0
+        self.file = None
+        self.mem = None
+
+        # This process' row, and the lock its threads update it under
+        self.row = None
+        self.lock = threading.Lock()
+
+    def declare(self, kind, name, help, label=None, values=()):
+        self.families[name] = Family(kind, name, help, label, values)
+
+    def start(self):
+        # The first slot of a row tells whether it was ever claimed
+        slots = 1
+        for family in self.families.values():
+            family.offset = slots
+            slots += family.width * len(family.values)
+
+        # tempfile takes a while to import, only pay for it here
+        import tempfile
+
+        self.width = slots
+        self.file = tempfile.TemporaryFile()
+        self.file.truncate(8 * slots * self.rows)
+        self.mem = mmap.mmap(self.file.fileno(), 8 * slots * self.rows)
+
+    def forked(self):
+        # Locks aren't inherited, neither is the row
+        self.row = None
+        self.lock = threading.Lock()
+
+    def claim(self):
+        size = 8 * self.width
+        first = os.getpid() % self.rows
+        for i in range(self.rows):
+            row = (first + i) % self.rows
+            try:
+                fcntl.lockf(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB, size, row * size)
+            except OSError:
+                continue
+            break
+        else:
+            row = 0
+
+        struct.pack_into("d", self.mem, row * size, 1)
+        self.row = row * size
+
+    def add(self, name, value=1, label=None):
+        slot = self.families[name].slot(label)
+        with self.lock:
+            if self.row is None:
+                self.claim()
+            offset = self.row + 8 * slot
+            (old,) = struct.unpack_from("d", self.mem, offset)
+            struct.pack_into("d", self.mem, offset, old + value)
+
+    def set(self, name, value, label=None):
+        slot = self.families[name].slot(label)
+        with self.lock:
+            if self.row is None:
+                self.claim()
+            struct.pack_into("d", self.mem, self.row + 8 * slot, value)
+
+    def observe(self, name, value, label=None):
+        start = self.families[name].slot(label)
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+
+        with self.lock:
+            if self.row is None:
+                self.claim()
+            bucket = self.row + 8 * (start + i)
+            total = self.row + 8 * (start + len(buckets) + 1)
+            (count,) = struct.unpack_from("d", self.mem, bucket)
+            struct.pack_into("d", self.mem, bucket, count + 1)
+            (old,) = struct.unpack_from("d", self.mem, total)
+            struct.pack_into("d", self.mem, total, old + value)
+
+    def snapshot(self):
+        size = 8 * self.width
+        values = [0.0] * self.width
+        for offset in range(0, size * self.rows, size):
+            (claimed,) = struct.unpack_from("d", self.mem, offset)
+            if claimed:
+                row = struct.unpack_from("%dd" % self.width, self.mem, offset)
+                values = [a + b for a, b in zip(values, row)]
+        return values
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text format."""
+
+        values = self.snapshot()
+        lines = []
+        for family in self.families.values():
+            lines.append("# HELP %s %s" % (family.name, family.help))
+            lines.append("# TYPE %s %s" % (family.name, family.kind))
+            for value in family.values:
+                start = family.slot(value)
+                if family.kind != "histogram":
+                    lines.append(
+                        "%s%s %s"
+                        % (family.name, family.labels(value), number(values[start]))
+                    )
+                    continue
+
+                count = 0
+                for i, bound in enumerate(buckets + ("+Inf",)):
+                    count += values[start + i]
+                    lines.append(
+                        "%s_bucket%s %s"
+                        % (
+                            family.name,
+                            family.labels(value, le=str(bound)),
+                            number(count),
+                        )
+                    )
+                total = values[start + len(buckets) + 1]
+                lines.append(
+                    "%s_sum%s %s" % (family.name, family.labels(value), number(total))
+                )
+                lines.append(
+                    "%s_count%s %s" % (family.name, family.labels(value), number(count))
+                )
+
+        return "\n".join(lines) + "\n"
+
+
+def number(value) -> str:
+    if value.is_integer():
+        return "%d" % value
+    return repr(value)
+
+
+def setup(config, handler, validators=()):
+    """Start the registry if the metrics option is set.
+
+    Must run before the server forks: commands are handler's do_*
+    methods and validators the names of the script validators.
+
+    """
+
+    global registry
+
+    registry = None
+    if not config.get("main", "metrics", ""):
+        return None
+
+    commands = sorted(
+        name[3:].upper()
+        for name in dir(handler)
+        if name.startswith("do_") and not name.startswith("do_sasl_")
+    )
+
+    new = Registry()
+    new.declare(
+        "histogram",
+        "pysieved_command_duration_seconds",
+        "Time taken by managesieve commands.",
+        "command",
+        commands,
+    )
+    new.declare(
+        "counter",
+        "pysieved_command_errors_total",
+        "Commands answered with NO or BYE, or that failed.",
+        "command",
+        commands,
+    )
+    new.declare(
+        "histogram",
+        "pysieved_auth_duration_seconds",
+        "Time taken by the auth plugin, by outcome.",
+        "outcome",
+        ("ok", "fail", "cont", "cached", "error"),
+    )
+    new.declare(
+        "histogram",
+        "pysieved_userdb_duration_seconds",
+        "Time taken by userdb lookups, by outcome.",
+        "outcome",
+        ("found", "notfound", "error"),
+    )
+    new.declare(
+        "histogram",
+        "pysieved_validator_duration_seconds",
+        "Time taken by script validator runs.",
+        "validator",
+        validators,
+    )
+    new.declare("counter", "pysieved_received_bytes_total", "Bytes received from clients.")
+    new.declare("counter", "pysieved_sent_bytes_total", "Bytes sent to clients.")
+    new.declare("gauge", "pysieved_connections", "Client connections open.")
+    new.declare("gauge", "pysieved_children", "Child processes serving sessions.")
+    new.start()
+
+    registry = new
+    return registry
+
+
+def forked():
+    if registry is not None:
+        registry.forked()
+
+
+os.register_at_fork(after_in_child=forked)
+
+
+# What sessions call.  They do nothing while metrics are off.
+def add(name, value=1, label=None):
+    if registry is not None:
+        registry.add(name, value, label)
+
+
+def set_gauge(name, value, label=None):
+    if registry is not None:
+        registry.set(name, value, label)
+
+
+def observe(name, value, label=None):
+    if registry is not None:
+        registry.observe(name, value, label)
+
+
+def since(name, start, label=None):
+    """Observe the time since perf_counter() returned start."""
+
+    if registry is not None:
+        registry.observe(name, time.perf_counter() - start, label)
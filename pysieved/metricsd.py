@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import http.server
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from pysieved import metrics
+from pysieved.validatord import drop_privileges
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPExporter(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+class TCP6Exporter(TCPExporter):
+    address_family = socket.AF_INET6
+
+
+class UnixExporter(socketserver.UnixStreamServer):
+    pass
+
+
+def bind(address):
+    """Return an exporter listening on address, host:port or a path."""
+
+    if "/" in address:
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+        return UnixExporter(address, MetricsHandler)
+
+    host, _, port = address.rpartition(":")
+    host = host.strip("[]")
+    if ":" in host:
+        return TCP6Exporter((host, int(port)), MetricsHandler)
+    return TCPExporter((host, int(port)), MetricsHandler)
+
+
+def spawn(config, log, server=None):
+    """Fork the exporter serving the metrics, if they are on.
+
+    It serves them over HTTP on the metrics address, for Prometheus to
+    scrape, reading the counters the other processes share.  It exits
+    with the process that spawned it.
+
+    """
+
+    address = config.get("main", "metrics", "")
+    registry = metrics.registry
+    if not address or registry is None:
+        return None
+
+    exporter = bind(address)
+    exporter.registry = registry
+    parent = os.getpid()
+
+    pid = os.fork()
+    if pid:
+        exporter.server_close()
+        return pid
+
+    status = 1
+    try:
+        if server is not None:
+            server.socket.close()
+
+        if os.getuid() == 0:
+            drop_privileges(config.get("main", "metrics_user", "nobody"))
+
+        def watch_parent():
+            while os.getppid() == parent:
+                time.sleep(5)
+            exporter.shutdown()
+
+        threading.Thread(target=watch_parent, daemon=True).start()
+
+        log(1, "Metrics exporter listening on %s" % address)
+        exporter.serve_forever()
+        status = 0
+    finally:
+        os._exit(status)
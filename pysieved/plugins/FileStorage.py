@@ -21,11 +21,15 @@
 # 26 November 2025 - Modified by F. Ioannidis.
 
 
+import hashlib
 import os
+import secrets
+import stat
 import tempfile
 import urllib.parse
 
 from pysieved import plugins
+from pysieved.blobs import file_digest
 
 ####################################
 ## Storage stuff
@@ -46,6 +50,12 @@ def write_out(sieve_has_error, basedir, final, txt):
         txt = txt.encode()
 
     script.write(txt)
+    install(sieve_has_error, basedir, final, script)
+
+
+def install(sieve_has_error, basedir, final, script):
+    """Validate the TempFile script and move it to final"""
+
     script.close()
 
     err_str = sieve_has_error(basedir, script.name)
@@ -59,6 +69,7 @@ class TempFile:
     """Like NamedTemporaryFile but won't complain if unlink fails"""
 
     def __init__(self, dir):
+        self.file = self.name = None
         fd, self.name = tempfile.mkstemp(dir=dir)
         self.file = os.fdopen(fd, "w+b")
         self.unlink = os.unlink
@@ -74,6 +85,9 @@ class TempFile:
 
     def __del__(self):
         self.close()
+        if self.name is None:
+            # mkstemp() failed
+            return
         try:
             self.unlink(self.name)
         except OSError:
@@ -81,80 +95,329 @@ class TempFile:
 
 
 class FileStorage(plugins.ScriptStorage):
-    def __init__(self, sieve_test, mydir, active_file, homedir):
+    """Scripts as files in a directory of the home directory.
+
+    The active script is a symlink to one of them.  Both directories are
+    opened on first use, and every operation works relative to them, so
+    a command costs as few lookups as possible on a slow (NFS) home.
+    The scripts directory is only created by the first write.
+
+    An active file that isn't a symlink is adopted as a script the
+    first time the directory is opened.  A marker in the directory then
+    tells later sessions not to look again.
+
+    With a BlobStore, scripts are hard links to shared blobs.  Scripts
+    that are only checked are written to `scratch`, not the home.
+    """
+
+    # Marker left once the active file has been checked
+    migrated = ".migrated"
+
+    def __init__(
+        self, sieve_test, mydir, active_file, homedir, blobs=None, scratch=None
+    ):
         self.sieve_test = sieve_test
         self.mydir = mydir
         self.active_file = active_file
         self.homedir = homedir
         self.basedir = os.path.join(self.homedir, self.mydir)
         self.active = os.path.join(self.homedir, self.active_file)
+        self.blobs = blobs
+        self.scratch = scratch or tempfile.gettempdir()
+        self.homefd = self.dirfd = None
+
+    def home(self):
+        if self.homefd is None:
+            self.homefd = os.open(self.homedir, os.O_RDONLY | os.O_DIRECTORY)
+        return self.homefd
+
+    def scripts_dir(self, create=False):
+        """Return the scripts directory's descriptor.
+
+        Returns None if there's no such directory yet, unless `create`
+        or an active file to adopt asks for it.
+        """
 
-        # Create our directory if needed
-        if not os.path.exists(self.basedir):
-            os.mkdir(self.basedir)
+        if self.dirfd is not None:
+            return self.dirfd
 
+        flags = os.O_RDONLY | os.O_DIRECTORY
+        try:
+            self.dirfd = os.open(self.mydir, flags, dir_fd=self.home())
+        except FileNotFoundError:
+            if not (create or self.legacy_active()):
+                return None
+            try:
+                os.mkdir(self.mydir, dir_fd=self.home())
+            except FileExistsError:
+                pass
+            self.dirfd = os.open(self.mydir, flags, dir_fd=self.home())
+
+        try:
+            os.stat(self.migrated, dir_fd=self.dirfd)
+        except FileNotFoundError:
+            self.migrate()
+
+        return self.dirfd
+
+    def legacy_active(self):
+        """Return true if the active file exists and isn't a symlink"""
+
+        try:
+            st = os.lstat(self.active_file, dir_fd=self.home())
+        except OSError:
+            return False
+        return not stat.S_ISLNK(st.st_mode)
+
+    def migrate(self):
         # If they already have a script, shuffle it into where we want it
-        if os.path.exists(self.active) and not os.path.islink(self.active):
-            os.rename(self.active, os.path.join(self.basedir, "dovecot"))
-            self.set_active("dovecot")
+        if self.legacy_active():
+            self.adopt_active()
 
-    def __setitem__(self, k, v):
-        write_out(
-            self.sieve_test,
-            self.basedir,
-            os.path.join(self.basedir, quote(k)),
-            v,
+        try:
+            fd = os.open(
+                self.migrated,
+                os.O_WRONLY | os.O_CREAT,
+                0o644,
+                dir_fd=self.dirfd,
+            )
+        except OSError:
+            # Read-only: check again next time
+            return
+        os.close(fd)
+
+    def adopt_active(self):
+        """Make the active file, which isn't a symlink, one of our scripts"""
+
+        os.rename(
+            self.active_file,
+            "dovecot",
+            src_dir_fd=self.homefd,
+            dst_dir_fd=self.dirfd,
         )
+        self.set_active("dovecot")
+
+    def close(self):
+        for fd in (self.dirfd, self.homefd):
+            if fd is not None:
+                os.close(fd)
+        self.homefd = self.dirfd = None
+
+    def __del__(self):
+        self.close()
+
+    def __setitem__(self, k, v):
+        self.scripts_dir(create=True)
+
+        if isinstance(v, str):
+            v = v.encode()
+
+        digest = None
+        if self.blobs is not None:
+            digest = hashlib.sha256(v).hexdigest()
+            if self.link_blob(k, digest):
+                return
+
+        final = os.path.join(self.basedir, quote(k))
+        write_out(self.sieve_test, self.basedir, final, v)
+        self.add_blob(final, digest)
+
+    def begin_upload(self):
+        self.scripts_dir(create=True)
+        return TempFile(self.basedir)
+
+    def finish_upload(self, k, upload):
+        self.scripts_dir(create=True)
+
+        digest = None
+        if self.blobs is not None:
+            upload.close()
+            digest = file_digest(upload.name)
+            if self.link_blob(k, digest):
+                return
+
+        final = os.path.join(self.basedir, quote(k))
+        install(self.sieve_test, self.basedir, final, upload)
+        self.add_blob(final, digest)
+
+    def check(self, v):
+        if isinstance(v, str):
+            v = v.encode()
+
+        script = TempFile(self.scratch)
+        script.write(v)
+        script.close()
+
+        # The validator daemon takes turns between users by basedir
+        err_str = self.sieve_test(self.basedir, script.name)
+        if err_str is not None:
+            raise ValueError(err_str)
+
+    def link_blob(self, k, digest):
+        """Store k as a link to a known blob, return false if there's none"""
+
+        blob = self.blobs.find(digest)
+        if blob is None:
+            return False
+
+        tmp = ".link-%s" % secrets.token_hex(8)
+        try:
+            os.link(blob, tmp, dst_dir_fd=self.dirfd)
+        except OSError:
+            # Collected meanwhile, or on another filesystem
+            return False
+
+        try:
+            os.rename(tmp, quote(k), src_dir_fd=self.dirfd, dst_dir_fd=self.dirfd)
+        except BaseException:
+            os.unlink(tmp, dir_fd=self.dirfd)
+            raise
+
+        self.blobs.maybe_collect()
+        return True
+
+    def add_blob(self, final, digest):
+        if digest is not None:
+            self.blobs.add(final, digest)
+            self.blobs.maybe_collect()
 
     def __getitem__(self, k):
-        fn = os.path.join(self.basedir, quote(k))
+        fd, _ = self.open_script(k)
+        with open(fd, "rb") as file:
+            return file.read()
+
+    def open_script(self, k):
+        if self.scripts_dir() is None:
+            raise KeyError("Unknown script")
 
         try:
-            with open(fn, "rb") as file:
-                text = file.read()
+            fd = os.open(quote(k), os.O_RDONLY, dir_fd=self.dirfd)
+        except OSError:
+            raise KeyError("Unknown script")
 
-            return text
-        except IOError:
+        # "." and ".." open the directories
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            os.close(fd)
             raise KeyError("Unknown script")
 
+        return fd, st.st_size
+
     def __delitem__(self, k):
         if k and self.is_active(k):
             raise ValueError("Script is active")
-        fn = os.path.join(self.basedir, quote(k))
+        if self.scripts_dir() is None:
+            raise KeyError("Unknown script")
+
         try:
-            os.unlink(fn)
+            os.unlink(quote(k), dir_fd=self.dirfd)
         except OSError:
             raise KeyError("Unknown script")
 
+        if self.blobs is not None:
+            self.blobs.maybe_collect()
+
     def __iter__(self):
-        for s in os.listdir(self.basedir):
-            if s[0] == ".":
-                continue
-            if s[-1] == "~":
-                continue
-            yield unquote(s)
+        if self.scripts_dir() is None:
+            return
+
+        with os.scandir(self.dirfd) as entries:
+            for entry in entries:
+                s = entry.name
+                if s[0] == ".":
+                    continue
+                if s[-1] == "~":
+                    continue
+                yield unquote(s) if "%" in s else s
 
     def has_key(self, k):
-        fn = os.path.join(self.basedir, quote(k))
-        return os.path.exists(fn)
+        if self.scripts_dir() is None:
+            return False
 
-    def is_active(self, k):
-        fn = os.path.join(self.basedir, quote(k))
-        if not self.has_key(k):
-            raise KeyError("Unknown script %s" % k)
         try:
-            return os.path.samefile(fn, self.active)
+            os.stat(quote(k), dir_fd=self.dirfd)
         except OSError:
             return False
+        return True
+
+    def active_name(self):
+        if self.scripts_dir() is None:
+            return None
+
+        try:
+            target = os.readlink(self.active_file, dir_fd=self.homefd)
+        except OSError:
+            # No active script, or not a symlink
+            return None
+
+        head, name = os.path.split(target)
+        head = os.path.join(os.path.dirname(self.active), head)
+        if os.path.normpath(head) == os.path.normpath(self.basedir):
+            name = unquote(name)
+            return name if self.has_key(name) else None
+
+        # Points elsewhere: look for the same file among our scripts
+        try:
+            st = os.stat(self.active_file, dir_fd=self.homefd)
+        except OSError:
+            return None
+
+        with os.scandir(self.dirfd) as entries:
+            for entry in entries:
+                if entry.inode() != st.st_ino or entry.name[0] == ".":
+                    continue
+                if entry.stat(follow_symlinks=False).st_dev == st.st_dev:
+                    return unquote(entry.name)
+
+        return None
+
+    def is_active(self, k):
+        if self.active_name() == k:
+            return True
+        if not self.has_key(k):
+            raise KeyError("Unknown script %s" % k)
+        return False
 
     def set_active(self, k):
         if k:
-            fn = os.path.join(self.mydir, quote(k))
             if not self.has_key(k):
                 raise KeyError("Unknown script")
+            self.point_active(k)
+            return
+
+        # Adopts an active file that isn't ours before removing it
+        self.scripts_dir()
         try:
-            os.unlink(self.active)
+            os.unlink(self.active_file, dir_fd=self.home())
         except OSError:
             pass
-        if k:
-            os.symlink(fn, self.active)
+
+    def point_active(self, k):
+        """Replace the active symlink by one to script k, atomically"""
+
+        tmp = "%s.%s~" % (self.active_file, secrets.token_hex(8))
+        os.symlink(os.path.join(self.mydir, quote(k)), tmp, dir_fd=self.home())
+        try:
+            os.rename(
+                tmp, self.active_file, src_dir_fd=self.homefd, dst_dir_fd=self.homefd
+            )
+        except BaseException:
+            os.unlink(tmp, dir_fd=self.homefd)
+            raise
+
+    def rename(self, old, new):
+        # No new script, so no validation: the file just changes names.
+        # Unlike rename(), link() never replaces a script created
+        # meanwhile, and the active symlink is moved before the old name
+        # goes, so it never dangles.
+        active = self.is_active(old)
+        try:
+            os.link(
+                quote(old), quote(new), src_dir_fd=self.dirfd, dst_dir_fd=self.dirfd
+            )
+        except FileNotFoundError:
+            raise KeyError("Unknown script %s" % old)
+
+        if active:
+            self.point_active(new)
+        os.unlink(quote(old), dir_fd=self.dirfd)
@@ -22,6 +22,7 @@
 
 
 import base64
+import os
 
 
 class PysievedPlugin:
@@ -97,8 +98,41 @@ class PysievedPlugin:
         Params will contain 'username' and 'password'.
         """
 
+        user = self.lookup_user(params)
+        if user is None:
+            return None
+
+        home, uid, gid = user
+        self.switch_user(uid, gid)
+        return home
+
+    def lookup_user(self, params):
+        """Return (home, uid, gid) without switching users.
+
+        uid and gid are None where lookup() leaves them alone.  Returns
+        None for an unknown user, and raises LookupError if the userdb
+        can't tell.  Implementing this makes the userdb cacheable.
+        """
+
         raise NotImplementedError()
 
+    def switch_user(self, uid, gid):
+        """Switch to the ids returned by lookup_user()."""
+
+        if gid is not None:
+            os.setgid(gid)
+        if uid is not None:
+            os.setuid(uid)
+
+    def setuid_per_user(self):
+        """Return true if lookup() switches to the user's uid/gid.
+
+        Such a userdb needs a process per session: it can't be used
+        with the server modes that serve several users from one process.
+        """
+
+        return True
+
     def create_storage(self, params):
         """Return a storage object.
 
@@ -108,7 +142,47 @@ class PysievedPlugin:
         raise NotImplementedError()
 
 
+class ProcessConnection:
+    """A database connection that every process opens for itself.
+
+    The connection is opened by connect() on first use.  One inherited
+    across fork() is still the parent's: it is kept around rather than
+    used or dropped, as closing it could close it under the parent (or
+    checkpoint its SQLite WAL).
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.conn = None
+        self.pid = None
+        self.inherited = None
+
+    def get(self):
+        if self.conn is not None and self.pid != os.getpid():
+            self.inherited = self.conn
+            self.conn = None
+
+        if self.conn is None:
+            self.conn = self.connect()
+            self.pid = os.getpid()
+
+        return self.conn
+
+    def close(self):
+        """Close this process' connection, get() opens a new one."""
+
+        conn, self.conn = self.conn, None
+        if conn is not None and self.pid == os.getpid():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
 class ScriptStorage:
+    # Largest script this user may store, None for the server's limit
+    maxsize = None
+
     def __setitem__(self, k, v):
         if False:
             # If it doesn't validate, return ValueError
@@ -126,17 +200,80 @@ class ScriptStorage:
     def __iter__(self):
         raise NotImplementedError()
 
+    def begin_upload(self):
+        """Return a file to receive a new script, or None.
+
+        This is optional: with None the script is read into memory and
+        stored with __setitem__.  Otherwise the script is written to
+        the returned file, which is then handed to finish_upload().
+        """
+
+        return None
+
+    def finish_upload(self, k, upload):
+        """Store the script written to `upload` as k.
+
+        Raise ValueError if it doesn't validate.
+        """
+
+        raise NotImplementedError()
+
+    def check(self, v):
+        """Validate script v without storing it.
+
+        Raise ValueError if it doesn't validate.
+        """
+
+        raise NotImplementedError()
+
+    def open_script(self, k):
+        """Return an open file descriptor and the size of script k.
+
+        This is optional: return None to have the script read with
+        __getitem__ instead.  Raise KeyError if there's no such script.
+        """
+
+        return None
+
     def has_key(self, k):
         raise NotImplementedError()
 
     def is_active(self, k):
         raise NotImplementedError()
 
+    def active_name(self):
+        """Return the name of the active script, or None.
+
+        Override this if it's cheaper than asking is_active() about
+        every script.
+        """
+
+        for k in self:
+            if self.is_active(k):
+                return k
+        return None
+
     def set_active(self, k):
         if k is not None and not self.has_key(k):
             raise KeyError("Unknown script")
         raise NotImplementedError()
 
+    def rename(self, old, new):
+        """Rename script old to new, keeping it active if it was.
+
+        Raise KeyError if there's no script old, and FileExistsError if
+        there is a script new.  Override this: the default stores the
+        script again under the new name, validating it once more.
+        """
+
+        if self.has_key(new):
+            raise FileExistsError("Script exists")
+        active = self.is_active(old)
+        self[new] = self[old]
+        if active:
+            self.set_active(new)
+        del self[old]
+
 
 class TestConfig:
     def __init__(self, **kwargs):
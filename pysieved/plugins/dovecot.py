@@ -18,21 +18,60 @@
 ## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
 ## USA
 
-import __init__
-import FileStorage
-import urllib
-import tempfile
-import stat
-import socket
+import base64
 import os
-import popen2
+import socket
+import subprocess
+import tempfile
+
+from pysieved import dovecothub, plugins, validation
+from pysieved.blobs import BlobStore
+from pysieved.plugins import FileStorage
 
 
 def b64_encode(s):
-    return s.encode('base64').replace('\n', '')
+    return base64.b64encode(s.encode()).decode()
+
+
+# Shared by all plugin instances, see init()
+hub = None
+
+
+class Connection:
+    """Line based connection to a Dovecot socket (or to the hub)"""
 
+    def __init__(self, sock, log):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.log = log
 
-class PysievedPlugin(__init__.PysievedPlugin):
+    def send(self, s):
+        self.log(7, '> %r' % s)
+        self.sock.sendall(s.encode())
+
+    def readline(self):
+        line = self.rfile.readline()
+        if not line.endswith(b'\n'):
+            raise ConnectionError('Dovecot closed the connection')
+        line = line[:-1].decode()
+        self.log(7, '< %r' % line)
+        return line
+
+    def reply(self, reqid, commands):
+        """Return the fields of the reply to request reqid"""
+
+        while True:
+            parts = self.readline().split('\t')
+            if (parts[0] in commands and len(parts) > 1
+                    and parts[1] == str(reqid)):
+                return parts
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class PysievedPlugin(plugins.PysievedPlugin):
     capabilities = ('fileinto reject envelope vacation imapflags '
                     'notify subaddress relational '
                     'comparator-i;ascii-numeric')
@@ -40,6 +79,8 @@ class PysievedPlugin(__init__.PysievedPlugin):
     version = [ 1, 0 ]
 
     def init(self, config):
+        global hub
+
         self.mux = config.get('Dovecot', 'mux', False)
         self.master = config.get('Dovecot', 'master', False)
         self.service = config.get('Dovecot', 'service', 'pysieved')
@@ -49,6 +90,19 @@ class PysievedPlugin(__init__.PysievedPlugin):
         self.active_file = config.get('Dovecot', 'active', '.dovecot.sieve')
         self.uid = config.getint('Dovecot', 'uid', -1)
         self.gid = config.getint('Dovecot', 'gid', -1)
+        self.sieve_test = validation.wrap_validator(
+            config, 'dovecot', self.sievec, self.dovecot_sieve_has_error,
+            self.log)
+
+        blobs = config.get('Dovecot', 'blobs', '')
+        self.blobs = BlobStore(blobs, self.log) if blobs else None
+        self.scratch = config.get('Dovecot', 'scratch', tempfile.gettempdir())
+
+        # One hub per daemon, started before privileges are dropped
+        if hub is None and config.getboolean('Dovecot', 'hub', False):
+            hub = dovecothub.Hub(self.mux, self.master, self.version, self.log)
+            hub.start()
+            self.log(1, 'Started Dovecot hub (pid %d)' % hub.pid)
 
         # Drop privileges here if all users share the same uid/gid
         if self.gid >= 0:
@@ -61,6 +115,18 @@ class PysievedPlugin(__init__.PysievedPlugin):
         self.user_sock = None
 
 
+    def connect(self, channel, path):
+        if hub is not None:
+            self.log(7, 'Opening %s socket through the hub' % channel)
+            sock = hub.connect(channel)
+        else:
+            self.log(7, 'Opening socket %s' % path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+
+        return Connection(sock, self.log)
+
+
     def open_auth_socket(self):
         # The forked child should be short-lived enough that
         # it should be ok to open the authentication socket
@@ -71,47 +137,49 @@ class PysievedPlugin(__init__.PysievedPlugin):
             raise ValueError('No MUX socket was specified')
 
         # Open the socket
-        self.log(7, 'Opening socket %s' % self.mux)
-        self.auth_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.auth_sock.connect(self.mux)
+        self.auth_sock = self.connect('auth', self.mux)
 
         # Send our version and PID
-        init_string = ('VERSION\t%d\t%d\nCPID\t%d\n' %
-                       (self.version[0],
-                        self.version[1],
-                        os.getpid()))
-        self.log(7, '> %r' % init_string)
-        self.auth_sock.sendall(init_string)
-
-        # Verify version
-        greet = self.auth_sock.recv(1024)
-        self.log(7, '< %r' % greet)
-        if greet.find('VERSION\t%d\t' % self.version[0]) == -1:
-            raise ValueError('Incompatible version number')
-
-        # Grab mechanisms
-        if len(self.mechs) == 0:
-            for line in greet.splitlines():
-                if line.startswith('MECH\t'):
-                    parts = line.split('\t')
-                    if parts[1].upper() not in [ mech.upper() for mech in self.mechs]:
-                        self.log(7, 'Adding mechanism %s' % parts[1].upper())
-                        self.mechs.append(parts[1].upper())
+        self.auth_sock.send('VERSION\t%d\t%d\nCPID\t%d\n' %
+                            (self.version[0],
+                             self.version[1],
+                             os.getpid()))
+
+        # Read the handshake, up to DONE
+        mechs = []
+        while True:
+            parts = self.auth_sock.readline().split('\t')
+            if parts[0] == 'VERSION':
+                if parts[1:2] != [str(self.version[0])]:
+                    raise ValueError('Incompatible version number')
+            elif parts[0] == 'MECH' and len(parts) > 1:
+                mechs.append(parts[1].upper())
+            elif parts[0] == 'DONE':
+                break
+
+        # Grab mechanisms, shared by all instances
+        self.log(7, 'Mechanisms %s' % ' '.join(mechs))
+        self.mechs[:] = mechs
 
         # All done
         self.reqid = 0
 
 
     def mechanisms(self):
-        # When first started, no mechanisms are known
-        # Open the authentication and get a list from the daemon
-        if len(self.mechs) == 0 and not self.auth_sock:
+        # Ask the daemon for a fresh list.  The socket isn't kept: this
+        # is called in the parent, and children must not share it.
+        if not self.auth_sock:
             self.open_auth_socket()
+            self.auth_sock.close()
+            self.auth_sock = None
 
         return self.mechs
 
 
     def do_sasl_first(self, mechanism, *args):
+        if not self.auth_sock:
+            self.open_auth_socket()
+
         # Make sure the requested mechanism is supported
         if mechanism.upper() not in [ mech.upper() for mech in self.mechs ]:
             return {'result': 'NO',
@@ -151,31 +219,27 @@ class PysievedPlugin(__init__.PysievedPlugin):
             return {'result': 'BYE', 'msg': 'Server Error'}
 
         # Dialog
-        self.log(7, '> %r' % msg)
-        self.auth_sock.sendall(msg)
-        ret = self.auth_sock.recv(1024)
-        self.log(7, '< %r' % ret)
+        try:
+            self.auth_sock.send(msg)
+            parts = self.auth_sock.reply(self.reqid, ('OK', 'FAIL', 'CONT'))
+        except OSError:
+            self.auth_sock.close()
+            self.auth_sock = None
+            return {'result': 'BYE', 'msg': 'Server Error'}
 
         # Parse result
-        if ret.startswith('OK'):
-            pass
-        elif ret.startswith('FAIL'):
+        if parts[0] == 'FAIL':
             return {'result': 'NO', 'msg': 'Authentication failed'}
-        elif ret.startswith('CONT\t'):
-            ret = (ret.splitlines())[0]
-            parts = ret.split('\t')
+        elif parts[0] == 'CONT':
             if len(parts) >= 3:
                 return {'result': 'CONT', 'msg': parts[2]}
             else:
                 return {'result': 'CONT', 'msg': ''}
-        else:
-            return {'result': 'BYE', 'msg': 'Unexpected result'}
 
         # Extract the authorized user
         username = None
 
-        ret = (ret.splitlines())[0]
-        for part in ret.split('\t'):
+        for part in parts[2:]:
             if part.startswith('user='):
                 username = part[5:]
                 break
@@ -195,82 +259,78 @@ class PysievedPlugin(__init__.PysievedPlugin):
         return False
 
 
-    def lookup(self, params):
+    def lookup_user(self, params):
         # We can do this only if a master socket was specified
         if not self.master:
             raise ValueError('No master socket was specified')
 
         if not self.user_sock:
-            self.log(7, 'Opening socket %s' % self.master)
-            self.user_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.user_sock.connect(self.master)
-            init_string = ('VERSION\t%d\t%d\n' %
-                           (self.version[0],
-                            self.version[1]))
-            self.log(7, '> %r' % init_string)
-            self.user_sock.sendall(init_string)
-            greet = self.user_sock.recv(1024)
-            self.log(7, '< %r' % greet)
-            if greet.find('VERSION\t%d\t' % self.version[0]) == -1:
+            self.user_sock = self.connect('master', self.master)
+            self.user_sock.send('VERSION\t%d\t%d\n' %
+                                (self.version[0],
+                                 self.version[1]))
+            parts = self.user_sock.readline().split('\t')
+            if parts[0] != 'VERSION' or parts[1:2] != [str(self.version[0])]:
                 raise ValueError('Incompatible major version number')
             self.lookup_id = 0
 
         self.lookup_id = self.lookup_id + 1
-        lookup_string = ('USER\t%d\t%s\tservice=%s\n' %
-                         (self.lookup_id,
-                          params['username'],
-                          self.service))
-        self.log(7, '> %r' % lookup_string)
-        self.user_sock.sendall(lookup_string)
-        ret = self.user_sock.recv(1024)
-        self.log(7, '< %r' % ret)
-
-        if ret.startswith('USER\t'):
-            ret = (ret.splitlines())[0]
-
+        self.user_sock.send('USER\t%d\t%s\tservice=%s\n' %
+                            (self.lookup_id,
+                             params['username'],
+                             self.service))
+        parts = self.user_sock.reply(self.lookup_id,
+                                     ('USER', 'NOTFOUND', 'FAIL'))
+
+        if parts[0] == 'USER':
             uid = None
             gid = None
             home = None
 
-            for part in ret.split('\t'):
+            for part in parts[2:]:
               if part.startswith('uid='):
-                  uid = part[4:]
+                  uid = int(part[4:])
               elif part.startswith('gid='):
-                  gid = part[4:]
+                  gid = int(part[4:])
               elif part.startswith('home='):
                   home = part[5:]
 
-            # Assuming we were started with elevated privileges, drop them now
-            if (self.gid < 0) and (int(gid) >= 0):
-                os.setgid(int(gid))
-
-            if (self.uid < 0) and (int(uid) >= 0):
-                os.setuid(int(uid))
+            # Assuming we were started with elevated privileges, drop them
+            # to the ids the configuration leaves unset
+            if (self.uid >= 0) or (uid is not None and uid < 0):
+                uid = None
+            if (self.gid >= 0) or (gid is not None and gid < 0):
+                gid = None
 
-            return home
-        else:
+            return home, uid, gid
+        elif parts[0] == 'NOTFOUND':
             return None
+        else:
+            raise LookupError('Userdb lookup failed')
+
+
+    def setuid_per_user(self):
+        # Only the ids left unset are taken from the userdb reply
+        return (self.uid < 0) or (self.gid < 0)
 
 
     def dovecot_sieve_has_error(self, basedir, script):
-        compiled = FileStorage.TempFile(basedir)
+        compiled = FileStorage.TempFile(os.path.dirname(script))
         compiled.close()
-        p = popen2.Popen3(('%s %s %s ' % (self.sievec,
-                                          script,
-                                          compiled.name)),
-                          True)
-        p.tochild.close()
-        ret_str = p.fromchild.read().strip()
-        err_str = p.childerr.read().strip()
-        p.fromchild.close()
-        p.childerr.close()
-        if p.wait():
-            return err_str
+        p = subprocess.Popen([self.sievec, script, compiled.name],
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        ret_str, err_str = p.communicate()
+        if p.returncode:
+            return err_str.strip().decode(errors='replace')
         return None
 
 
     def create_storage(self, params):
-        return FileStorage.FileStorage(self.dovecot_sieve_has_error,
+        return FileStorage.FileStorage(self.sieve_test,
                                        self.scripts_dir,
                                        self.active_file,
-                                       params['homedir'])
+                                       params['homedir'],
+                                       self.blobs,
+                                       self.scratch)
@@ -24,54 +24,143 @@
 import os
 import re
 import subprocess
+import tempfile
 
-from pysieved import plugins
+from pysieved import plugins, validation
+from pysieved.blobs import BlobStore
 from pysieved.plugins import FileStorage
 
 
-class EximStorage(FileStorage.FileStorage):
-    def __init__(self, sieve_test, mydir, active_file, homedir):
-        self.sieve_test = sieve_test
-        self.mydir = mydir
-        self.active_file = active_file
-        self.homedir = homedir
-        self.basedir = os.path.join(self.homedir, self.mydir)
-        self.active = os.path.join(self.homedir, self.active_file)
-        self.sieve_hdr = "# Sieve filter"
-        self.sieve_re = re.compile(r"^" + re.escape(self.sieve_hdr), re.S)
+class Normalizer:
+    """Normalize an Exim filter fed in chunks.
 
-        # Create our directory if needed
-        if not os.path.exists(self.basedir):
-            os.mkdir(self.basedir)
+    Line endings become LF, the header is added if it is missing and
+    leading and trailing empty lines are dropped, so that the filter
+    ends with a single LF.
 
-        # If they already have a script, shuffle it into where we want it
-        if os.path.exists(self.active) and not os.path.islink(self.active):
-            try:
-                with open(self.active) as file:
-                    script = file.read()
+    """
 
-                # Make sure this is an Exim Sieve filter
-                if re.match(self.sieve_re, script, re.S):
-                    os.rename(self.active, os.path.join(self.basedir, "exim"))
-                    self.set_active("exim")
-            except IOError:
-                pass
+    def __init__(self, header: bytes):
+        self.header = header
+        self.head = b""  # Start of the filter, until the header is checked
+        self.cr = False  # The last chunk ended with a CR
+        self.started = False  # Something other than LF was written
+        self.newlines = 0  # LFs held back, they may be trailing
 
-    def __setitem__(self, name: str, content: bytes):
-        # Normalize all line endings to LF first
-        filter_ = content.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    def feed(self, chunk: bytes) -> bytes:
+        if self.cr:
+            chunk = b"\r" + chunk
+            self.cr = False
+
+        if chunk.endswith(b"\r"):
+            # Might be the first half of a CRLF
+            chunk = chunk[:-1]
+            self.cr = True
+
+        return self._check_header(chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n"))
+
+    def close(self) -> bytes:
+        out = b""
+        if self.cr:
+            self.cr = False
+            out = self._check_header(b"\n")
+
+        if self.head is not None:
+            # Shorter than the header
+            out += self._check_header(b"", True)
+
+        return out + b"\n"
+
+    def _check_header(self, chunk: bytes, end=False) -> bytes:
+        if self.head is not None:
+            self.head += chunk
+            if len(self.head) < len(self.header) and not end:
+                return b""
+
+            chunk, self.head = self.head, None
+            if not chunk.startswith(self.header):
+                chunk = self.header + chunk
+
+        return self._strip(chunk)
+
+    def _strip(self, chunk: bytes) -> bytes:
+        if not self.started:
+            chunk = chunk.lstrip(b"\n")
+            if not chunk:
+                return b""
+            self.started = True
+
+        body = chunk.rstrip(b"\n")
+        if not body:
+            self.newlines += len(chunk)
+            return b""
+
+        out = b"\n" * self.newlines + body
+        self.newlines = len(chunk) - len(body)
 
-        # Prepare header with LF
-        header = f"{self.sieve_hdr}\n".encode()
+        return out
 
-        # Add header only if it is not already there
-        if not filter_.startswith(header):
-            filter_ = header + filter_
 
-        filter_ = filter_.strip(b"\n") + b"\n"
+class NormalizedFile:
+    """File-like object normalizing an Exim filter into a TempFile"""
+
+    def __init__(self, script, header: bytes):
+        self.script = script
+        self.name = script.name
+        self.normalizer = Normalizer(header)
+
+    def write(self, data):
+        self.script.write(self.normalizer.feed(bytes(data)))
+
+    def close(self):
+        if self.normalizer:
+            self.script.write(self.normalizer.close())
+            self.normalizer = None
+        self.script.close()
+
+
+class EximStorage(FileStorage.FileStorage):
+    def __init__(
+        self, sieve_test, mydir, active_file, homedir, blobs=None, scratch=None
+    ):
+        self.sieve_hdr = "# Sieve filter"
+        self.sieve_re = re.compile(r"^" + re.escape(self.sieve_hdr), re.S)
+
+        super().__init__(sieve_test, mydir, active_file, homedir, blobs, scratch)
+
+    def adopt_active(self):
+        try:
+            fd = os.open(self.active_file, os.O_RDONLY, dir_fd=self.homefd)
+            with open(fd) as file:
+                script = file.read()
+
+            # Make sure this is an Exim Sieve filter
+            if re.match(self.sieve_re, script, re.S):
+                os.rename(
+                    self.active_file,
+                    "exim",
+                    src_dir_fd=self.homefd,
+                    dst_dir_fd=self.dirfd,
+                )
+                self.set_active("exim")
+        except IOError:
+            pass
+
+    def __setitem__(self, name: str, content: bytes):
+        normalizer = Normalizer(f"{self.sieve_hdr}\n".encode())
+        filter_ = normalizer.feed(content) + normalizer.close()
 
         super().__setitem__(name, filter_)
 
+    def check(self, content: bytes):
+        # Checked as it would be stored
+        normalizer = Normalizer(f"{self.sieve_hdr}\n".encode())
+        super().check(normalizer.feed(content) + normalizer.close())
+
+    def begin_upload(self):
+        script = super().begin_upload()
+        return NormalizedFile(script, f"{self.sieve_hdr}\n".encode())
+
 
 class PysievedPlugin(plugins.PysievedPlugin):
     capabilities = (
@@ -87,6 +176,13 @@ class PysievedPlugin(plugins.PysievedPlugin):
         self.active_file = config.get("Exim", "active", ".forward")
         self.uid = config.getint("Exim", "uid", -1)
         self.gid = config.getint("Exim", "gid", -1)
+        self.sieve_test = validation.wrap_validator(
+            config, "exim", self.sendmail, self.exim_sieve_has_error, self.log
+        )
+
+        blobs = config.get("Exim", "blobs", "")
+        self.blobs = BlobStore(blobs, self.log) if blobs else None
+        self.scratch = config.get("Exim", "scratch", tempfile.gettempdir())
 
         # Drop privileges here if all users share the same uid/gid
         if self.gid >= 0:
@@ -95,7 +191,7 @@ class PysievedPlugin(plugins.PysievedPlugin):
             os.setuid(self.uid)
 
     def exim_sieve_has_error(self, basedir, script):
-        compiled = FileStorage.TempFile(basedir)
+        compiled = FileStorage.TempFile(os.path.dirname(script))
         compiled.close()
 
         sendmail = self.sendmail
@@ -119,8 +215,10 @@ class PysievedPlugin(plugins.PysievedPlugin):
 
     def create_storage(self, params):
         return EximStorage(
-            self.exim_sieve_has_error,
+            self.sieve_test,
             self.scripts_dir,
             self.active_file,
             params["homedir"],
+            self.blobs,
+            self.scratch,
         )
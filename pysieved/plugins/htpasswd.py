@@ -21,27 +21,193 @@
 # 14 July 2025 - Modified by F. Ioannidis.
 
 
+import collections
+import hashlib
+import mmap
+import os
+import threading
 from crypt import crypt
 
 from pysieved import plugins
 
+# Password files, shared by the plugin instances of a process
+tables = {}
+tables_lock = threading.Lock()
+
+
+def search(data, username):
+    """Binary search lines sorted by username for username's hash."""
+
+    lo, hi = 0, len(data)
+    while lo < hi:
+        # lo and hi are at the start of a line, mid may not be
+        mid = (lo + hi) // 2
+        start = data.rfind(b"\n", lo, mid) + 1 or lo
+        end = data.find(b"\n", start, hi)
+        if end == -1:
+            end = hi
+
+        name, sep, cpass = data[start:end].rstrip().partition(b":")
+        if name == username and sep:
+            return cpass
+        # The file is sorted on whole lines, where ":" ends the name
+        elif name + b":" < username + b":":
+            lo = end + 1
+        else:
+            hi = start
+
+    return None
+
+
+class PasswdFile:
+    """A password file, reloaded when it changes.
+
+    The table is rebuilt on the side and swapped in whole, so lookups
+    never see half of it.  A thread checks the file every `interval`
+    seconds.  Threads don't survive fork(), so every process starts its
+    own on its first lookup, reloading the table first if the file
+    changed since it was loaded.  Without an interval, lookups check
+    the file themselves.
+
+    An `indexed` file must be sorted by username (LC_ALL=C sort).  It
+    is mapped into memory and searched in place, so there is nothing to
+    load at startup.
+
+    Successful crypt() checks are remembered, up to `cache_size`.
+
+    """
+
+    def __init__(self, path, indexed, interval, cache_size, log):
+        self.path = path
+        self.indexed = indexed
+        self.interval = interval
+        self.log = log
+
+        self.signature = None
+        self.table = None
+        self.reload()
+
+        self.cache_size = cache_size
+        self.cache_key = os.urandom(32)
+        self.verified = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # The process whose watcher thread is running
+        self.pid = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.watch_lock = threading.Lock()
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def reload(self):
+        # Before reading, so that changes made meanwhile are seen next time
+        signature = self.stat()
+
+        with open(self.path, "rb") as file:
+            if self.indexed:
+                try:
+                    table = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Empty file
+                    table = b""
+            else:
+                table = {}
+                for line in file:
+                    name, sep, cpass = line.rstrip().partition(b":")
+                    if sep:
+                        table[name] = cpass
+
+        self.table, self.signature = table, signature
+
+    def start_watching(self):
+        with self.watch_lock:
+            if self.pid == os.getpid():
+                return
+            if self.stat() != self.signature:
+                self.reload()
+            self.thread = threading.Thread(
+                target=self.watch, name="htpasswd", daemon=True
+            )
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            if self.stat() == self.signature:
+                continue
+            try:
+                self.reload()
+            except Exception as error:
+                self.log(1, "Can't reload %s: %s" % (self.path, error))
+            else:
+                self.log(4, "Reloaded %s" % self.path)
+
+    def close(self):
+        self.stopped.set()
+
+    def get(self, username):
+        """Return username's password hash, or None"""
+
+        if self.indexed:
+            if self.stat() != self.signature:
+                # Mapping it again is cheap
+                self.reload()
+            return search(self.table, username)
+
+        if self.interval <= 0:
+            if self.stat() != self.signature:
+                self.reload()
+        elif self.pid != os.getpid():
+            self.start_watching()
+
+        return self.table.get(username)
+
+    def verify(self, cpass, password):
+        key = hashlib.blake2b(
+            cpass + b"\0" + password.encode(), key=self.cache_key
+        ).digest()
+        with self.lock:
+            if key in self.verified:
+                self.verified.move_to_end(key)
+                return True
+
+        cpass = cpass.decode()
+        if cpass != crypt(password, cpass):
+            return False
+
+        if self.cache_size > 0:
+            with self.lock:
+                self.verified[key] = True
+                while len(self.verified) > self.cache_size:
+                    self.verified.popitem(last=False)
+
+        return True
+
 
 class PysievedPlugin(plugins.PysievedPlugin):
     def init(self, config):
         self.passfile = config.get("htpasswd", "passwdfile", "/etc/exim/virtual/passwd")
 
-        with open(self.passfile) as file:
-            lines = file.readlines()
-
-        self.passwd = {}
-        for line in lines:
-            parts = line.rstrip().split(":", 1)
-            self.passwd[parts[0]] = parts[1]
+        with tables_lock:
+            self.passwd = tables.get(self.passfile)
+            if self.passwd is None:
+                self.passwd = tables[self.passfile] = PasswdFile(
+                    self.passfile,
+                    config.getboolean("htpasswd", "indexed", False),
+                    config.getint("htpasswd", "reload_interval", 5),
+                    config.getint("htpasswd", "crypt_cache_size", 1000),
+                    self.log,
+                )
 
     def auth(self, params):
-        try:
-            cpass = self.passwd[params["username"]]
-        except KeyError:
+        cpass = self.passwd.get(params["username"].encode())
+        if cpass is None:
             return False
 
-        return cpass == crypt(params["password"], cpass)
+        return self.passwd.verify(cpass, params["password"])
@@ -18,45 +18,131 @@
 ## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
 ## USA
 
-import __init__
-import MySQLdb
 
-class PysievedPlugin(__init__.PysievedPlugin):
+import importlib
+import re
+
+from pysieved import plugins
+
+# %(name)s, with the quotes the queries used to need around it
+PLACEHOLDER = re.compile(r"""(["']?)%\((\w+)\)s\1""")
+
+
+def bind_parameters(query, paramstyle):
+    """Turn a query using %(name)s into one with bound parameters.
+
+    Returns the query for the driver's paramstyle and the names of the
+    parameters it takes.
+
+    """
+
+    names = []
+
+    def placeholder(match):
+        names.append(match.group(2))
+        if paramstyle == "named":
+            return ":%s" % match.group(2)
+        return "%%(%s)s" % match.group(2)
+
+    if paramstyle not in ("named", "pyformat"):
+        raise ValueError("Unsupported paramstyle %r" % paramstyle)
+
+    return PLACEHOLDER.sub(placeholder, query), names
+
+
+class PysievedPlugin(plugins.PysievedPlugin):
     def init(self, config):
-        dbhost = config.get('MySQL', 'dbhost')
-        dbuser = config.get('MySQL', 'dbuser')
-        dbpass = config.get('MySQL', 'dbpass')
-        dbname = config.get('MySQL', 'dbname')
-        self.auth_query = config.get('MySQL', 'auth_query')
-        self.user_query = config.get('MySQL', 'user_query')
+        self.driver = importlib.import_module(config.get("MySQL", "driver", "MySQLdb"))
+        self.connect_args = {
+            "host": config.get("MySQL", "dbhost"),
+            "user": config.get("MySQL", "dbuser"),
+            "passwd": config.get("MySQL", "dbpass"),
+            "db": config.get("MySQL", "dbname"),
+        }
+
+        paramstyle = self.driver.paramstyle
+        if paramstyle == "format":
+            # MySQLdb takes %(name)s with a dict as well
+            paramstyle = "pyformat"
+        elif paramstyle == "qmark":
+            # sqlite3 takes :name as well
+            paramstyle = "named"
+
+        # Optional: authenticate and return the home directory at once
+        self.auth_lookup_query = config.get("MySQL", "auth_lookup_query", "")
+        if self.auth_lookup_query:
+            self.auth_lookup_query = bind_parameters(self.auth_lookup_query, paramstyle)
+            # Only needed to look up users who didn't just log in
+            user_query = config.get("MySQL", "user_query", "")
+        else:
+            self.auth_query = bind_parameters(
+                config.get("MySQL", "auth_query"), paramstyle
+            )
+            user_query = config.get("MySQL", "user_query")
+
+        self.user_query = None
+        if user_query:
+            self.user_query = bind_parameters(user_query, paramstyle)
 
-        self.conn = MySQLdb.connect(host = dbhost,
-                                    user = dbuser,
-                                    passwd = dbpass,
-                                    db = dbname)
+        self.db = plugins.ProcessConnection(
+            lambda: self.driver.connect(**self.connect_args)
+        )
 
+        # (username, home) of the last login, for the lookup that follows
+        self.last_login = None
 
-    def __del__(self):
-        self.conn.close()
+    def connection(self):
+        return self.db.get()
 
+    def query(self, query, params):
+        """Return the first row the query returns for params, or None."""
+
+        sql, names = query
+        args = {name: params.get(name) for name in names}
+
+        for attempt in (1, 2):
+            try:
+                cursor = self.connection().cursor()
+                try:
+                    cursor.execute(sql, args)
+                    return cursor.fetchone()
+                finally:
+                    cursor.close()
+            except (self.driver.OperationalError, self.driver.InterfaceError) as error:
+                # The server may have closed an idle connection
+                self.log(2, "MySQL error, reconnecting: %s" % error)
+                self.db.close()
+                if attempt == 2:
+                    raise
 
     def auth(self, params):
-        cursor = self.conn.cursor()
-        cursor.execute(self.auth_query % params)
-        row = cursor.fetchone()
-        cursor.close()
+        if self.auth_lookup_query:
+            row = self.query(self.auth_lookup_query, params)
+            if row:
+                # Saves lookup() a query
+                self.last_login = (params["username"], row[0])
+        else:
+            row = self.query(self.auth_query, params)
 
         # Only return true if there was a row result
         if row:
             return True
         return False
 
+    def lookup_user(self, params):
+        last_login, self.last_login = self.last_login, None
+        if last_login is not None and last_login[0] == params["username"]:
+            return last_login[1], None, None
+
+        if self.user_query is None:
+            self.log(1, "No user_query to look up %s with" % params["username"])
+            return None
 
-    def lookup(self, params):
-        cursor = self.conn.cursor()
-        cursor.execute(self.user_query % params)
-        row = cursor.fetchone()
-        assert row, 'No results from select (invalid user?)'
-        cursor.close()
+        row = self.query(self.user_query, params)
+        if not row:
+            return None
 
-        return row[0]
+        return row[0], None, None
+
+    def setuid_per_user(self):
+        return False
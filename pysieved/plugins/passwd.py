@@ -18,16 +18,14 @@
 ## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
 ## USA
 
-import __init__
 import pwd
-import os
 
-class PysievedPlugin(__init__.PysievedPlugin):
-    def lookup(self, params):
-        pwent = pwd.getpwnam(params['username'])
-        uid = pwent[2]
-        gid = pwent[3]
-        os.setgid(gid)
-        os.setuid(uid)
-        return pwent[5]
+from pysieved import plugins
 
+class PysievedPlugin(plugins.PysievedPlugin):
+    def lookup_user(self, params):
+        try:
+            pwent = pwd.getpwnam(params['username'])
+        except KeyError:
+            return None
+        return pwent.pw_dir, pwent.pw_uid, pwent.pw_gid
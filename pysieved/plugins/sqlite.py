@@ -0,0 +1,250 @@
+#! /usr/bin/python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+
+import contextlib
+import os
+import sqlite3
+import tempfile
+
+from pysieved import plugins, validation
+from pysieved.plugins import FileStorage
+from pysieved.plugins.dovecot import PysievedPlugin as DovecotPlugin
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scripts (
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    script BLOB NOT NULL,
+    active INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, name)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS active_script ON scripts (user) WHERE active;
+"""
+
+
+class SQLiteStorage(plugins.ScriptStorage):
+    """One user's scripts in the shared database.
+
+    Only the active script is written out, to active_file in the home
+    directory, where the MTA reads it.  It is replaced in the same
+    transaction that marks it active.
+
+    """
+
+    def __init__(self, conn, sieve_test, scratch, user, homedir, active_file):
+        self.conn = conn
+        self.sieve_test = sieve_test
+        self.scratch = scratch
+        self.user = user
+        self.homedir = homedir
+        self.active = os.path.join(homedir, active_file)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Takes the write lock at once, so what is read stays true
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def validate(self, v):
+        script = FileStorage.TempFile(self.scratch)
+        script.write(v)
+        script.close()
+
+        # The validator daemon takes turns between users by basedir
+        err_str = self.sieve_test(self.user, script.name)
+        if err_str is not None:
+            raise ValueError(err_str)
+
+    check = validate
+
+    def materialize(self, v):
+        """Write the active script out, or remove it if v is None"""
+
+        if v is None:
+            try:
+                os.unlink(self.active)
+            except FileNotFoundError:
+                pass
+            return
+
+        script = FileStorage.TempFile(os.path.dirname(self.active))
+        script.write(v)
+        script.close()
+        os.rename(script.name, self.active)
+
+    def __setitem__(self, k, v):
+        if isinstance(v, str):
+            v = v.encode()
+
+        self.validate(v)
+        with self.transaction():
+            row = self.conn.execute(
+                "SELECT active FROM scripts WHERE user = ? AND name = ?",
+                (self.user, k),
+            ).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO scripts (user, name, script) VALUES (?, ?, ?)",
+                    (self.user, k, v),
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE scripts SET script = ? WHERE user = ? AND name = ?",
+                    (v, self.user, k),
+                )
+                if row[0]:
+                    self.materialize(v)
+
+    def __getitem__(self, k):
+        row = self.conn.execute(
+            "SELECT script FROM scripts WHERE user = ? AND name = ?",
+            (self.user, k),
+        ).fetchone()
+        if row is None:
+            raise KeyError("Unknown script")
+        return bytes(row[0])
+
+    def __delitem__(self, k):
+        if self.is_active(k):
+            raise ValueError("Script is active")
+        with self.transaction():
+            self.conn.execute(
+                "DELETE FROM scripts WHERE user = ? AND name = ?", (self.user, k)
+            )
+
+    def rename(self, old, new):
+        # The active file's content stays the same
+        with self.transaction():
+            if not self.has_key(old):
+                raise KeyError("Unknown script")
+            if self.has_key(new):
+                raise FileExistsError("Script exists")
+            self.conn.execute(
+                "UPDATE scripts SET name = ? WHERE user = ? AND name = ?",
+                (new, self.user, old),
+            )
+
+    def __iter__(self):
+        rows = self.conn.execute(
+            "SELECT name FROM scripts WHERE user = ? ORDER BY name", (self.user,)
+        ).fetchall()
+        return iter([row[0] for row in rows])
+
+    def has_key(self, k):
+        row = self.conn.execute(
+            "SELECT 1 FROM scripts WHERE user = ? AND name = ?", (self.user, k)
+        ).fetchone()
+        return row is not None
+
+    def active_name(self):
+        row = self.conn.execute(
+            "SELECT name FROM scripts WHERE user = ? AND active", (self.user,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def is_active(self, k):
+        row = self.conn.execute(
+            "SELECT active FROM scripts WHERE user = ? AND name = ?", (self.user, k)
+        ).fetchone()
+        if row is None:
+            raise KeyError("Unknown script %s" % k)
+        return bool(row[0])
+
+    def set_active(self, k):
+        with self.transaction():
+            script = None
+            if k:
+                script = self[k]
+
+            self.conn.execute(
+                "UPDATE scripts SET active = 0 WHERE user = ? AND active",
+                (self.user,),
+            )
+            if k:
+                self.conn.execute(
+                    "UPDATE scripts SET active = 1 WHERE user = ? AND name = ?",
+                    (self.user, k),
+                )
+
+            # Rolls the change back if it fails
+            self.materialize(script)
+
+
+class PysievedPlugin(plugins.PysievedPlugin):
+    capabilities = (
+        "fileinto reject envelope vacation imapflags "
+        "notify subaddress relational "
+        "comparator-i;ascii-numeric"
+    )
+
+    def init(self, config):
+        self.database = config.get("SQLite", "database", "/var/lib/pysieved/scripts.db")
+        self.sievec = config.get("SQLite", "sievec", "/usr/lib/dovecot/sievec")
+        self.active_file = config.get("SQLite", "active", ".dovecot.sieve")
+        self.scratch = config.get("SQLite", "scratch", tempfile.gettempdir())
+        self.uid = config.getint("SQLite", "uid", -1)
+        self.gid = config.getint("SQLite", "gid", -1)
+        self.sieve_test = validation.wrap_validator(
+            config, "sqlite", self.sievec, self.dovecot_sieve_has_error, self.log
+        )
+
+        # Drop privileges here if all users share the same uid/gid
+        if self.gid >= 0:
+            os.setgid(self.gid)
+        if self.uid >= 0:
+            os.setuid(self.uid)
+
+        # Once, for everybody: WAL mode sticks to the database
+        conn = sqlite3.connect(self.database)
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+        self.db = plugins.ProcessConnection(self.connect)
+
+    def connect(self):
+        conn = sqlite3.connect(self.database, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def connection(self):
+        return self.db.get()
+
+    # Same sievec
+    dovecot_sieve_has_error = DovecotPlugin.dovecot_sieve_has_error
+
+    def create_storage(self, params):
+        return SQLiteStorage(
+            self.connection(),
+            self.sieve_test,
+            self.scratch,
+            params["username"],
+            params["homedir"],
+            self.active_file,
+        )
@@ -1,6 +1,5 @@
 # 22 January 2025 - Modified by F. Ioannidis.
 
-import os
 import re
 
 from pysieved import plugins
@@ -16,12 +15,7 @@ class PysievedPlugin(plugins.PysievedPlugin):
         self.path = config.get("Virtual", "path", None)
         assert (self.uid is not None) and (self.gid is not None) and self.path
 
-    def lookup(self, params):
-        if self.gid >= 0:
-            os.setgid(self.gid)
-        if self.uid >= 0:
-            os.setuid(self.uid)
-
+    def lookup_user(self, params):
         try:
             user, domain = params["username"].split("@", 1)
         except ValueError:
@@ -47,8 +41,14 @@ class PysievedPlugin(plugins.PysievedPlugin):
             else:
                 return s
 
-        username = path_re.sub(repl, self.path)
-        return username
+        home = path_re.sub(repl, self.path)
+        uid = self.uid if self.uid >= 0 else None
+        gid = self.gid if self.gid >= 0 else None
+        return home, uid, gid
+
+    def setuid_per_user(self):
+        # Everybody shares the configured uid/gid
+        return False
 
 
 if __name__ == "__main__":
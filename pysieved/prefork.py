@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import os
+import select
+import signal
+import socket
+import socketserver as SocketServer
+import threading
+import time
+
+from pysieved import metrics
+
+
+class PreforkServer(SocketServer.TCPServer):
+    """TCP server handing connections to a pool of pre-forked workers.
+
+    The supervisor (whoever calls serve_forever) never accepts a
+    connection itself.  It keeps `workers` children around which all
+    accept on the shared listening socket and serve one session after
+    the other.
+
+    A worker exits after `max_sessions` sessions (0 for no limit), or as
+    soon as a session changed its uid or gid if the userdb switches to
+    each user's (see setuid_per_user), since the worker can't serve
+    anybody else afterwards.  With a userdb that has every user share
+    one uid/gid, the first session drops the worker's privileges for
+    good and the worker goes on serving.  Exited workers are reaped on SIGCHLD and replaced.  A
+    worker that failed is replaced no sooner than `respawn_interval`
+    seconds after it started, so that workers failing at startup don't
+    keep the supervisor forking.  recycle_workers() has every worker
+    exit after its current session.
+
+    """
+
+    allow_reuse_address = True
+    address_family = socket.AF_INET6
+    request_queue_size = 128
+    respawn_interval = 1.0
+
+    def __init__(
+        self,
+        server_address,
+        RequestHandlerClass,
+        workers=8,
+        max_sessions=1000,
+        bind_and_activate=True,
+    ):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+        self.workers = max(1, workers)
+        self.max_sessions = max_sessions
+        self.children = set()
+        self._started = {}
+        self._respawn_after = 0
+        self._recycle = False
+
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+        # Signal handlers (and shutdown()) poke this to wake the supervisor
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down.clear()
+        saved = self._install_signals()
+
+        try:
+            while not self._shutdown_request:
+                self.reap_children()
+
+                timeout = poll_interval
+                delay = self._respawn_after - time.monotonic()
+                if delay > 0:
+                    timeout = min(timeout, delay)
+                else:
+                    while len(self.children) < self.workers:
+                        self.spawn_worker()
+                metrics.set_gauge("pysieved_children", len(self.children))
+
+                # Without signal handlers (not the main thread) we simply
+                # poll for exited children every poll_interval
+                r, _, _ = select.select([self._wakeup_r], [], [], timeout)
+                if r:
+                    self._drain_wakeup()
+        finally:
+            self._shutdown_request = False
+            self.stop_workers()
+            self._restore_signals(saved)
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+        self._wakeup()
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        super().server_close()
+
+        for fd in (self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def spawn_worker(self):
+        started = time.monotonic()
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            self._started[pid] = started
+            return pid
+
+        # Child
+        status = 1
+        try:
+            self._reset_child()
+            self.serve_worker()
+            status = 0
+        finally:
+            os._exit(status)
+
+    def serve_worker(self):
+        ids = (os.getuid(), os.geteuid(), os.getgid(), os.getegid())
+        per_user = self.RequestHandlerClass.setuid_per_user()
+
+        # Workers take turns accepting, so that one woken by SIGHUP
+        # while idle can exit instead of waiting for a client
+        self.socket.setblocking(False)
+
+        sessions = 0
+        while not self._recycle:
+            if self.max_sessions and sessions >= self.max_sessions:
+                break
+
+            r, _, _ = select.select([self.socket, self._wakeup_r], [], [])
+            if self._wakeup_r in r:
+                self._drain_wakeup()
+            if self.socket not in r or self._recycle:
+                continue
+
+            try:
+                request, client_address = self.socket.accept()
+            except BlockingIOError:
+                # Another worker was faster
+                continue
+            except OSError:
+                continue
+
+            request.setblocking(True)
+            if self.verify_request(request, client_address):
+                try:
+                    self.process_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+            else:
+                self.shutdown_request(request)
+            sessions += 1
+
+            changed = (os.getuid(), os.geteuid(), os.getgid(), os.getegid()) != ids
+            if changed and per_user:
+                # Privileges were dropped for this session's user
+                break
+
+    def recycle_workers(self):
+        """Replace all workers, once they're done with their session.
+
+        New workers start with the server's current state, like
+        refreshed capability banners.
+
+        """
+
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def reap_children(self):
+        for pid in list(self.children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done, status = pid, 0
+
+            if not done:
+                continue
+
+            self.children.discard(pid)
+            started = self._started.pop(pid, None)
+            if status and started is not None:
+                # Failed: don't replace it right away
+                self._respawn_after = max(
+                    self._respawn_after, started + self.respawn_interval
+                )
+
+    def stop_workers(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+        self.children.clear()
+        self._started.clear()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except OSError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 512):
+                pass
+        except OSError:
+            pass
+
+    def _install_signals(self):
+        if threading.current_thread() is not threading.main_thread():
+            return None
+
+        def on_term(signum, frame):
+            self._shutdown_request = True
+
+        saved = {
+            signal.SIGCHLD: signal.signal(signal.SIGCHLD, lambda *args: None),
+            signal.SIGTERM: signal.signal(signal.SIGTERM, on_term),
+        }
+        saved["wakeup"] = signal.set_wakeup_fd(self._wakeup_w)
+
+        return saved
+
+    def _restore_signals(self, saved):
+        if saved is None:
+            return
+
+        signal.set_wakeup_fd(saved.pop("wakeup"))
+        for signum, handler in saved.items():
+            signal.signal(signum, handler)
+
+    def _reset_child(self):
+        # The forking thread is the main thread of the child
+        signal.set_wakeup_fd(-1)
+
+        for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+        # SIGHUP asks the worker to exit after its session
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+
+        def on_hup(signum, frame):
+            self._recycle = True
+
+        signal.signal(signal.SIGHUP, on_hup)
+        signal.set_wakeup_fd(self._wakeup_w)
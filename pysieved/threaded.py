@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import queue
+import socket
+import socketserver as SocketServer
+import threading
+
+
+class ThreadPoolServer(SocketServer.TCPServer):
+    """TCP server handing connections to a fixed pool of threads.
+
+    At most `threads` sessions are served at once, and as many more
+    accepted connections wait for a free thread.  Beyond that the accept
+    loop blocks and new clients wait in the listen backlog.
+
+    All sessions share one process, so this is only usable when the
+    userdb never switches to the user's uid/gid (see get_handler).
+
+    """
+
+    allow_reuse_address = True
+    address_family = socket.AF_INET6
+
+    def __init__(
+        self,
+        server_address,
+        RequestHandlerClass,
+        threads=16,
+        bind_and_activate=True,
+    ):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+        self.requests = queue.Queue(threads)
+        self.nthreads = threads
+        self.threads = []
+
+    def serve_forever(self, poll_interval=0.5):
+        # Threads don't survive fork, so start them in the serving process
+        self.start_threads()
+        super().serve_forever(poll_interval)
+
+    def start_threads(self):
+        for i in range(len(self.threads), self.nthreads):
+            t = threading.Thread(
+                target=self.process_requests,
+                name="pysieved-%d" % i,
+                daemon=True,
+            )
+            t.start()
+            self.threads.append(t)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+
+        # Idle threads stop, busy ones are daemons and die with us
+        for _ in self.threads:
+            try:
+                self.requests.put_nowait(None)
+            except queue.Full:
+                break
@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+
+import importlib
+import importlib.util
+import os
+
+
+# STARTTLS implementations, by [TLS] backend
+backends = ("ssl", "tlslite")
+
+
+def available(backend="tlslite"):
+    """Return true if backend can be used, without importing it"""
+
+    if backend == "ssl":
+        return importlib.util.find_spec("_ssl") is not None
+    return importlib.util.find_spec("tlslite") is not None
+
+
+def api():
+    # Imported on first use: it takes longer than everything else
+    return importlib.import_module("tlslite.api")
+
+
+def get_credentials(backend, key, cert, passphrase="", cache=None, log=None):
+    if backend == "ssl":
+        return SSLCredentials(key, cert, passphrase, log)
+    return TLSLiteCredentials(key, cert, passphrase, cache, log)
+
+
+class SSLCredentials:
+    """An ssl.SSLContext with the TLS certificate and key, built on first use.
+
+    Daemons build it before forking, and every session wraps its socket
+    with that one context.  The sessions share its session ticket key:
+    a client resuming its TLS session skips the full handshake whichever
+    process serves it.
+
+    """
+
+    backend = "ssl"
+
+    def __init__(self, key, cert, passphrase="", log=None):
+        self.key = key
+        self.cert = cert
+        self.passphrase = passphrase
+        self.log = log or (lambda level, message, *args: None)
+        self.loaded = None
+
+    def load(self):
+        """Return the SSLContext"""
+
+        if self.loaded is None:
+            self.loaded = self.read()
+        return self.loaded
+
+    def read(self):
+        import ssl
+
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(self.cert, self.key, self.passphrase or None)
+        return context
+
+
+class TLSLiteCredentials:
+    """The TLS certificate chain and private key, parsed on first use.
+
+    With a cache (a FileCache), decrypted keys are kept across
+    processes as PEM, keyed by the files' identity and the passphrase,
+    so that inetd sessions don't decrypt the key each time.  The cache
+    holds the decrypted key: it must be readable by nobody else.
+
+    """
+
+    backend = "tlslite"
+
+    def __init__(self, key, cert, passphrase="", cache=None, log=None):
+        self.key = key
+        self.cert = cert
+        self.passphrase = passphrase
+        self.cache = cache
+        self.log = log or (lambda level, message, *args: None)
+        self.loaded = None
+
+    def load(self):
+        """Return (certChain, privateKey)"""
+
+        if self.loaded is None:
+            self.loaded = self.read()
+        return self.loaded
+
+    def cache_key(self):
+        import hashlib
+
+        parts = ["tls", hashlib.sha256(self.passphrase.encode()).hexdigest()]
+        for fn in (self.key, self.cert):
+            st = os.stat(fn)
+            parts.append("%s %d %d %d" % (fn, st.st_ino, st.st_mtime_ns, st.st_size))
+        return "\0".join(parts)
+
+    def read(self):
+        tlslite = api()
+        with open(self.cert) as f:
+            x509 = tlslite.X509()
+            x509.parse(f.read())
+        cert_chain = tlslite.X509CertChain([x509])
+
+        key = None
+        if self.cache is not None:
+            key = self.cache_key()
+            data = self.cache.get(key)
+            if data is not None:
+                try:
+                    return cert_chain, tlslite.parsePEMKey(data.decode(), private=True)
+                except Exception as error:
+                    self.log(3, "Unusable cached TLS key: %s", error)
+
+        with open(self.key) as f:
+            private_key = tlslite.parsePEMKey(
+                f.read(), private=True, passwordCallback=lambda: self.passphrase
+            )
+
+        if key is not None:
+            try:
+                self.cache.set(key, private_key.write().encode())
+            except Exception as error:
+                # Not every key implementation can write itself out
+                self.log(3, "Cannot cache TLS key: %s", error)
+
+        return cert_chain, private_key
@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import json
+
+from pysieved.cache import FileCache
+
+
+class UserCache:
+    """Remember userdb lookups: username -> (home, uid, gid).
+
+    Sits in front of any userdb plugin implementing lookup_user().  The
+    cached ids are applied with the plugin's switch_user(), the way its
+    lookup() would.  Unknown users are remembered too, for a shorter
+    while; lookups that fail are not remembered at all.
+
+    """
+
+    def __init__(self, cache, ttl, negative_ttl):
+        self.cache = cache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get(self, username):
+        """Return (home, uid, gid), None for an unknown user, or False."""
+
+        value = self.cache.get("user\0" + username)
+        if value is None:
+            return False
+
+        try:
+            user = json.loads(value)
+        except ValueError:
+            return False
+
+        return tuple(user) if user else None
+
+    def set(self, username, user):
+        if user is None:
+            if self.negative_ttl > 0:
+                self.cache.set("user\0" + username, b"null", self.negative_ttl)
+        else:
+            value = json.dumps(list(user)).encode()
+            self.cache.set("user\0" + username, value, self.ttl)
+
+    def lookup(self, plugin, params):
+        """Like plugin.lookup(params), through the cache."""
+
+        username = params["username"]
+        user = self.get(username)
+        if user is False:
+            try:
+                user = plugin.lookup_user(params)
+            except NotImplementedError:
+                # Only lookup() knows how to switch users
+                return plugin.lookup(params)
+
+            self.set(username, user)
+
+        if user is None:
+            return None
+
+        home, uid, gid = user
+        plugin.switch_user(uid, gid)
+        return home
+
+
+def get_user_cache(config, log=None):
+    """Return the UserCache configured in [main], or None."""
+
+    path = config.get("main", "userdb_cache", "")
+    if not path:
+        return None
+
+    # Readable only by the user that fills it
+    cache = FileCache(
+        path,
+        config.getint("main", "userdb_cache_size", 10000),
+        log,
+        mode=0o600,
+    )
+
+    return UserCache(
+        cache,
+        config.getint("main", "userdb_cache_ttl", 3600),
+        config.getint("main", "userdb_cache_negative_ttl", 60),
+    )
@@ -0,0 +1,217 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import hashlib
+import json
+import os
+import socket
+import time
+
+from pysieved import metrics
+
+# Stands for the script's file name in cached error messages
+SCRIPT = "<script>"
+
+# sieve_has_error(basedir, script) functions check the file script and
+# keep any file of their own next to it.  basedir only tells whose
+# script it is: the directory of the user's scripts, which may not
+# exist yet, or their name.
+
+# The plugins' own sieve_has_error functions, by name, for validatord
+validators = {}
+
+
+class Transient(str):
+    """An error message that says nothing about the script itself"""
+
+
+class TimedValidator:
+    """Time the runs of a sieve_has_error function, for the metrics"""
+
+    def __init__(self, name, sieve_has_error):
+        self.name = name
+        self.sieve_has_error = sieve_has_error
+
+    def __call__(self, basedir, script):
+        start = time.perf_counter()
+        try:
+            return self.sieve_has_error(basedir, script)
+        finally:
+            metrics.since("pysieved_validator_duration_seconds", start, self.name)
+
+
+class CachedValidator:
+    """Remember the verdict of a sieve_has_error function.
+
+    Verdicts are keyed by the SHA-256 of the script, the validator's
+    name and program, and the program's mtime and size, so that
+    upgrading the validator starts afresh.  The script's temporary file
+    name is taken out of cached error messages.
+
+    """
+
+    def __init__(self, cache, name, program, sieve_has_error):
+        self.cache = cache
+        self.name = name
+        self.program = program
+        self.sieve_has_error = sieve_has_error
+
+    def key(self, script):
+        try:
+            st = os.stat(self.program)
+        except OSError:
+            # Not a plain path, we can't tell its version
+            return None
+
+        digest = hashlib.sha256()
+        with open(script, "rb") as f:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                digest.update(chunk)
+
+        return "%s\0%s\0%d\0%d\0%s" % (
+            self.name,
+            self.program,
+            st.st_mtime_ns,
+            st.st_size,
+            digest.hexdigest(),
+        )
+
+    def __call__(self, basedir, script):
+        key = self.key(script)
+        if key is None:
+            return self.sieve_has_error(basedir, script)
+
+        verdict = self.cache.get(key)
+        if verdict is not None:
+            if not verdict:
+                return None
+            return verdict.decode().replace(SCRIPT, script)
+
+        err_str = self.sieve_has_error(basedir, script)
+        if err_str is None:
+            self.cache.set(key, b"")
+            return None
+        elif isinstance(err_str, Transient):
+            return err_str
+
+        if isinstance(err_str, bytes):
+            err_str = err_str.decode(errors="replace")
+
+        # An empty message must still read as an error
+        err_str = err_str or "Invalid script"
+        self.cache.set(key, err_str.replace(script, SCRIPT).encode())
+
+        return err_str
+
+
+class RemoteValidator:
+    """Have the validator daemon (validatord) check scripts.
+
+    The daemon limits how many validators run at once.  If it can't be
+    reached, scripts are validated in this process.
+
+    """
+
+    def __init__(self, path, name, sieve_has_error, timeout, log=None):
+        self.path = path
+        self.name = name
+        self.sieve_has_error = sieve_has_error
+        self.timeout = timeout
+        self.log = log or (lambda level, message: None)
+
+    def request(self, header, data=b""):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(header).encode() + b"\n" + data)
+
+            reply = b""
+            while not reply.endswith(b"\n"):
+                r = sock.recv(4096)
+                if not r:
+                    raise ConnectionError("Validator daemon hung up")
+                reply += r
+
+        return json.loads(reply)
+
+    def stats(self):
+        return self.request({"stats": True})
+
+    def __call__(self, basedir, script):
+        with open(script, "rb") as f:
+            data = f.read()
+
+        header = {"validator": self.name, "user": basedir, "size": len(data)}
+        try:
+            reply = self.request(header, data)
+        except socket.timeout:
+            return Transient("Validation timed out")
+        except (OSError, ValueError) as error:
+            self.log(1, "Validator daemon unavailable (%s), validating here" % error)
+            return self.sieve_has_error(basedir, script)
+
+        error = reply.get("error")
+        if error is None:
+            return None
+        elif reply.get("transient"):
+            return Transient(error)
+
+        return error.replace(SCRIPT, script)
+
+
+def wrap_validator(config, name, program, sieve_has_error, log=None):
+    """Wrap sieve_has_error with the validator daemon and the cache.
+
+    Both are optional, as are the metrics, and sieve_has_error is
+    returned as is if none is configured.  With the daemon, only the
+    daemon uses the cache, so that its entries have a single owner.
+
+    """
+
+    if config.get("main", "metrics", ""):
+        sieve_has_error = TimedValidator(name, sieve_has_error)
+
+    cached = sieve_has_error
+    path = config.get("main", "validation_cache", "")
+    if path:
+        from pysieved.cache import FileCache
+
+        if isinstance(program, bytes):
+            program = program.decode()
+
+        cache = FileCache(
+            path,
+            config.getint("main", "validation_cache_size", 10000),
+            log,
+        )
+        cached = CachedValidator(cache, name, program, sieve_has_error)
+    validators[name] = cached
+
+    path = config.get("main", "validator_socket", "")
+    if not path:
+        return cached
+
+    # Waiting for a slot and running may each take validator_timeout
+    timeout = config.getint("main", "validator_timeout", 30)
+    return RemoteValidator(path, name, sieve_has_error, 2 * timeout + 5, log)
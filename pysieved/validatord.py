@@ -0,0 +1,369 @@
+#! /usr/bin/env python
+
+## pysieved - Python managesieve server
+## Copyright (C) 2007 Neale Pickett
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or (at
+## your option) any later version.
+
+## This program is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+## USA
+
+
+import asyncio
+import collections
+import grp
+import json
+import os
+import pwd
+import resource
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+from pysieved import validation
+from pysieved.managesieve import maxsize
+
+
+class Job:
+    def __init__(self, user, name, script):
+        self.user = user
+        self.name = name
+        self.script = script
+        self.queued = time.monotonic()
+        self.result = None
+
+
+class ValidatorDaemon:
+    """Validate scripts for every pysieved process, a few at a time.
+
+    Clients (see validation.RemoteValidator) connect to the Unix socket
+    `sock` and send one JSON line, followed by the script:
+
+        {"validator": "exim", "user": "/home/joe/.pysieved", "size": 42}
+
+    and get back {"error": null} or {"error": "message"}.  The request
+    {"stats": true} returns the counters of stats() instead.  Scripts
+    larger than `maxsize`, the PUTSCRIPT limit, are refused unread.
+
+    At most `slots` validators run at once.  Waiting jobs are queued per
+    user, and users take turns, so one user uploading in a loop can't
+    starve the others.  Each job runs in a forked child in its own
+    process group, limited to `cpu` seconds of CPU time and killed with
+    its compiler after `timeout` seconds.  Jobs that waited `timeout`
+    seconds for a slot are refused.
+
+    """
+
+    def __init__(
+        self, sock, validators, slots=4, cpu=10, timeout=30, log=None, maxsize=maxsize
+    ):
+        self.socket = sock
+        self.validators = validators
+        self.slots = max(1, slots)
+        self.cpu = cpu
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.log = log or (lambda level, message: None)
+
+        self.loop = None
+        self.queues = {}
+        self.ready = collections.deque()
+        self.running = 0
+        self.counters = collections.Counter()
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self._stop = None
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def serve_forever(self):
+        self._is_shut_down.clear()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self._shutdown_request = False
+            self.loop = None
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stop.set)
+
+        self._is_shut_down.wait()
+
+    async def serve(self):
+        self._stop = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.scratch = tempfile.mkdtemp(prefix="pysieved-validator-")
+
+        server = await asyncio.start_unix_server(
+            self.handle_client, sock=self.socket.dup()
+        )
+
+        try:
+            if not self._shutdown_request:
+                await self._stop.wait()
+        finally:
+            server.close()
+            shutil.rmtree(self.scratch, ignore_errors=True)
+
+    async def handle_client(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            size = request.get("size")
+            if request.get("stats"):
+                reply = self.stats()
+            elif not isinstance(size, int) or not 0 <= size <= self.maxsize:
+                self.counters["refused"] += 1
+                reply = {"error": "Script too large", "transient": False}
+            else:
+                script = await reader.readexactly(size)
+                job = Job(request.get("user", ""), request["validator"], script)
+                error = await self.submit(job)
+                reply = {
+                    "error": error,
+                    "transient": isinstance(error, validation.Transient),
+                }
+
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+        except (ValueError, KeyError, TypeError, asyncio.IncompleteReadError) as error:
+            self.log(1, "Bad validator request: %s" % error)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def submit(self, job):
+        if job.name not in self.validators:
+            return validation.Transient("No validator %r" % job.name)
+
+        job.result = self.loop.create_future()
+        if job.user not in self.queues:
+            self.queues[job.user] = collections.deque()
+            self.ready.append(job.user)
+        self.queues[job.user].append(job)
+
+        self.dispatch()
+        error = await job.result
+
+        latency = time.monotonic() - job.queued
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.counters["done"] += 1
+
+        return error
+
+    def dispatch(self):
+        while self.running < self.slots and self.ready:
+            # Round robin over the users with waiting jobs
+            user = self.ready.popleft()
+            queue = self.queues[user]
+            job = queue.popleft()
+            if queue:
+                self.ready.append(user)
+            else:
+                del self.queues[user]
+
+            if time.monotonic() - job.queued > self.timeout:
+                self.counters["refused"] += 1
+                job.result.set_result(
+                    validation.Transient("Server busy, try again later")
+                )
+                continue
+
+            self.running += 1
+            self.loop.create_task(self.run(job))
+
+    async def run(self, job):
+        workdir = tempfile.mkdtemp(dir=self.scratch)
+        try:
+            script = os.path.join(workdir, "script")
+            with open(script, "wb") as f:
+                f.write(job.script)
+
+            error = await self.run_child(job.name, workdir, script)
+            if error is not None and not isinstance(error, validation.Transient):
+                error = error.replace(script, validation.SCRIPT)
+            job.result.set_result(error)
+        except Exception as error:
+            self.counters["failed"] += 1
+            self.log(-1, "Validator %s failed: %s" % (job.name, error))
+            job.result.set_result(validation.Transient("Validation failed"))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            self.running -= 1
+            self.dispatch()
+
+    async def run_child(self, name, workdir, script):
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(r)
+            self.run_job(w, name, workdir, script)
+
+        os.close(w)
+        try:
+            # Set it from both sides, killpg() must not miss the child
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+
+        reader = asyncio.StreamReader()
+        transport, _ = await self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(r, "rb", 0)
+        )
+        try:
+            result = await asyncio.wait_for(reader.read(), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            result = None
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        finally:
+            transport.close()
+            await self.loop.run_in_executor(None, os.waitpid, pid, 0)
+
+        if result is None:
+            return validation.Transient("Validation timed out")
+        elif not result:
+            # Died without an answer, most likely on the CPU limit
+            self.counters["failed"] += 1
+            return validation.Transient("Validation failed")
+        elif result[:1] == b"0":
+            return None
+
+        return result[1:].decode(errors="replace") or "Invalid script"
+
+    def run_job(self, w, name, workdir, script):
+        status = 1
+        try:
+            os.setpgid(0, 0)
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            if self.cpu:
+                resource.setrlimit(resource.RLIMIT_CPU, (self.cpu, self.cpu))
+
+            error = self.validators[name](workdir, script)
+            if error is None:
+                result = b"0"
+            elif isinstance(error, bytes):
+                result = b"1" + error
+            else:
+                result = b"1" + error.encode()
+
+            with os.fdopen(w, "wb") as f:
+                f.write(result)
+            status = 0
+        finally:
+            os._exit(status)
+
+    def stats(self):
+        done = self.counters["done"]
+        return {
+            "slots": self.slots,
+            "running": self.running,
+            "queued": sum(len(q) for q in self.queues.values()),
+            "done": done,
+            "timeouts": self.counters["timeouts"],
+            "refused": self.counters["refused"],
+            "failed": self.counters["failed"],
+            "latency_avg_ms": round(1000 * self.latency_total / done, 1) if done else 0,
+            "latency_max_ms": round(1000 * self.latency_max, 1),
+        }
+
+
+def bind(path, group=None):
+    """Listen on path, for its owner and members of group only"""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock.bind(path)
+    if group:
+        os.chown(path, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(path, 0o660)
+    sock.listen(128)
+
+    return sock
+
+
+def drop_privileges(username):
+    pw = pwd.getpwnam(username)
+    os.setgroups([])
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+
+
+def spawn(config, log, server=None):
+    """Fork the validator daemon if validator_socket is configured.
+
+    The daemon validates with the plugins loaded so far, and exits with
+    the process that spawned it.
+
+    """
+
+    path = config.get("main", "validator_socket", "")
+    if not path:
+        return None
+
+    sock = bind(path, config.get("main", "validator_group", ""))
+    parent = os.getpid()
+
+    pid = os.fork()
+    if pid:
+        sock.close()
+        return pid
+
+    status = 1
+    try:
+        if server is not None:
+            server.socket.close()
+
+        if os.getuid() == 0:
+            drop_privileges(config.get("main", "validator_user", "nobody"))
+
+        daemon = ValidatorDaemon(
+            sock,
+            dict(validation.validators),
+            slots=config.getint("main", "validator_slots", 4),
+            cpu=config.getint("main", "validator_cpu", 10),
+            timeout=config.getint("main", "validator_timeout", 30),
+            log=log,
+        )
+
+        def watch_parent():
+            while os.getppid() == parent:
+                time.sleep(5)
+            daemon.shutdown()
+
+        threading.Thread(target=watch_parent, daemon=True).start()
+
+        log(1, "Validator daemon listening on %s" % path)
+        daemon.serve_forever()
+        status = 0
+    finally:
+        os._exit(status)
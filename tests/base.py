@@ -213,6 +213,12 @@ class MockClient:
         command = f'DELETESCRIPT "{name}"\r\n'
         return self._send(command.encode())
 
+    def renamescript(self, old: str, new: str) -> bytes:
+        """Send a RENAMESCRIPT command."""
+
+        command = f'RENAMESCRIPT "{old}" "{new}"\r\n'
+        return self._send(command.encode())
+
     def logout(self) -> bytes | None:
         """Send a LOGOUT command."""
 
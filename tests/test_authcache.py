@@ -0,0 +1,66 @@
+import base64
+import os
+import tempfile
+from unittest import TestCase
+
+from base import MockConfig
+
+from pysieved.authcache import get_auth_cache
+
+
+def plain(username: str, password: str) -> str:
+    return base64.b64encode(f"\0{username}\0{password}".encode()).decode()
+
+
+class AuthCacheTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        config = MockConfig({"main": {"auth_cache": self.tmp.name}})
+        self.cache = get_auth_cache(config)
+
+    def test_cached_login(self) -> None:
+        """Test that a successful login is remembered."""
+
+        args = (plain("test", "12345"),)
+        self.assertIsNone(self.cache.lookup("PLAIN", args))
+
+        self.cache.succeeded("PLAIN", args, "test")
+        self.assertEqual(self.cache.lookup("plain", args), "test")
+        self.assertIsNone(self.cache.lookup("PLAIN", (plain("test", "54321"),)))
+
+    def test_no_plaintext(self) -> None:
+        """Test that credentials are not stored in the clear."""
+
+        self.cache.succeeded("PLAIN", (plain("test", "12345"),), "test")
+
+        for name in os.listdir(self.tmp.name):
+            with open(os.path.join(self.tmp.name, name), "rb") as f:
+                content = f.read()
+            self.assertNotIn(b"12345", content)
+            self.assertNotIn(plain("test", "12345").encode(), content)
+
+    def test_failed_login(self) -> None:
+        """Test that a failed login forgets the user's logins."""
+
+        args = (plain("test", "12345"),)
+        self.cache.succeeded("PLAIN", args, "test")
+        self.cache.succeeded("PLAIN", (plain("other", "12345"),), "other")
+
+        self.cache.failed("PLAIN", (plain("test", "wrong"),))
+        self.assertIsNone(self.cache.lookup("PLAIN", args))
+        self.assertEqual(
+            self.cache.lookup("PLAIN", (plain("other", "12345"),)), "other"
+        )
+
+        self.cache.succeeded("PLAIN", args, "test")
+        self.assertEqual(self.cache.lookup("PLAIN", args), "test")
+
+    def test_not_cacheable(self) -> None:
+        """Test that multi-step exchanges are not cached."""
+
+        self.cache.succeeded("PLAIN", (), "test")
+        self.cache.succeeded("LOGIN", ("dGVzdA==",), "test")
+        self.assertIsNone(self.cache.lookup("PLAIN", ()))
+        self.assertIsNone(self.cache.lookup("LOGIN", ("dGVzdA==",)))
@@ -0,0 +1,117 @@
+import base64
+import os
+import socketserver
+import tempfile
+import threading
+from unittest import TestCase
+
+from base import MockConfig
+
+from pysieved.plugins import dovecot
+
+
+class MockDovecot(socketserver.StreamRequestHandler):
+    """Just enough of Dovecot's auth and auth-master protocols"""
+
+    def handle(self):
+        self.server.connections += 1
+
+        if self.server.channel == "auth":
+            # Greeting lines arrive in pieces, like they may from Dovecot
+            self.wfile.write(b"VERSION\t1\t2\nMECH\tPL")
+            self.wfile.flush()
+            self.wfile.write(b"AIN\tplaintext\nSPID\t1\nCUID\t1\nDONE\n")
+        else:
+            self.wfile.write(b"VERSION\t1\t0\n")
+
+        for line in self.rfile:
+            parts = line.decode().rstrip("\n").split("\t")
+            if parts[0] == "AUTH":
+                resp = [p[5:] for p in parts if p.startswith("resp=")][0]
+                _, user, password = base64.b64decode(resp).decode().split("\0")
+                if password == "12345":
+                    reply = f"OK\t{parts[1]}\tuser={user}\n"
+                else:
+                    reply = f"FAIL\t{parts[1]}\tuser={user}\n"
+            elif parts[0] == "USER":
+                reply = f"USER\t{parts[1]}\t{parts[2]}\thome=/home/{parts[2]}\n"
+            else:
+                continue
+
+            # Merge an unrelated line into the reply
+            self.wfile.write(b"NOTICE\t0\n" + reply.encode())
+
+
+class MockDovecotServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, channel):
+        super().__init__(path, MockDovecot)
+        self.channel = channel
+        self.connections = 0
+
+
+class DovecotTest(TestCase):
+    hub = False
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.servers = {}
+        for channel in ("auth", "master"):
+            server = MockDovecotServer(os.path.join(self.tmp.name, channel), channel)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            self.addCleanup(thread.join)
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            self.servers[channel] = server
+
+        self.config = MockConfig(
+            {
+                "Dovecot": {
+                    "mux": self.servers["auth"].server_address,
+                    "master": self.servers["master"].server_address,
+                    "hub": self.hub,
+                }
+            }
+        )
+
+    def plugin(self) -> dovecot.PysievedPlugin:
+        plugin = dovecot.PysievedPlugin(lambda level, message: None, self.config)
+        if dovecot.hub is not None:
+            self.addCleanup(self.stop_hub)
+
+        return plugin
+
+    def stop_hub(self) -> None:
+        hub, dovecot.hub = dovecot.hub, None
+        if hub is not None:
+            hub.control.close()
+            os.waitpid(hub.pid, 0)
+
+    def test_auth(self) -> None:
+        """Test logins and lookups."""
+
+        plugin = self.plugin()
+        self.assertIn("PLAIN", plugin.mechanisms())
+        self.assertTrue(plugin.auth({"username": "test", "password": "12345"}))
+        self.assertFalse(plugin.auth({"username": "test", "password": "54321"}))
+        self.assertEqual(plugin.lookup({"username": "test"}), "/home/test")
+
+    def test_sessions(self) -> None:
+        """Test several sessions, each with its own plugin instance."""
+
+        for _ in range(3):
+            plugin = self.plugin()
+            self.assertTrue(plugin.auth({"username": "test", "password": "12345"}))
+            self.assertEqual(plugin.lookup({"username": "test"}), "/home/test")
+
+        expected = 1 if self.hub else 3
+        self.assertEqual(self.servers["auth"].connections, expected)
+        self.assertEqual(self.servers["master"].connections, expected)
+
+
+class DovecotHubTest(DovecotTest):
+    hub = True
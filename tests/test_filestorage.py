@@ -0,0 +1,236 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from pysieved.blobs import BlobStore
+from pysieved.plugins.FileStorage import FileStorage
+
+
+def no_error(basedir, script):
+    return None
+
+
+class FileStorageTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.home = self.tmp.name
+
+    def storage(self) -> FileStorage:
+        storage = FileStorage(no_error, ".pysieved", ".dovecot.sieve", self.home)
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_scripts(self) -> None:
+        """Test storing, listing and activating scripts."""
+
+        storage = self.storage()
+        storage["one"] = b"keep;\n"
+        storage["two/2"] = b"discard;\n"
+
+        self.assertEqual(sorted(storage), ["one", "two/2"])
+        self.assertEqual(storage["two/2"], b"discard;\n")
+        self.assertIsNone(storage.active_name())
+
+        storage.set_active("two/2")
+        self.assertEqual(storage.active_name(), "two/2")
+        self.assertTrue(storage.is_active("two/2"))
+        self.assertFalse(storage.is_active("one"))
+        self.assertRaises(KeyError, storage.is_active, "three")
+        self.assertRaises(ValueError, storage.__delitem__, "two/2")
+
+        storage.set_active(None)
+        self.assertIsNone(storage.active_name())
+        del storage["two/2"]
+        self.assertEqual(list(storage), ["one"])
+
+    def test_not_a_file(self) -> None:
+        """Test that directories aren't served as scripts."""
+
+        storage = self.storage()
+        storage["one"] = b"keep;\n"
+        os.mkdir(os.path.join(self.home, ".pysieved", "sub"))
+
+        for name in [".", "..", "sub"]:
+            self.assertRaises(KeyError, storage.__getitem__, name)
+            self.assertRaises(KeyError, storage.open_script, name)
+
+    def test_rename(self) -> None:
+        """Test renaming scripts without validating them again."""
+
+        validated = []
+        storage = FileStorage(
+            lambda basedir, script: validated.append(script),
+            ".pysieved",
+            ".dovecot.sieve",
+            self.home,
+        )
+        self.addCleanup(storage.close)
+        storage["one"] = b"keep;\n"
+        storage["two"] = b"discard;\n"
+        storage.set_active("one")
+        inode = os.stat(os.path.join(self.home, ".pysieved", "one")).st_ino
+
+        storage.rename("one", "a/b")
+        self.assertEqual(sorted(storage), ["a/b", "two"])
+        self.assertEqual(storage.active_name(), "a/b")
+        self.assertEqual(
+            os.stat(os.path.join(self.home, ".dovecot.sieve")).st_ino, inode
+        )
+        self.assertEqual(len(validated), 2)
+        self.assertEqual(
+            os.stat(os.path.join(self.home, ".dovecot.sieve")).st_nlink, 1
+        )
+
+        self.assertRaises(FileExistsError, storage.rename, "a/b", "two")
+        self.assertEqual(storage["two"], b"discard;\n")
+        self.assertRaises(KeyError, storage.rename, "one", "three")
+
+        # Only the active script's link changes
+        storage.rename("two", "three")
+        self.assertEqual(storage.active_name(), "a/b")
+        self.assertEqual(sorted(os.listdir(self.home)), [".dovecot.sieve", ".pysieved"])
+
+    def test_check(self) -> None:
+        """Test that checking a script leaves the home directory alone."""
+
+        scratch = os.path.join(self.tmp.name, "scratch")
+        os.mkdir(scratch)
+        checked = []
+
+        def sieve_test(basedir, script):
+            with open(script, "rb") as f:
+                checked.append((basedir, os.path.dirname(script), f.read()))
+            return "line 1: error" if checked[-1][2] == b"bad" else None
+
+        storage = FileStorage(
+            sieve_test, ".pysieved", ".dovecot.sieve", self.home, scratch=scratch
+        )
+        self.addCleanup(storage.close)
+
+        storage.check(b"keep;\n")
+        self.assertRaisesRegex(ValueError, "line 1", storage.check, b"bad")
+
+        basedir = storage.basedir
+        self.assertEqual(
+            checked, [(basedir, scratch, b"keep;\n"), (basedir, scratch, b"bad")]
+        )
+        self.assertEqual(sorted(os.listdir(self.home)), ["scratch"])
+        self.assertEqual(os.listdir(scratch), [])
+
+    def test_absolute_link(self) -> None:
+        """Test an active symlink set up by something else."""
+
+        storage = self.storage()
+        storage["one"] = b"keep;\n"
+        os.symlink(
+            os.path.join(self.home, ".pysieved", "one"),
+            os.path.join(self.home, ".dovecot.sieve"),
+        )
+
+        self.assertEqual(storage.active_name(), "one")
+
+    def test_dangling_link(self) -> None:
+        """Test an active symlink to a script that's gone."""
+
+        storage = self.storage()
+        os.symlink(".pysieved/gone", os.path.join(self.home, ".dovecot.sieve"))
+
+        self.assertIsNone(storage.active_name())
+
+    def test_adopt_active(self) -> None:
+        """Test that an existing active script becomes a stored one."""
+
+        with open(os.path.join(self.home, ".dovecot.sieve"), "wb") as f:
+            f.write(b"keep;\n")
+
+        storage = self.storage()
+        self.assertEqual(list(storage), ["dovecot"])
+        self.assertEqual(storage.active_name(), "dovecot")
+        self.assertEqual(storage["dovecot"], b"keep;\n")
+
+    def test_lazy_directory(self) -> None:
+        """Test that the scripts directory is only created by a write."""
+
+        storage = self.storage()
+        self.assertEqual(list(storage), [])
+        self.assertIsNone(storage.active_name())
+        self.assertFalse(storage.has_key("one"))
+        self.assertRaises(KeyError, storage.open_script, "one")
+        self.assertRaises(KeyError, storage.__delitem__, "one")
+        storage.set_active(None)
+        self.assertFalse(os.path.exists(os.path.join(self.home, ".pysieved")))
+
+        storage["one"] = b"keep;\n"
+        self.assertEqual(list(storage), ["one"])
+
+    def test_migrated_once(self) -> None:
+        """Test that the active file is only looked at until migrated."""
+
+        self.storage()["one"] = b"keep;\n"
+
+        # Put there after the first session
+        with open(os.path.join(self.home, ".dovecot.sieve"), "wb") as f:
+            f.write(b"keep;\n")
+
+        storage = self.storage()
+        self.assertEqual(list(storage), ["one"])
+        self.assertIsNone(storage.active_name())
+
+
+class BlobStoreTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.blobs = BlobStore(os.path.join(self.tmp.name, "blobs"))
+        self.validated = []
+
+    def sieve_test(self, basedir: str, script: str) -> None:
+        with open(script, "rb") as f:
+            self.validated.append(f.read())
+        return None
+
+    def storage(self, username: str) -> FileStorage:
+        home = os.path.join(self.tmp.name, username)
+        os.makedirs(home, exist_ok=True)
+        storage = FileStorage(
+            self.sieve_test, ".pysieved", ".dovecot.sieve", home, self.blobs
+        )
+        self.addCleanup(storage.close)
+        return storage
+
+    def inode(self, username: str, name: str) -> int:
+        return os.stat(os.path.join(self.tmp.name, username, ".pysieved", name)).st_ino
+
+    def test_shared_body(self) -> None:
+        """Test that a known body is linked, not validated again."""
+
+        self.storage("one")["script"] = b"keep;\n"
+        self.storage("two")["script"] = b"keep;\n"
+
+        upload = self.storage("three").begin_upload()
+        upload.write(b"keep;\n")
+        self.storage("three").finish_upload("other", upload)
+
+        self.assertEqual(self.validated, [b"keep;\n"])
+        self.assertEqual(self.inode("one", "script"), self.inode("two", "script"))
+        self.assertEqual(self.inode("one", "script"), self.inode("three", "other"))
+        self.assertEqual(self.storage("three")["other"], b"keep;\n")
+
+        self.storage("two")["script"] = b"discard;\n"
+        self.assertEqual(self.validated, [b"keep;\n", b"discard;\n"])
+        self.assertEqual(self.storage("one")["script"], b"keep;\n")
+
+    def test_collect(self) -> None:
+        """Test that only blobs nobody links to are collected."""
+
+        self.storage("one")["keep"] = b"keep;\n"
+        self.storage("one")["discard"] = b"discard;\n"
+        self.assertEqual(self.blobs.collect(), 0)
+
+        del self.storage("one")["discard"]
+        self.assertEqual(self.blobs.collect(), 1)
+
+        self.storage("two")["discard"] = b"discard;\n"
+        self.assertEqual(self.validated, [b"keep;\n", b"discard;\n", b"discard;\n"])
@@ -0,0 +1,150 @@
+import crypt
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from base import MockConfig
+
+from pysieved.plugins import htpasswd
+
+
+class HtpasswdTest(TestCase):
+    extra_configuration = {}
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.passfile = os.path.join(self.tmp.name, "passwd")
+
+        self.hash = crypt.crypt("12345", crypt.mksalt(crypt.METHOD_SHA512))
+        users = ["user%05d:%s" % (i, self.hash) for i in range(0, 2000, 2)]
+        self.write(users + ["test:%s" % self.hash])
+
+        self.addCleanup(self.close)
+
+    def close(self) -> None:
+        passwd = htpasswd.tables.pop(self.passfile, None)
+        if passwd is not None:
+            passwd.close()
+
+    def write(self, lines: list[str]) -> None:
+        # Through a new file, like htpasswd does
+        with open(self.passfile + ".new", "w") as file:
+            file.write("".join(line + "\n" for line in sorted(lines)))
+        os.rename(self.passfile + ".new", self.passfile)
+
+    def plugin(self) -> htpasswd.PysievedPlugin:
+        configuration = {"passwdfile": self.passfile, "reload_interval": 0.05}
+        configuration.update(self.extra_configuration)
+        return htpasswd.PysievedPlugin(
+            lambda level, message: None, MockConfig({"htpasswd": configuration})
+        )
+
+    def wait_for_reload(self, plugin: htpasswd.PysievedPlugin) -> None:
+        deadline = time.monotonic() + 5
+        while plugin.passwd.thread and plugin.passwd.signature != plugin.passwd.stat():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_auth(self) -> None:
+        """Test logins against the password file."""
+
+        plugin = self.plugin()
+        self.assertTrue(plugin.auth({"username": "test", "password": "12345"}))
+        self.assertTrue(plugin.auth({"username": "user01998", "password": "12345"}))
+        self.assertFalse(plugin.auth({"username": "test", "password": "54321"}))
+        self.assertFalse(plugin.auth({"username": "user01999", "password": "12345"}))
+        self.assertFalse(plugin.auth({"username": "", "password": "12345"}))
+
+    def test_reload(self) -> None:
+        """Test that users added and removed are seen without a restart."""
+
+        plugin = self.plugin()
+        self.write(["new:%s" % self.hash])
+        self.wait_for_reload(plugin)
+
+        self.assertTrue(plugin.auth({"username": "new", "password": "12345"}))
+        self.assertFalse(plugin.auth({"username": "test", "password": "12345"}))
+
+    def test_shared(self) -> None:
+        """Test that instances in a process share the table."""
+
+        self.assertIs(self.plugin().passwd, self.plugin().passwd)
+
+    def test_forked_child(self) -> None:
+        """Test that a forked child watches the file with its own thread."""
+
+        plugin = self.plugin()
+        self.assertTrue(plugin.auth({"username": "test", "password": "12345"}))
+        self.assertTrue(plugin.passwd.thread.is_alive())
+
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                self.write(["new:%s" % self.hash])
+                ok = plugin.auth({"username": "new", "password": "12345"})
+                watched = plugin.passwd.thread.is_alive()
+
+                self.write(["other:%s" % self.hash])
+                self.wait_for_reload(plugin)
+                table = plugin.passwd.table
+                ok = ok and plugin.auth({"username": "other", "password": "12345"})
+                status = 0 if ok and watched and plugin.passwd.table is table else 1
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_crypt_cache(self) -> None:
+        """Test that a successful crypt() check is remembered."""
+
+        calls = []
+
+        def counting_crypt(password, salt):
+            calls.append(password)
+            return crypt.crypt(password, salt)
+
+        plugin = self.plugin()
+        htpasswd.crypt, saved = counting_crypt, htpasswd.crypt
+        try:
+            for _ in range(3):
+                self.assertTrue(plugin.auth({"username": "test", "password": "12345"}))
+                self.assertFalse(plugin.auth({"username": "test", "password": "54321"}))
+        finally:
+            htpasswd.crypt = saved
+
+        self.assertEqual(calls, ["12345", "54321", "54321", "54321"])
+
+
+class IndexedHtpasswdTest(HtpasswdTest):
+    extra_configuration = {"indexed": True}
+
+    def test_forked_child(self) -> None:
+        """Indexed files are mapped again in any process."""
+
+    def test_search(self) -> None:
+        """Test the binary search on every name around the ones present."""
+
+        plugin = self.plugin()
+        for i in range(2000):
+            cpass = plugin.passwd.get(b"user%05d" % i)
+            self.assertEqual(cpass, self.hash.encode() if i % 2 == 0 else None)
+        self.assertIsNone(plugin.passwd.get(b"zzz"))
+        self.assertIsNone(plugin.passwd.get(b"a"))
+
+        self.assertIsNone(htpasswd.search(b"", b"test"))
+
+    def test_search_prefixes(self) -> None:
+        """Test names that are prefixes of each other, in LC_ALL=C order."""
+
+        names = [b"alice", b"bo", b"bob.smith", b"bob2", b"bob", b"carol"]
+        data = b"".join(sorted(b"%s:hash-%s\n" % (name, name) for name in names))
+        self.assertEqual([line.split(b":")[0] for line in data.splitlines()], names)
+
+        for name in names:
+            self.assertEqual(htpasswd.search(data, name), b"hash-" + name)
+        for name in [b"b", b"bob.", b"bob1", b"bobby", b"carl"]:
+            self.assertIsNone(htpasswd.search(data, name))
@@ -0,0 +1,146 @@
+import logging
+import os
+import signal
+import tempfile
+import time
+from logging.handlers import WatchedFileHandler
+from unittest import TestCase
+
+from pysieved import logwriter, main
+
+
+class Unprintable:
+    def __repr__(self):
+        raise AssertionError("Formatted a disabled message")
+
+
+class LogTest(TestCase):
+    def test_lazy(self) -> None:
+        """Test that arguments of disabled levels are not formatted."""
+
+        verbosity = main.VERBOSITY
+        self.addCleanup(setattr, main, "VERBOSITY", verbosity)
+        main.VERBOSITY = 1
+
+        main.log(3, "S: %r", Unprintable())
+
+
+class LogWriterTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "pysieved.log")
+
+        self.logger = logging.getLogger("pysieved.test_logwriter")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+        handler = WatchedFileHandler(self.path)
+        handler.setFormatter(logging.Formatter("[%(process)d] %(message)s"))
+        self.logger.addHandler(handler)
+        self.pid = logwriter.spawn(handler, self.logger)
+
+    def stop(self) -> None:
+        """Close the sending end and wait for the writer to finish."""
+
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+        _, status = os.waitpid(self.pid, 0)
+        self.assertEqual(status, 0)
+
+    def read(self, path=None) -> list:
+        with open(path or self.path) as f:
+            return f.read().splitlines()
+
+    def test_records(self) -> None:
+        """Test that records of every process end up in the log file."""
+
+        self.logger.info("from %s", "parent")
+
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                for i in range(100):
+                    self.logger.info("from child %d", i)
+                self.logger.handlers[0].close()
+                status = 0
+            finally:
+                os._exit(status)
+
+        os.waitpid(pid, 0)
+        self.stop()
+
+        lines = self.read()
+        self.assertEqual(lines[0], "[%d] from parent" % os.getpid())
+        self.assertEqual(self.count(lines[1:]), 100)
+
+    def count(self, lines) -> int:
+        """Count the records in lines, dropped ones included."""
+
+        n = 0
+        for line in lines:
+            if line.endswith(" log records dropped"):
+                n += int(line.split()[-4])
+            else:
+                n += 1
+        return n
+
+    def test_dropped(self) -> None:
+        """Test that records are dropped and counted while the writer lags."""
+
+        (sender,) = self.logger.handlers
+
+        # Until the socket buffer is full, and then some
+        os.kill(self.pid, signal.SIGSTOP)
+        try:
+            sent = 0
+            while sender.dropped < 10 and sent < 100000:
+                self.logger.info("record %d", sent)
+                sent += 1
+        finally:
+            os.kill(self.pid, signal.SIGCONT)
+
+        self.assertEqual(sender.dropped, 10)
+
+        # Let the writer catch up
+        for _ in range(200):
+            if len(self.read()) == sent - 10:
+                break
+            time.sleep(0.01)
+
+        self.logger.info("after")
+        self.stop()
+
+        lines = self.read()
+        self.assertEqual(lines[-1][-5:], "after")
+        self.assertTrue(lines[-2].endswith(" 10 log records dropped"))
+        self.assertEqual(self.count(lines), sent + 1)
+
+    def test_long_record(self) -> None:
+        """Test that a record too long for one message is cut."""
+
+        self.logger.info("x" * logwriter.maxrecord)
+        self.stop()
+
+        lines = self.read()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" ..."))
+
+    def test_rotation(self) -> None:
+        """Test that the writer reopens a rotated log file."""
+
+        self.logger.info("before")
+        for _ in range(100):
+            if os.path.getsize(self.path):
+                break
+            time.sleep(0.01)
+        os.rename(self.path, self.path + ".1")
+
+        self.logger.info("after")
+        self.stop()
+
+        self.assertEqual(self.read(self.path + ".1")[-1][-6:], "before")
+        self.assertEqual(self.read()[-1][-5:], "after")
@@ -1,3 +1,4 @@
+import os
 import warnings
 from pathlib import Path
 from threading import Thread
@@ -76,6 +77,102 @@ class AuthenticateTest(TestCase):
         expected_response = b'NO "Bad username or password"\r\n'
         self.assertEqual(response, expected_response)
 
+    def test_authenticate_literal_too_large(self) -> None:
+        """Test that a huge SASL continuation literal is refused unread."""
+
+        self.server.RequestHandlerClass.do_sasl_first = lambda self, *args: {
+            "result": "CONT",
+            "msg": "",
+        }
+
+        # Sessions are forked at connect time
+        client = MockClient(self.server)
+        self.addCleanup(client.close)
+        client.get_full_response()
+
+        response = client._send(b'AUTHENTICATE "PLAIN"\r\n')
+        self.assertEqual(response, b"{0}\r\n\r\n")
+
+        response = client._send(b"{1500000000+}\r\n")
+        self.assertEqual(response, b'BYE "Literal too large"\r\n')
+
+
+class CapabilityBannerTest(TestCase):
+    def test_greeting_without_auth_backend(self) -> None:
+        """Test that the greeting is sent without asking the auth plugin."""
+
+        handler = get_handler(MockOptions(), MockConfig(DEFAULT_CONFIG))
+
+        def list_mech(self):
+            raise RuntimeError("Auth plugin asked for mechanisms")
+
+        handler.list_mech = list_mech
+
+        server = Server((MockOptions.bindaddr, MockOptions.port), handler)
+        t = Thread(target=server.serve_forever)
+        t.start()
+        try:
+            client = MockClient(server)
+            greeting = client.get_full_response()
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            t.join()
+
+        self.assertEqual(greeting, handler.banners[False, False])
+        self.assertTrue(greeting.endswith(b"\r\nOK\r\n"))
+
+
+class CheckScriptTest(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        options = MockOptions()
+        handler = get_handler(options, MockConfig(DEFAULT_CONFIG))
+
+        # Scripts containing "bad" don't validate
+        def sieve_test(basedir, script):
+            with open(script, "rb") as f:
+                content = f.read()
+            return "Bad script" if b"bad" in content else None
+
+        new_storage = handler.new_storage
+
+        def stub_storage(session, homedir):
+            storage = new_storage(session, homedir)
+            storage.sieve_test = sieve_test
+            return storage
+
+        handler.new_storage = stub_storage
+
+        self.server = Server((options.bindaddr, options.port), handler)
+        self._t = Thread(target=self.server.serve_forever)
+        self._t.start()
+        self.addCleanup(self._t.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.fs = MockFilesystem(options.base, "test")
+        self.client = MockClient(self.server)
+        self.addCleanup(self.client.close)
+        self.client.get_full_response()
+        self.client.authenticate("test", "12345")
+
+    def checkscript(self, content: bytes) -> bytes:
+        command = b"CHECKSCRIPT {%d+}\r\n%s\r\n" % (len(content), content)
+        return self.client._send(command)
+
+    def test_checkscript(self) -> None:
+        """Test CHECKSCRIPT verdicts, and that no script is left behind."""
+
+        before = sorted(os.listdir(self.fs.filters))
+
+        self.assertEqual(self.checkscript(b"keep;\n"), b"OK\r\n")
+        self.assertEqual(self.checkscript(b"bad;\n"), b'NO "Bad script"\r\n')
+
+        self.assertEqual(sorted(os.listdir(self.fs.filters)), before)
+
 
 class ManagesieveTest(TestCase):
     @classmethod
@@ -148,7 +245,17 @@ class ManagesieveTest(TestCase):
         self.assertEqual(lines[0], b'"IMPLEMENTATION" "pysieved 1.0"')
         self.assertEqual(lines[1], b'"SASL" "PLAIN"')
         self.assertEqual(lines[2], expected_sieve)
-        self.assertEqual(lines[3], b"OK")
+        self.assertEqual(lines[3], b'"VERSION" "1.0"')
+        self.assertEqual(lines[4], b"OK")
+
+    def test_noop(self) -> None:
+        """Test the NOOP command, with and without a tag."""
+
+        self.assertEqual(self.client._send(b"NOOP\r\n"), b'OK "Done"\r\n')
+        self.assertEqual(
+            self.client._send(b'NOOP "STARTTLS-SYNC-42"\r\n'),
+            b'OK (TAG "STARTTLS-SYNC-42") "Done"\r\n',
+        )
 
     def test_havespace(self) -> None:
         """Test a valid HAVESPACE command."""
@@ -195,6 +302,34 @@ class ManagesieveTest(TestCase):
         removed = self.fs.remove_filter(filter_name)
         self.assertTrue(removed)
 
+    def test_putscript_too_large(self) -> None:
+        """Test a PUTSCRIPT command with a literal over the size limit."""
+
+        self.client.authenticate(self.username, self.password)
+
+        filter_name = "putscript_too_large"
+
+        response = self.client.putscript(filter_name, b"#" * 200_000)
+        self.assertEqual(response, b'NO (QUOTA/MAXSIZE) "Literal too large"\r\n')
+        self.assertFalse(self.fs.has_filter(filter_name))
+
+        # The literal was skipped, the session goes on
+        response = self.client.havespace(filter_name, 1)
+        self.assertEqual(response, self.OK)
+
+    def test_literal_in_pieces(self) -> None:
+        """Test a literal larger than the input buffer, sent in pieces."""
+
+        self.client.authenticate(self.username, self.password)
+
+        name = b"n" * 80_000
+        self.client.conn.sendall(b"DELETESCRIPT {%d+}\r\n" % len(name))
+        for i in range(0, len(name), 7_000):
+            self.client.conn.sendall(name[i : i + 7_000])
+        response = self.client._send(b"\r\n")
+        self.assertTrue(response.startswith(b"NO "), response)
+        self.assertTrue(self.client.listscripts().endswith(self.OK))
+
     def test_setactive(self) -> None:
         """Test the SETACTIVE command on the test script."""
 
@@ -253,6 +388,10 @@ class ManagesieveTest(TestCase):
         response = self.client.getscript("does-not-exist")
         self.assertEqual(response, b'NO "No script by that name"\r\n')
 
+        for name in [".", ".."]:
+            response = self.client.getscript(name)
+            self.assertEqual(response, b'NO "No script by that name"\r\n')
+
     def test_deletescript(self) -> None:
         """Test the DELETESCRIPT command on a valid filter."""
 
@@ -269,6 +408,36 @@ class ManagesieveTest(TestCase):
         self.fs.create_filter(self.filter_name, self.filter_content)
         self.client.setactive(self.filter_name)
 
+    def test_renamescript(self) -> None:
+        """Test the RENAMESCRIPT command on the active script."""
+
+        self.client.authenticate(self.username, self.password)
+        self.client.setactive(self.filter_name)
+
+        response = self.client.renamescript(self.filter_name, "renamed")
+        self.assertEqual(response, self.OK)
+
+        filters = self.client.listscripts()
+        self.assertIn(b'"renamed" ACTIVE\r\n', filters)
+        self.assertFalse(self.fs.has_filter(self.filter_name))
+
+        # Rename back for other tests
+        response = self.client.renamescript("renamed", self.filter_name)
+        self.assertEqual(response, self.OK)
+
+    def test_renamescript_errors(self) -> None:
+        """Test RENAMESCRIPT with a missing script and an existing name."""
+
+        self.client.authenticate(self.username, self.password)
+
+        response = self.client.renamescript("does-not-exist", "new")
+        self.assertEqual(response, b'NO (NONEXISTENT) "No script by that name"\r\n')
+
+        response = self.client.renamescript(self.filter_name, self.filter_name)
+        self.assertEqual(
+            response, b'NO (ALREADYEXISTS) "A script by that name exists"\r\n'
+        )
+
     def test_deletescript_invalid_script(self) -> None:
         """Test the DELETESCRIPT command with a non-existing filter name."""
 
@@ -0,0 +1,186 @@
+import os
+import signal
+import socket
+import tempfile
+import time
+from threading import Thread
+from unittest import TestCase
+
+from base import MockClient, MockConfig
+from config import DEFAULT_CONFIG
+from test_servers import MockOptions
+
+from pysieved import metrics, metricsd
+from pysieved.main import get_handler, get_server
+from pysieved.managesieve import RequestHandler
+
+
+def config_with_metrics(**main) -> MockConfig:
+    config = {section: dict(values) for section, values in DEFAULT_CONFIG.items()}
+    config["main"]["metrics"] = "127.0.0.1:0"
+    config["main"].update(main)
+    return MockConfig(config)
+
+
+class RegistryTest(TestCase):
+    def setUp(self) -> None:
+        self.addCleanup(setattr, metrics, "registry", None)
+        self.registry = metrics.setup(config_with_metrics(), RequestHandler, ["sievec"])
+
+    def test_off(self) -> None:
+        """Test that metrics are off without the option."""
+
+        self.assertIsNone(metrics.setup(MockConfig(DEFAULT_CONFIG), RequestHandler))
+        metrics.add("pysieved_sent_bytes_total", 10)
+
+    def test_forked(self) -> None:
+        """Test that counts of forked processes add up."""
+
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if not pid:
+                status = 1
+                try:
+                    for _ in range(100):
+                        metrics.add("pysieved_sent_bytes_total", 2)
+                        metrics.observe("pysieved_validator_duration_seconds", 0.003, "sievec")
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+
+        text = self.registry.render()
+        self.assertIn("\npysieved_sent_bytes_total 800\n", text)
+        self.assertIn(
+            '\npysieved_validator_duration_seconds_bucket{validator="sievec",le="0.0025"} 0\n',
+            text,
+        )
+        self.assertIn(
+            '\npysieved_validator_duration_seconds_bucket{validator="sievec",le="0.005"} 400\n',
+            text,
+        )
+        self.assertIn(
+            '\npysieved_validator_duration_seconds_count{validator="sievec"} 400\n', text
+        )
+
+    def test_killed(self) -> None:
+        """Test that a process killed while updating holds nobody up."""
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(r)
+            metrics.add("pysieved_sent_bytes_total", 1)
+            # Killed in the middle of an update
+            with self.registry.lock:
+                os.write(w, b"x")
+                time.sleep(60)
+
+        os.close(w)
+        os.read(r, 1)
+        os.close(r)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+        metrics.add("pysieved_sent_bytes_total", 1)
+        self.assertIn("\npysieved_sent_bytes_total 2\n", self.registry.render())
+
+    def test_unknown_label(self) -> None:
+        """Test that undeclared label values are counted as other."""
+
+        metrics.add("pysieved_command_errors_total", label="FROB")
+        text = self.registry.render()
+        self.assertIn('\npysieved_command_errors_total{command="other"} 1\n', text)
+        self.assertIn('\npysieved_command_errors_total{command="LOGOUT"} 0\n', text)
+
+
+class ServerMetricsTest(TestCase):
+    def setUp(self) -> None:
+        self.addCleanup(setattr, metrics, "registry", None)
+
+        options = MockOptions()
+        config = config_with_metrics(mode="prefork", workers=2)
+        handler = get_handler(options, config)
+
+        self.server = get_server(config, (options.bindaddr, options.port), handler)
+        self._t = Thread(target=self.server.serve_forever)
+        self._t.start()
+        self.addCleanup(self._t.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_session(self) -> None:
+        """Test the metrics of a session served by a worker."""
+
+        client = MockClient(self.server)
+        self.addCleanup(client.close)
+        client.get_full_response()
+        self.assertEqual(client.authenticate("test", "12345"), b"OK\r\n")
+        client.conn.sendall(b'GETSCRIPT "does-not-exist"\r\n')
+        client.get_full_response()
+        self.assertEqual(client.logout(), b"OK\r\n")
+
+        for _ in range(50):
+            text = metrics.registry.render()
+            if "\npysieved_connections 0\n" in text:
+                break
+            time.sleep(0.1)
+
+        self.assertIn("\npysieved_connections 0\n", text)
+        self.assertIn("\npysieved_children 2\n", text)
+        self.assertIn(
+            '\npysieved_command_duration_seconds_count{command="AUTHENTICATE"} 1\n',
+            text,
+        )
+        self.assertIn(
+            '\npysieved_command_duration_seconds_count{command="LOGOUT"} 1\n', text
+        )
+        self.assertIn('\npysieved_command_errors_total{command="GETSCRIPT"} 1\n', text)
+        self.assertIn('\npysieved_command_errors_total{command="AUTHENTICATE"} 0\n', text)
+        self.assertIn('\npysieved_auth_duration_seconds_count{outcome="ok"} 1\n', text)
+        self.assertIn(
+            '\npysieved_userdb_duration_seconds_count{outcome="found"} 1\n', text
+        )
+        self.assertNotIn("\npysieved_received_bytes_total 0\n", text)
+        self.assertNotIn("\npysieved_sent_bytes_total 0\n", text)
+
+
+class ExporterTest(TestCase):
+    def test_unix_socket(self) -> None:
+        """Test scraping the metrics from the exporter's Unix socket."""
+
+        self.addCleanup(setattr, metrics, "registry", None)
+        registry = metrics.setup(config_with_metrics(), RequestHandler)
+        metrics.add("pysieved_sent_bytes_total", 42)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "metrics")
+
+        exporter = metricsd.bind(path)
+        exporter.registry = registry
+        t = Thread(target=exporter.serve_forever)
+        t.start()
+        self.addCleanup(t.join)
+        self.addCleanup(exporter.server_close)
+        self.addCleanup(exporter.shutdown)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(path)
+            sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = b""
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                response += data
+
+        self.assertTrue(response.startswith(b"HTTP/1.0 200"))
+        self.assertIn(b"\r\nContent-Type: text/plain; version=0.0.4\r\n", response)
+        self.assertIn(b"\npysieved_sent_bytes_total 42\n", response)
@@ -0,0 +1,114 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from base import MockConfig
+
+from pysieved.plugins import mysql
+
+AUTH_QUERY = 'SELECT username FROM users WHERE username = "%(username)s" AND password = "%(password)s" AND (active = "1")'
+USER_QUERY = 'SELECT homedir FROM users WHERE username = "%(username)s" AND (active = "1")'
+AUTH_LOOKUP_QUERY = 'SELECT homedir FROM users WHERE username = "%(username)s" AND password = "%(password)s" AND (active = "1")'
+
+
+class MySQLTest(TestCase):
+    """Run the MySQL plugin against SQLite, which has the same DB-API."""
+
+    extra_configuration = {}
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        dbname = os.path.join(self.tmp.name, "users.db")
+        with sqlite3.connect(dbname) as conn:
+            conn.execute(
+                "CREATE TABLE users (username TEXT, password TEXT, homedir TEXT, active TEXT)"
+            )
+            conn.execute("INSERT INTO users VALUES ('test', '12345', '/home/test', '1')")
+        conn.close()
+
+        configuration = {
+            "driver": "sqlite3",
+            "dbhost": "localhost",
+            "dbuser": "user",
+            "dbpass": "pass",
+            "dbname": dbname,
+            "auth_query": AUTH_QUERY,
+            "user_query": USER_QUERY,
+        }
+        configuration.update(self.extra_configuration)
+
+        self.queries = []
+        self.plugin = mysql.PysievedPlugin(
+            lambda level, message: None, MockConfig({"MySQL": configuration})
+        )
+        # sqlite3.connect() only takes the database file
+        self.plugin.connect_args = {"database": dbname}
+        self.plugin.connection().set_trace_callback(self.queries.append)
+
+    def test_auth(self) -> None:
+        """Test a login and a lookup."""
+
+        self.assertTrue(self.plugin.auth({"username": "test", "password": "12345"}))
+        self.assertEqual(self.plugin.lookup({"username": "test"}), "/home/test")
+
+    def test_wrong_password(self) -> None:
+        """Test a login with a wrong password."""
+
+        self.assertFalse(self.plugin.auth({"username": "test", "password": "54321"}))
+
+    def test_injection(self) -> None:
+        """Test that parameters are bound, not interpolated."""
+
+        params = {"username": 'test" OR "1" = "1', "password": '" OR "1" = "1'}
+        self.assertFalse(self.plugin.auth(params))
+
+    def test_connection_per_process(self) -> None:
+        """Test that a forked child opens its own connection."""
+
+        parent = self.plugin.connection()
+
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                status = 0 if self.plugin.connection() is not parent else 1
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertIs(self.plugin.connection(), parent)
+
+
+class AuthLookupQueryTest(MySQLTest):
+    extra_configuration = {"auth_lookup_query": AUTH_LOOKUP_QUERY}
+
+    def test_one_query(self) -> None:
+        """Test that a login and its lookup take a single query."""
+
+        self.test_auth()
+        self.assertEqual(len(self.queries), 1)
+
+    def test_last_login_only(self) -> None:
+        """Test that only the last login's home is kept for lookups."""
+
+        for _ in range(3):
+            self.assertTrue(self.plugin.auth({"username": "test", "password": "12345"}))
+        self.assertEqual(self.plugin.last_login, ("test", "/home/test"))
+
+        self.assertEqual(self.plugin.lookup({"username": "test"}), "/home/test")
+        self.assertIsNone(self.plugin.last_login)
+        self.assertEqual(len(self.queries), 3)
+
+
+class NoUserQueryTest(MySQLTest):
+    extra_configuration = {"auth_lookup_query": AUTH_LOOKUP_QUERY, "user_query": ""}
+
+    def test_lookup_without_login(self) -> None:
+        """Test that without user_query, only users who logged in are found."""
+
+        self.assertIsNone(self.plugin.lookup({"username": "test"}))
+        self.test_auth()
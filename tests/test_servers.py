@@ -0,0 +1,351 @@
+import os
+import time
+from pathlib import Path
+from threading import Thread
+from unittest import TestCase, skipUnless
+
+from base import MockClient, MockConfig, MockFilesystem
+from config import DEFAULT_CONFIG
+
+from pysieved.main import get_handler, get_server
+
+
+class MockOptions:
+    bindaddr = ""
+    port = 0
+    pidfile = "/tmp/pysieved.pid"
+    base = str(Path(__file__).parent.joinpath("mock_srv"))
+    tls_required = False
+    tls_key = ""
+    tls_cert = ""
+    tls_passphrase = ""
+    debug = True
+
+
+class ServerModeTest:
+    """Run a short session against the server started in `mode`."""
+
+    mode = ""
+    extra_configuration = {}
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        options = MockOptions()
+        config = {section: dict(values) for section, values in DEFAULT_CONFIG.items()}
+        config["main"]["mode"] = self.mode
+        config["main"].update(self.extra_configuration)
+        config = MockConfig(config)
+
+        handler = get_handler(options, config)
+
+        self.server = get_server(config, (options.bindaddr, options.port), handler)
+        self._t = Thread(target=self.server.serve_forever)
+        self._t.start()
+
+        self.username = "test"
+        self.password = "12345"
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self._t.join()
+
+        super().tearDown()
+
+    def connect(self) -> MockClient:
+        client = MockClient(self.server)
+        client.conn.settimeout(2)
+        self.addCleanup(client.close)
+
+        return client
+
+    def read_until(self, client: MockClient, end: bytes) -> bytes:
+        response = b""
+        while not response.endswith(end):
+            part = client.conn.recv(client.BUF_SIZE)
+            if not part:
+                break
+            response += part
+
+        return response
+
+    def test_session(self) -> None:
+        """Test a greeting and an authentication on the server."""
+
+        client = self.connect()
+
+        greeting = self.read_until(client, b"OK\r\n")
+        self.assertTrue(greeting.startswith(b'"IMPLEMENTATION" "pysieved 1.0"'))
+
+        client.conn.settimeout(client._default_timeout)
+        response = client.authenticate(self.username, self.password)
+        self.assertEqual(response, b"OK\r\n")
+
+        response = client.logout()
+        self.assertEqual(response, b"OK\r\n")
+
+    def test_getscript(self) -> None:
+        """Test that GETSCRIPT sends the whole script."""
+
+        fs = MockFilesystem(MockOptions.base, self.username)
+        content = b"# Sieve filter\n" + b"# padding\n" * 20000
+        fs.create_filter("server_mode_filter", content)
+        self.addCleanup(fs.remove_filter, "server_mode_filter")
+
+        client = self.connect()
+        self.read_until(client, b"OK\r\n")
+        client.conn.settimeout(client._default_timeout)
+        client.authenticate(self.username, self.password)
+
+        client.conn.settimeout(2)
+        client.conn.send(b'GETSCRIPT "server_mode_filter"\r\n')
+        response = self.read_until(client, b"\r\nOK\r\n")
+
+        expected = b"{%d}\r\n%s\r\nOK\r\n" % (len(content), content)
+        self.assertEqual(response, expected)
+
+    def test_sequential_sessions(self) -> None:
+        """Test more sessions than there are workers."""
+
+        for _ in range(5):
+            client = self.connect()
+            greeting = self.read_until(client, b"OK\r\n")
+            self.assertTrue(greeting.endswith(b"OK\r\n"))
+            client.close()
+
+
+class PreforkServerTest(ServerModeTest, TestCase):
+    mode = "prefork"
+    extra_configuration = {"workers": 2, "max_sessions": 2}
+
+    def wait_for_workers(self) -> set:
+        for _ in range(50):
+            if len(self.server.children) == 2:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(len(self.server.children), 2)
+        return set(self.server.children)
+
+    def test_workers_replaced(self) -> None:
+        """Test that workers are recycled after max_sessions."""
+
+        old = self.wait_for_workers()
+
+        # Two sessions at a time: each worker serves one of them
+        for _ in range(2):
+            clients = [self.connect() for _ in range(2)]
+            for client in clients:
+                self.assertTrue(self.read_until(client, b"OK\r\n").endswith(b"OK\r\n"))
+            for client in clients:
+                client.close()
+
+        for _ in range(50):
+            if not old & self.server.children and len(self.server.children) == 2:
+                break
+            time.sleep(0.1)
+
+        self.assertFalse(old & self.server.children)
+        self.assertEqual(len(self.server.children), 2)
+
+    def test_failing_workers(self) -> None:
+        """Test that workers failing at startup are not replaced at once."""
+
+        self.wait_for_workers()
+
+        spawned = []
+        spawn_worker = self.server.spawn_worker
+
+        def failing_worker():
+            spawned.append(time.monotonic())
+            self.server.serve_worker = lambda: 1 / 0
+            try:
+                return spawn_worker()
+            finally:
+                del self.server.serve_worker
+
+        self.server.respawn_interval = 0.5
+        self.server.spawn_worker = failing_worker
+        self.server.recycle_workers()
+
+        # Like SIGCHLD would, which only reaches the main thread
+        deadline = time.monotonic() + 1.2
+        while time.monotonic() < deadline:
+            self.server._wakeup()
+            time.sleep(0.01)
+        del self.server.spawn_worker
+
+        # Both workers, then each replacement every half second
+        self.assertGreaterEqual(len(spawned), 2)
+        self.assertLessEqual(len(spawned), 8)
+
+    def drop_privileges(self, per_user: bool) -> None:
+        """Have sessions switch to a shared gid, like the virtual userdb."""
+
+        handler = self.server.RequestHandlerClass
+        get_homedir = handler.get_homedir
+
+        def switching_get_homedir(session, username):
+            os.setegid(65534)
+            return get_homedir(session, username)
+
+        handler.get_homedir = switching_get_homedir
+        handler.setuid_per_user = classmethod(lambda cls: per_user)
+
+        # Only workers forked from now on see the patched handler
+        old = self.wait_for_workers()
+        self.server.recycle_workers()
+        for _ in range(50):
+            if not old & self.server.children and len(self.server.children) == 2:
+                break
+            time.sleep(0.1)
+
+    def serve_authenticated(self) -> None:
+        for _ in range(2):
+            clients = [self.connect() for _ in range(2)]
+            for client in clients:
+                self.read_until(client, b"OK\r\n")
+                client.conn.settimeout(client._default_timeout)
+                response = client.authenticate(self.username, self.password)
+                self.assertEqual(response, b"OK\r\n")
+            for client in clients:
+                client.close()
+        time.sleep(0.2)
+
+    @skipUnless(os.geteuid() == 0, "needs root to switch gid")
+    def test_shared_uid_keeps_workers(self) -> None:
+        """Test that workers outlive sessions switching to a shared uid."""
+
+        self.server.max_sessions = 0
+        self.drop_privileges(per_user=False)
+        workers = self.wait_for_workers()
+
+        self.serve_authenticated()
+        self.assertEqual(self.server.children, workers)
+
+    @skipUnless(os.geteuid() == 0, "needs root to switch gid")
+    def test_per_user_recycles_workers(self) -> None:
+        """Test that workers exit once a session switched users."""
+
+        self.server.max_sessions = 0
+        self.drop_privileges(per_user=True)
+        workers = self.wait_for_workers()
+
+        self.serve_authenticated()
+        self.assertFalse(self.server.children & workers)
+
+    def test_recycle_workers(self) -> None:
+        """Test that idle workers are replaced after recycle_workers()."""
+
+        self.test_sequential_sessions()
+        old = set(self.server.children)
+        self.server.recycle_workers()
+
+        for _ in range(50):
+            if not old & self.server.children:
+                break
+            time.sleep(0.1)
+
+        self.assertFalse(old & self.server.children)
+        self.test_sequential_sessions()
+
+
+class ThreadPoolServerTest(ServerModeTest, TestCase):
+    mode = "thread"
+    extra_configuration = {"threads": 2}
+
+    def test_concurrent_sessions(self) -> None:
+        """Test as many concurrent sessions as there are threads."""
+
+        clients = [self.connect() for _ in range(2)]
+        for client in clients:
+            greeting = self.read_until(client, b"OK\r\n")
+            self.assertTrue(greeting.endswith(b"OK\r\n"))
+
+        for client in reversed(clients):
+            client.conn.settimeout(client._default_timeout)
+            response = client.authenticate(self.username, self.password)
+            self.assertEqual(response, b"OK\r\n")
+
+    def test_threads_start_with_serving(self) -> None:
+        """Test that the pool starts in serve_forever, not before a fork."""
+
+        config = {section: dict(values) for section, values in DEFAULT_CONFIG.items()}
+        config["main"].update(mode=self.mode, **self.extra_configuration)
+        config = MockConfig(config)
+        server = get_server(config, ("", 0), get_handler(MockOptions(), config))
+        self.addCleanup(server.server_close)
+
+        self.assertEqual(server.threads, [])
+
+        self.read_until(self.connect(), b"OK\r\n")
+        self.assertEqual(len(self.server.threads), 2)
+
+
+class AsyncioServerTest(ServerModeTest, TestCase):
+    mode = "asyncio"
+    extra_configuration = {"threads": 2}
+
+    def test_concurrent_sessions(self) -> None:
+        """Test idle sessions that outnumber the executor threads."""
+
+        clients = [self.connect() for _ in range(5)]
+        for client in clients:
+            greeting = self.read_until(client, b"OK\r\n")
+            self.assertTrue(greeting.endswith(b"OK\r\n"))
+
+        for client in reversed(clients):
+            client.conn.settimeout(client._default_timeout)
+            response = client.authenticate(self.username, self.password)
+            self.assertEqual(response, b"OK\r\n")
+
+    def test_sasl_timeout(self) -> None:
+        """Test that a client stalling a SASL exchange is dropped."""
+
+        handler = self.server.RequestHandlerClass
+        handler.input_timeout = 0.2
+        handler.do_sasl_first = lambda self, *args: {"result": "CONT", "msg": ""}
+
+        client = self.connect()
+        self.read_until(client, b"OK\r\n")
+        client.conn.send(b'AUTHENTICATE "PLAIN"\r\n')
+        self.assertEqual(self.read_until(client, b"\r\n\r\n"), b"{0}\r\n\r\n")
+
+        # Hung up without an answer
+        self.assertEqual(client.conn.recv(client.BUF_SIZE), b"")
+
+    def test_sasl_literal_too_large(self) -> None:
+        """Test that a huge SASL continuation literal is refused unread."""
+
+        handler = self.server.RequestHandlerClass
+        handler.do_sasl_first = lambda self, *args: {"result": "CONT", "msg": ""}
+
+        client = self.connect()
+        self.read_until(client, b"OK\r\n")
+        client.conn.send(b'AUTHENTICATE "PLAIN"\r\n')
+        self.assertEqual(self.read_until(client, b"\r\n\r\n"), b"{0}\r\n\r\n")
+
+        client.conn.send(b"{1500000000+}\r\n")
+        self.assertEqual(self.read_until(client, b"\r\n"), b'BYE "Literal too large"\r\n')
+
+    def test_getscript_unread(self) -> None:
+        """Test that GETSCRIPTs nobody reads hold up no thread."""
+
+        fs = MockFilesystem(MockOptions.base, self.username)
+        fs.create_filter("server_mode_filter", b"#" * (32 << 20))
+        self.addCleanup(fs.remove_filter, "server_mode_filter")
+
+        for _ in range(2):
+            client = self.connect()
+            self.read_until(client, b"OK\r\n")
+            client.conn.settimeout(client._default_timeout)
+            client.authenticate(self.username, self.password)
+            client.conn.send(b'GETSCRIPT "server_mode_filter"\r\n')
+
+        client = self.connect()
+        greeting = self.read_until(client, b"OK\r\n")
+        self.assertTrue(greeting.endswith(b"OK\r\n"))
+        client.conn.settimeout(2)
+        response = client.authenticate(self.username, self.password)
+        self.assertEqual(response, b"OK\r\n")
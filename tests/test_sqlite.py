@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from base import MockConfig
+
+from pysieved.plugins import sqlite
+
+
+class SQLiteStorageTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.database = os.path.join(self.tmp.name, "scripts.db")
+        self.plugin = sqlite.PysievedPlugin(
+            lambda level, message: None,
+            MockConfig(
+                {
+                    "SQLite": {
+                        "database": self.database,
+                        "sievec": "/bin/true",
+                        "scratch": self.tmp.name,
+                    }
+                }
+            ),
+        )
+
+        self.addCleanup(self.close)
+
+    def close(self) -> None:
+        self.plugin.db.close()
+
+    def storage(self, username: str) -> sqlite.SQLiteStorage:
+        home = os.path.join(self.tmp.name, username)
+        os.makedirs(home, exist_ok=True)
+        return self.plugin.create_storage({"username": username, "homedir": home})
+
+    def active_file(self, username: str) -> bytes | None:
+        try:
+            path = os.path.join(self.tmp.name, username, ".dovecot.sieve")
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def test_wal(self) -> None:
+        """Test that the database is in WAL mode."""
+
+        conn = sqlite3.connect(self.database)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_scripts(self) -> None:
+        """Test storing, listing and deleting scripts, per user."""
+
+        storage = self.storage("test")
+        storage["one"] = b"keep;\n"
+        storage["two"] = "discard;\n"
+        self.storage("other")["three"] = b"keep;\n"
+
+        self.assertEqual(list(storage), ["one", "two"])
+        self.assertEqual(storage["two"], b"discard;\n")
+        self.assertTrue(storage.has_key("one"))
+        self.assertFalse(storage.has_key("three"))
+        self.assertRaises(KeyError, storage.__getitem__, "three")
+
+        del storage["one"]
+        self.assertEqual(list(storage), ["two"])
+        self.assertEqual(list(self.storage("other")), ["three"])
+
+    def test_set_active(self) -> None:
+        """Test that only the active script is written out."""
+
+        storage = self.storage("test")
+        storage["one"] = b"keep;\n"
+        storage["two"] = b"discard;\n"
+        self.assertIsNone(self.active_file("test"))
+
+        storage.set_active("one")
+        self.assertEqual(storage.active_name(), "one")
+        self.assertEqual(self.active_file("test"), b"keep;\n")
+        self.assertRaises(ValueError, storage.__delitem__, "one")
+
+        storage.set_active("two")
+        self.assertTrue(storage.is_active("two"))
+        self.assertFalse(storage.is_active("one"))
+        self.assertEqual(self.active_file("test"), b"discard;\n")
+
+        # Replacing the active script replaces the file
+        storage["two"] = b"stop;\n"
+        self.assertEqual(self.active_file("test"), b"stop;\n")
+
+        self.assertRaises(KeyError, storage.set_active, "three")
+        self.assertEqual(storage.active_name(), "two")
+
+        storage.set_active(None)
+        self.assertIsNone(storage.active_name())
+        self.assertIsNone(self.active_file("test"))
+
+    def test_rename(self) -> None:
+        """Test renaming the active script."""
+
+        storage = self.storage("test")
+        storage["one"] = b"keep;\n"
+        storage["two"] = b"discard;\n"
+        storage.set_active("one")
+        self.plugin.sievec = "/bin/false"
+
+        storage.rename("one", "three")
+        self.assertEqual(list(storage), ["three", "two"])
+        self.assertEqual(storage.active_name(), "three")
+        self.assertEqual(self.active_file("test"), b"keep;\n")
+
+        self.assertRaises(FileExistsError, storage.rename, "three", "two")
+        self.assertRaises(KeyError, storage.rename, "one", "four")
+        self.assertEqual(list(storage), ["three", "two"])
+
+    def test_check(self) -> None:
+        """Test that checking a script stores nothing."""
+
+        storage = self.storage("test")
+        storage.check(b"keep;\n")
+        self.assertEqual(list(storage), [])
+
+        self.plugin.sievec = "/bin/false"
+        self.assertRaises(ValueError, storage.check, b"bad")
+
+    def test_failed_write_out(self) -> None:
+        """Test that activation is rolled back if the file can't be written."""
+
+        storage = self.storage("test")
+        storage["one"] = b"keep;\n"
+        storage.homedir = storage.active = os.path.join(self.tmp.name, "gone", "x")
+
+        self.assertRaises(OSError, storage.set_active, "one")
+        self.assertIsNone(storage.active_name())
+
+    def test_invalid_script(self) -> None:
+        """Test that scripts the validator refuses are not stored."""
+
+        self.plugin.sievec = "/bin/false"
+        storage = self.storage("test")
+
+        self.assertRaises(ValueError, storage.__setitem__, "one", b"bad")
+        self.assertEqual(list(storage), [])
@@ -0,0 +1,193 @@
+import base64
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from threading import Thread
+from unittest import TestCase, skipUnless
+
+from base import MockClient, MockConfig
+from config import DEFAULT_CONFIG
+from test_servers import MockOptions
+
+from pysieved import tls
+from pysieved.cache import FileCache
+from pysieved.main import LazyPlugin, get_handler, get_server, load_plugins
+
+KEY = str(Path(__file__).parent.joinpath("mock.key"))
+CERT = str(Path(__file__).parent.joinpath("mock.crt"))
+
+
+class CredentialsTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.key = os.path.join(self.tmp.name, "key.pem")
+        self.cert = os.path.join(self.tmp.name, "cert.pem")
+        for fn in (self.key, self.cert):
+            with open(fn, "w") as f:
+                f.write("-----BEGIN-----\n")
+
+        cache = FileCache(os.path.join(self.tmp.name, "cache"), mode=0o600)
+        self.credentials = tls.TLSLiteCredentials(self.key, self.cert, "secret", cache)
+
+    @skipUnless(tls.available("tlslite"), "tlslite is not installed")
+    def test_cached(self) -> None:
+        """Test that the key is cached as PEM and read back from there."""
+
+        cache = self.credentials.cache
+        credentials = tls.TLSLiteCredentials(KEY, CERT, "", cache)
+        _, key = credentials.load()
+
+        cached = cache.get(credentials.cache_key())
+        self.assertTrue(cached.startswith(b"-----BEGIN"))
+
+        _, again = tls.TLSLiteCredentials(KEY, CERT, "", cache).load()
+        self.assertEqual(again.n, key.n)
+
+    def test_cache_key(self) -> None:
+        """Test that the cache key follows the files and the passphrase."""
+
+        key = self.credentials.cache_key()
+        self.assertNotIn("secret", key)
+
+        self.credentials.passphrase = "other"
+        self.assertNotEqual(self.credentials.cache_key(), key)
+
+        self.credentials.passphrase = "secret"
+        with open(self.key, "a") as f:
+            f.write("-----END-----\n")
+        self.assertNotEqual(self.credentials.cache_key(), key)
+
+
+class LazyPluginTest(TestCase):
+    def test_lazy_imports(self) -> None:
+        """Test that importing main leaves out what sessions may not use."""
+
+        modules = [
+            "pysieved.authcache",
+            "pysieved.cache",
+            "pysieved.usercache",
+            "pysieved.validation",
+            "json",
+            "tempfile",
+        ]
+        code = "import sys, pysieved.main; print(*(m in sys.modules for m in %r))"
+        output = subprocess.check_output([sys.executable, "-c", code % modules])
+        self.assertEqual(output.split(), [b"False"] * len(modules))
+
+    def test_lazy_userdb(self) -> None:
+        """Test that the userdb is only set up when used."""
+
+        _, homedir, _ = load_plugins(MockConfig(DEFAULT_CONFIG), lazy=True)
+        self.assertIsInstance(homedir, LazyPlugin)
+        self.assertIsNone(homedir._plugin)
+
+        self.assertTrue(homedir.lookup({"username": "test"}))
+        self.assertIsNotNone(homedir._plugin)
+
+
+class SSLOptions(MockOptions):
+    tls_required = True
+    tls_key = KEY
+    tls_cert = CERT
+
+
+class SSLServerTest:
+    """STARTTLS with the ssl backend on the server started in `mode`."""
+
+    mode = ""
+    extra_configuration = {}
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        options = SSLOptions()
+        config = {section: dict(values) for section, values in DEFAULT_CONFIG.items()}
+        config["main"]["mode"] = self.mode
+        config["main"].update(self.extra_configuration)
+        config = MockConfig(config)
+
+        handler = get_handler(options, config)
+        handler.preload()
+
+        self.server = get_server(config, (options.bindaddr, options.port), handler)
+        self._t = Thread(target=self.server.serve_forever)
+        self._t.start()
+        self.addCleanup(self._t.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.context = ssl.create_default_context(cafile=CERT)
+        self.context.check_hostname = False
+
+    def read_until(self, conn, end: bytes) -> bytes:
+        response = b""
+        while not response.endswith(end):
+            part = conn.recv(4096)
+            if not part:
+                break
+            response += part
+
+        return response
+
+    def starttls(self, session=None):
+        client = MockClient(self.server)
+        self.addCleanup(client.close)
+        conn = client.conn
+        conn.settimeout(5)
+
+        greeting = self.read_until(conn, b"OK\r\n")
+        self.assertIn(b'"STARTTLS"', greeting)
+        self.assertNotIn(b'"SASL" "PLAIN"', greeting.split(b"\r\n"))
+
+        conn.sendall(b"STARTTLS\r\n")
+        self.assertEqual(
+            self.read_until(conn, b"\r\n"), b'OK "Begin TLS negotiation now"\r\n'
+        )
+
+        conn = self.context.wrap_socket(conn, session=session)
+        client.conn = conn
+        capability = self.read_until(conn, b"OK\r\n")
+        self.assertNotIn(b'"STARTTLS"', capability)
+        self.assertIn(b'"SASL" "PLAIN"', capability)
+
+        return conn
+
+    def test_session(self) -> None:
+        """Test an authentication after STARTTLS."""
+
+        conn = self.starttls()
+        auth = base64.b64encode(b"\x00test\x0012345")
+        conn.sendall(b'AUTHENTICATE "PLAIN" "%s"\r\n' % auth)
+        self.assertEqual(self.read_until(conn, b"\r\n"), b"OK\r\n")
+
+        conn.sendall(b"LOGOUT\r\n")
+        self.assertEqual(self.read_until(conn, b"\r\n"), b"OK\r\n")
+
+    def test_resumption(self) -> None:
+        """Test that a later session resumes the first one's TLS session."""
+
+        conn = self.starttls()
+        session = conn.session
+        self.assertIsNotNone(session)
+        conn.close()
+
+        # More sessions than workers: several processes resume it
+        for _ in range(3):
+            conn = self.starttls(session)
+            self.assertTrue(conn.session_reused)
+            conn.close()
+
+
+class PreforkSSLServerTest(SSLServerTest, TestCase):
+    mode = "prefork"
+    extra_configuration = {"workers": 2, "max_sessions": 2}
+
+
+class AsyncioSSLServerTest(SSLServerTest, TestCase):
+    mode = "asyncio"
+    extra_configuration = {"threads": 2}
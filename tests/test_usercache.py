@@ -0,0 +1,85 @@
+import tempfile
+from unittest import TestCase
+
+from base import MockConfig
+
+from pysieved import plugins
+from pysieved.usercache import get_user_cache
+
+
+class CountingUserdb(plugins.PysievedPlugin):
+    def init(self, config):
+        self.lookups = []
+        self.switches = []
+
+    def lookup_user(self, params):
+        self.lookups.append(params["username"])
+        if params["username"] == "test":
+            return "/home/test", 1000, 100
+        return None
+
+    def switch_user(self, uid, gid):
+        self.switches.append((uid, gid))
+
+
+class LegacyUserdb(plugins.PysievedPlugin):
+    def lookup(self, params):
+        return "/home/legacy"
+
+
+class UserCacheTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.config = MockConfig({"main": {"userdb_cache": self.tmp.name}})
+        self.cache = get_user_cache(self.config)
+        self.userdb = CountingUserdb(None, self.config)
+
+    def test_cached_lookup(self) -> None:
+        """Test that a lookup is remembered, ids included."""
+
+        for _ in range(3):
+            home = self.cache.lookup(self.userdb, {"username": "test"})
+            self.assertEqual(home, "/home/test")
+
+        self.assertEqual(self.userdb.lookups, ["test"])
+        self.assertEqual(self.userdb.switches, [(1000, 100)] * 3)
+
+    def test_shared(self) -> None:
+        """Test that another process's cache sees the entry."""
+
+        self.cache.lookup(self.userdb, {"username": "test"})
+
+        other = get_user_cache(self.config)
+        self.assertEqual(other.lookup(self.userdb, {"username": "test"}), "/home/test")
+        self.assertEqual(self.userdb.lookups, ["test"])
+
+    def test_unknown_user(self) -> None:
+        """Test that unknown users are remembered."""
+
+        for _ in range(2):
+            self.assertIsNone(self.cache.lookup(self.userdb, {"username": "nobody"}))
+
+        self.assertEqual(self.userdb.lookups, ["nobody"])
+        self.assertEqual(self.userdb.switches, [])
+
+    def test_negative_ttl(self) -> None:
+        """Test that unknown users are not remembered with a zero TTL."""
+
+        self.cache.negative_ttl = 0
+        for _ in range(2):
+            self.assertIsNone(self.cache.lookup(self.userdb, {"username": "nobody"}))
+
+        self.assertEqual(self.userdb.lookups, ["nobody", "nobody"])
+
+    def test_legacy_plugin(self) -> None:
+        """Test that plugins without lookup_user are asked every time."""
+
+        userdb = LegacyUserdb(None, self.config)
+        self.assertEqual(self.cache.lookup(userdb, {"username": "test"}), "/home/legacy")
+
+    def test_disabled(self) -> None:
+        """Test that there's no cache unless configured."""
+
+        self.assertIsNone(get_user_cache(MockConfig({})))
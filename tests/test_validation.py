@@ -0,0 +1,146 @@
+import os
+import sys
+import tempfile
+from unittest import TestCase
+
+from base import MockConfig
+
+from pysieved import cache, validation
+from pysieved.cache import FileCache
+from pysieved.validation import CachedValidator, RemoteValidator, wrap_validator
+
+
+class ValidationCacheTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.calls = []
+        config = MockConfig(
+            {"main": {"validation_cache": os.path.join(self.tmp.name, "cache")}}
+        )
+        self.validate = wrap_validator(
+            config, "test", sys.executable, self.sieve_has_error
+        )
+
+    def sieve_has_error(self, basedir, script):
+        self.calls.append(script)
+        with open(script, "rb") as f:
+            if b"error" in f.read():
+                return b"%s: line 1: error" % script.encode()
+        return None
+
+    def script(self, content: bytes) -> str:
+        fd, name = tempfile.mkstemp(dir=self.tmp.name)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        return name
+
+    def test_valid_script_cached(self) -> None:
+        """Test that the validator runs once for identical scripts."""
+
+        first = self.script(b"keep;\n")
+        second = self.script(b"keep;\n")
+
+        self.assertIsNone(self.validate(self.tmp.name, first))
+        self.assertIsNone(self.validate(self.tmp.name, second))
+        self.assertEqual(self.calls, [first])
+
+    def test_error_cached(self) -> None:
+        """Test that cached errors name the script being validated."""
+
+        first = self.script(b"error;\n")
+        second = self.script(b"error;\n")
+
+        self.assertEqual(self.validate(self.tmp.name, first), f"{first}: line 1: error")
+        self.assertEqual(
+            self.validate(self.tmp.name, second), f"{second}: line 1: error"
+        )
+        self.assertEqual(self.calls, [first])
+
+    def test_different_scripts(self) -> None:
+        """Test that a different script is validated again."""
+
+        self.validate(self.tmp.name, self.script(b"keep;\n"))
+        self.validate(self.tmp.name, self.script(b"discard;\n"))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_not_configured(self) -> None:
+        """Test that the validator is used as is without a cache."""
+
+        validate = wrap_validator(
+            MockConfig({"main": {}}), "test", sys.executable, self.sieve_has_error
+        )
+        self.assertEqual(validate, self.sieve_has_error)
+
+    def test_daemon_owns_cache(self) -> None:
+        """Test that with the validator daemon, only the daemon caches."""
+
+        config = MockConfig(
+            {
+                "main": {
+                    "validation_cache": os.path.join(self.tmp.name, "cache"),
+                    "validator_socket": os.path.join(self.tmp.name, "sock"),
+                }
+            }
+        )
+        validate = wrap_validator(config, "test", sys.executable, self.sieve_has_error)
+
+        self.assertIsInstance(validate, RemoteValidator)
+        self.assertEqual(validate.sieve_has_error, self.sieve_has_error)
+        self.assertIsInstance(validation.validators["test"], CachedValidator)
+
+
+class FileCacheTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.cache = FileCache(self.tmp.name, max_entries=10)
+
+    def test_expired(self) -> None:
+        """Test that expired entries are misses."""
+
+        self.cache.set("key", b"value", ttl=-1)
+        self.assertIsNone(self.cache.get("key"))
+
+        self.cache.set("key", b"value", ttl=60)
+        self.assertEqual(self.cache.get("key"), b"value")
+
+    def test_foreign_entry(self) -> None:
+        """Test that an entry that can't be touched is still a hit."""
+
+        self.cache.set("key", b"value")
+
+        def utime(path, times=None):
+            raise PermissionError(1, "Operation not permitted")
+
+        cache.os.utime, saved = utime, cache.os.utime
+        try:
+            self.assertEqual(self.cache.get("key"), b"value")
+        finally:
+            cache.os.utime = saved
+
+    def test_evict(self) -> None:
+        """Test that the least recently used entries are evicted."""
+
+        for i in range(20):
+            self.cache.set(str(i), b"value")
+            os.utime(self.cache.filename(str(i)), (i, i))
+
+        self.cache.evict()
+
+        self.assertIsNone(self.cache.get("0"))
+        self.assertEqual(self.cache.get("19"), b"value")
+        self.assertEqual(len(os.listdir(self.tmp.name)), 9 + 1)
+
+    def test_due(self) -> None:
+        """Test that a marker is due once per interval."""
+
+        marker = os.path.join(self.tmp.name, ".marker")
+        self.assertTrue(cache.due(marker, 60))
+        self.assertFalse(cache.due(marker, 60))
+
+        os.utime(marker, (0, 0))
+        self.assertTrue(cache.due(marker, 60))
+        self.assertFalse(cache.due(marker, 60))
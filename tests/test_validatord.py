@@ -0,0 +1,96 @@
+import os
+import stat
+import tempfile
+import time
+from threading import Thread
+from unittest import TestCase
+
+from pysieved import validatord
+from pysieved.validation import RemoteValidator, Transient
+
+
+def sieve_has_error(basedir, script):
+    with open(script, "rb") as f:
+        content = f.read()
+
+    if b"sleep" in content:
+        time.sleep(10)
+    if b"error" in content:
+        return b"%s: line 1: error" % script.encode()
+    return None
+
+
+class ValidatorDaemonTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        self.path = os.path.join(self.tmp.name, "validator.sock")
+        self.daemon = validatord.ValidatorDaemon(
+            validatord.bind(self.path),
+            {"test": sieve_has_error},
+            slots=2,
+            timeout=1,
+        )
+        self._t = Thread(target=self.daemon.serve_forever)
+        self._t.start()
+        self.addCleanup(self._t.join)
+        self.addCleanup(self.daemon.shutdown)
+
+        self.validate = RemoteValidator(self.path, "test", self.local, 5)
+        self.local_calls = 0
+
+    def local(self, basedir, script):
+        self.local_calls += 1
+        return sieve_has_error(basedir, script)
+
+    def script(self, content: bytes) -> str:
+        fd, name = tempfile.mkstemp(dir=self.tmp.name)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        return name
+
+    def test_validate(self) -> None:
+        """Test scripts validated by the daemon."""
+
+        self.assertIsNone(self.validate(self.tmp.name, self.script(b"keep;\n")))
+
+        script = self.script(b"error;\n")
+        self.assertEqual(self.validate(self.tmp.name, script), f"{script}: line 1: error")
+        self.assertEqual(self.local_calls, 0)
+
+        stats = self.validate.stats()
+        self.assertEqual(stats["done"], 2)
+        self.assertEqual(stats["running"], 0)
+        self.assertEqual(stats["queued"], 0)
+
+    def test_socket_mode(self) -> None:
+        """Test that other users can't connect to the socket."""
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o660)
+
+    def test_too_large(self) -> None:
+        """Test that scripts over the PUTSCRIPT limit are refused unread."""
+
+        header = {"validator": "test", "user": "", "size": self.daemon.maxsize + 1}
+        reply = self.validate.request(header)
+
+        self.assertEqual(reply["error"], "Script too large")
+        self.assertFalse(reply["transient"])
+        self.assertEqual(self.validate.stats()["refused"], 1)
+
+    def test_timeout(self) -> None:
+        """Test that a hung validator is killed."""
+
+        error = self.validate(self.tmp.name, self.script(b"sleep;\n"))
+        self.assertIsInstance(error, Transient)
+        self.assertEqual(self.validate.stats()["timeouts"], 1)
+
+    def test_fallback(self) -> None:
+        """Test validating locally when the daemon is not running."""
+
+        validate = RemoteValidator(
+            os.path.join(self.tmp.name, "missing.sock"), "test", self.local, 5
+        )
+        self.assertIsNone(validate(self.tmp.name, self.script(b"keep;\n")))
+        self.assertEqual(self.local_calls, 1)